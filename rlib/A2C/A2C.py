@@ -6,10 +6,13 @@ import multiprocessing, threading
 from collections import deque
 import time, datetime, os
 import copy
+from functools import partial
 
 from rlib.networks.networks import*
 from rlib.utils.VecEnv import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
+from rlib.utils.AsyncEvaluator import AsyncEvaluator
+from rlib.utils.Sweep import main_or_sweep, latest_checkpoint
 from rlib.utils.utils import fold_batch, stack_many, log_uniform
 from rlib.A2C.ActorCritic import ActorCritic
 
@@ -35,22 +38,31 @@ class A2C(SyncMultiEnvTrainer):
             super().__init__(model,env,num_steps)
         
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
-                policies, values = self.model.forward(self.states)
-                actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
-                next_states, rewards, dones, infos = self.env.step(actions)
-                rollout.append((self.states, actions, rewards, values, dones, np.array(infos)))
+                with self.timer.phase('forward'):
+                    policies, values = self.model.forward(self.states)
+                with self.timer.phase('sample'):
+                    actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+                with self.timer.phase('env_step'):
+                    next_states, rewards, dones, infos = self.env.step(actions)
+                with self.timer.phase('store'):
+                    self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, values=values, dones=dones, infos=infos)
                 self.states = next_states
             
-            states, actions, rewards, values, dones, infos = stack_many(zip(*rollout))
-            _, last_values = self.model.forward(next_states)
+            states, actions, rewards, values, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'values', 'dones', 'infos')
+            with self.timer.phase('forward'):
+                _, last_values = self.model.forward(next_states)
             return states, actions, rewards, dones, infos, values, last_values
     
     def get_action(self, state):
         policy, value = self.model.forward(state)
         action = int(np.random.choice(policy.shape[1], p=policy[0]))
         return action
+
+    def get_batch_actions(self, states, val_state):
+        policies, values = self.model.forward(states)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, val_state
     
     
         
@@ -84,7 +96,7 @@ class A2C(SyncMultiEnvTrainer):
                     self.train_writer.add_summary(sumscore, tot_steps)
 
        
-def main(env_id):
+def main(env_id, async_eval=True, seed=None, run_dir=None):
     
     num_envs = 32
     nsteps = 20
@@ -93,6 +105,8 @@ def main(env_id):
 
     train_log_dir = 'logs/A2C/' + env_id +'/GAE/' + current_time 
     model_dir = "models/A2C/" + env_id + '/GAE/' + current_time 
+    if run_dir is not None: # launched by a Sweep, logs and checkpoints are kept in the run's directory
+        train_log_dir, model_dir = run_dir + '/logs', run_dir + '/models'
     
     env = gym.make(env_id)
     action_size = env.action_space.n
@@ -104,8 +118,9 @@ def main(env_id):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(10)]
-        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
+        val_env_fns = [EnvConstructor(DummyEnv, env_id) for i in range(10)]
+        val_envs = [] if async_eval else BatchEnv(DummyEnv, env_id, 10, blocking=False) # the evaluator builds its own envs
+        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False, seed=seed)
 
     else:
         print('Atari')
@@ -116,11 +131,12 @@ def main(env_id):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
-        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, k=4, reset=reset, episodic=False, clip_reward=True)
+        val_env_fns = [EnvConstructor(AtariEnv, env_id, k=4, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
+        val_envs = [] if async_eval else BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, episodic=False, reset=reset, clip_reward=False)
+        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, k=4, reset=reset, episodic=False, clip_reward=True, seed=seed)
     
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     print('input shape', input_size)
 
     env.close()
@@ -138,21 +154,30 @@ def main(env_id):
                         grad_clip=0.5) 
     
 
-    a2c = A2C(envs = envs,
-              model = model,
-              model_dir = model_dir,
-              log_dir = train_log_dir,
-              val_envs = val_envs,
-              train_mode = 'nstep',
-              return_type = 'GAE',
-              total_steps = 50e6,
-              nsteps = nsteps,
-              validate_freq = 1e6,
-              save_freq = 0,
-              render_freq = 0,
-              num_val_episodes = 50,
-              log_scalars = True,
-              gpu_growth = True)
+    checkpoint = latest_checkpoint(model_dir) if run_dir is not None else None
+    if checkpoint is not None: # resume an unfinished sweep run
+        a2c = A2C.load(A2C, model, checkpoint[0], envs, val_envs, checkpoint[1])
+    else:
+        a2c = A2C(envs = envs,
+                  model = model,
+                  model_dir = model_dir,
+                  log_dir = train_log_dir,
+                  val_envs = val_envs,
+                  train_mode = 'nstep',
+                  return_type = 'GAE',
+                  total_steps = 50e6,
+                  nsteps = nsteps,
+                  validate_freq = 1e6,
+                  save_freq = 1e6 if run_dir is not None else 0, # sweep runs checkpoint so they can be resumed
+                  render_freq = 0,
+                  num_val_episodes = 50,
+                  log_scalars = True,
+                  gpu_growth = True)
+    
+    if async_eval: # validate in a separate process so training fps is unaffected 
+        evaluator = AsyncEvaluator(partial(ActorCritic, nature_cnn, input_size, action_size, build_optimiser=False),
+                                   val_env_fns, num_episodes=50, log_dir=train_log_dir + '/train')
+        a2c.attach_evaluator(evaluator)
 
     a2c.train()
 
@@ -168,5 +193,4 @@ if __name__ == "__main__":
     env_id_list = ['SpaceInvadersDeterministic-v4', 'FreewayDeterministic-v4', 'MontezumaRevengeDeterministic-v4', 'PongDeterministic-v4']
     #env_id_list = ['MontezumaRevengeDeterministic-v4']
     #env_id_list = ['MountainCar-v0', 'Acrobot-v1', 'CartPole-v1', ]
-    for env_id in env_id_list:
-        main(env_id)
+    main_or_sweep(main, env_id_list, 'sweeps/A2C', cores_per_run=8) # single run of the first env, --sweep for every env x seed
@@ -25,9 +25,8 @@ class A2C_LSTM(ActorCritic_LSTM):
         except TypeError:
             input_size = (input_shape,)
         
-        with tf.variable_scope('ActorCritic', reuse=tf.AUTO_REUSE): # due to fixed lstm reshape size, need to create two Actorcritic models for multi and single envs
+        with tf.variable_scope('ActorCritic', reuse=tf.AUTO_REUSE): # lstm batch size is taken from the fed hidden state, one policy serves training and validation
             self.train_policy = ActorCritic_LSTM(policy_model, input_shape, action_size, num_envs, cell_size, build_optimiser=False, **policy_args)
-            self.validate_policy = ActorCritic_LSTM(policy_model, input_shape, action_size, 1, cell_size, build_optimiser=False, **policy_args)
         
         self.loss = self.train_policy.loss
     
@@ -42,11 +41,11 @@ class A2C_LSTM(ActorCritic_LSTM):
         self.train_op = self.optimiser.apply_gradients(grads_vars)
 
     def forward(self, state, hidden, validate=False):
-        if validate:
-            return self.validate_policy.forward(state, hidden)
-        else :
-            return self.train_policy.forward(state, hidden)
+        return self.train_policy.forward(state, hidden)
     
+    def inference_tensors(self):
+        return self.train_policy.inference_tensors()
+
     def backprop(self, state, R, actions, hidden, dones):
         feed_dict = {self.train_policy.state:state, self.train_policy.actions:actions,
                      self.train_policy.R:R, self.train_policy.hidden_in[0]:hidden[0], self.train_policy.hidden_in[1]:hidden[1],
@@ -58,7 +57,6 @@ class A2C_LSTM(ActorCritic_LSTM):
     def set_session(self, sess):
         self.sess = sess
         self.train_policy.set_session(sess)
-        self.validate_policy.set_session(sess)
 
 
 class A2C_LSTM_Trainer(SyncMultiEnvTrainer):
@@ -83,9 +81,8 @@ class A2C_LSTM_Trainer(SyncMultiEnvTrainer):
         batch_size = (self.num_envs * self.nsteps)
         start = time.time()
         num_updates = self.total_steps // batch_size
-        s = 0
         # main loop
-        for t in range(1,num_updates+1):
+        for t in range(self.t,num_updates+1):
             states, actions, rewards, hidden_batch, dones, infos, values, last_values = self.runner.run()
             
             if self.return_type == 'nstep':
@@ -98,6 +95,7 @@ class A2C_LSTM_Trainer(SyncMultiEnvTrainer):
             # stack all states, actions and Rs across all workers into a single batch
             states, actions, R = fold_batch(states), fold_batch(actions), fold_batch(R)
             l = self.model.backprop(states, R, actions, hidden_batch[0], dones)
+            self.profile_update(t, t * batch_size)
 
             if self.render_freq > 0 and t % ((self.validate_freq // batch_size) * self.render_freq) == 0:
                 render = True
@@ -109,11 +107,24 @@ class A2C_LSTM_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir  + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
+            
+            self.t += 1
+    
     
+    def get_batch_actions(self, states, hidden):
+        policies, values, hidden = self.model.forward(states, hidden, validate=True)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, hidden
     
+    def init_validate_state(self, num_envs):
+        return self.model.get_initial_hidden(num_envs)
+    
+    def reset_validate_state(self, hidden, actions, rewards, dones):
+        return self.model.reset_batch_hidden(hidden, 1-dones)
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -149,17 +160,16 @@ class A2C_LSTM_Trainer(SyncMultiEnvTrainer):
             self.prev_hidden = self.model.get_initial_hidden(num_envs)
         
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 policies, values, hidden = self.model.forward(self.states, self.prev_hidden)
                 actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
                 next_states, rewards, dones, infos = self.env.step(actions)
-                rollout.append((self.states, actions, rewards, self.prev_hidden, dones, infos))
+                self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, hidden=self.prev_hidden, dones=dones, infos=infos)
                 self.states = next_states
                 
                 self.prev_hidden = self.model.reset_batch_hidden(hidden, 1-dones) # reset hidden state at end of episode
                 
-            states, actions, rewards, hidden_batch, dones, infos = stack_many(zip(*rollout))
+            states, actions, rewards, hidden_batch, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'hidden', 'dones', 'infos')
             _, last_values, _ = self.model.forward(next_states, self.prev_hidden)
             return states, actions, rewards, hidden_batch, dones, infos, values, last_values
             
@@ -173,7 +183,7 @@ def main(env_id):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(10)]
+        val_envs = BatchEnv(DummyEnv, env_id, 10, blocking=False)
         envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
 
     else:
@@ -185,11 +195,11 @@ def main(env_id):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=1, rescale=84, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=1, rescale=84, episodic=False, reset=reset, clip_reward=False)
         envs = BatchEnv(AtariEnv, env_id, num_envs, rescale=84, blocking=False , k=1, reset=reset, episodic=False, clip_reward=True)
     
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
 
     current_time = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
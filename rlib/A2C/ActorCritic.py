@@ -1,17 +1,18 @@
 import tensorflow as tf
 import numpy as np
-from rlib.networks.networks import mlp_layer, lstm, lstm_masked
+from rlib.networks.networks import mlp_layer, lstm, lstm_masked, scaled_gradients, observation_placeholder
 
 class ActorCritic(object):
-    def __init__(self, model, input_shape, action_size, entropy_coeff=0.01, value_coeff=0.5, lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, build_optimiser=True, **model_args):
+    def __init__(self, model, input_shape, action_size, entropy_coeff=0.01, value_coeff=0.5, lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, build_optimiser=True, loss_scale=1.0, **model_args):
         self.lr, self.lr_final = lr, lr_final
         self.entropy_coeff, self.value_coeff = entropy_coeff, value_coeff
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
+        self.loss_scale = loss_scale # static loss scale for float16 models e.g. model_args dtype=tf.float16, loss_scale=128
         self.sess = None
 
         with tf.variable_scope('encoder_network'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape])
+            self.state = observation_placeholder(input_shape)
             print('state shape', self.state.get_shape().as_list())
             self.dense = model(self.state, **model_args)
         
@@ -42,7 +43,7 @@ class ActorCritic(object):
             lr = tf.train.polynomial_decay(lr, global_step, decay_steps, end_learning_rate=lr_final, power=1.0, cycle=False, name=None)
             #optimiser = tf.train.RMSPropOptimizer(lr, decay=0.99, epsilon=1e-5)
             optimiser = tf.train.AdamOptimizer(lr)
-            grads = tf.gradients(self.loss, self.weights)
+            grads = scaled_gradients(self.loss, self.weights, loss_scale)
             grads, _ = tf.clip_by_global_norm(grads, grad_clip)
             grads_vars = list(zip(grads, self.weights))
             self.train_op = optimiser.apply_gradients(grads_vars, global_step=global_step)
@@ -56,6 +57,10 @@ class ActorCritic(object):
     def get_value(self, state):
         return self.sess.run(self.V, feed_dict = {self.state: state})
 
+    def inference_tensors(self):
+        # inputs and outputs of forward, see rlib.utils.InferencePolicy
+        return {'state':self.state}, {'policy':self.policy_distrib, 'value':self.V}
+
     def backprop(self, state, R, a):
         *_,l = self.sess.run([self.train_op, self.loss], feed_dict = {self.state : state, self.R : R, self.actions: a})
         return l
@@ -67,7 +72,7 @@ class ActorCritic(object):
 
 class ActorCritic_LSTM(object):
     def __init__(self, model, input_shape, action_size, num_envs, cell_size,
-                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, build_optimiser=False, model_args={}):
+                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, build_optimiser=False, fused_lstm=False, model_args={}):
         self.lr, self.lr_final = lr, lr_final
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
@@ -76,16 +81,14 @@ class ActorCritic_LSTM(object):
         self.sess = None
 
         with tf.variable_scope('input'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='time_batch_state') # [time*batch, *input_shape]
+            self.state = observation_placeholder(input_shape, name='time_batch_state') # [time*batch, *input_shape]
 
         with tf.variable_scope('encoder_network'):
             self.dense = model(self.state, **model_args)
-            dense_size = self.dense.get_shape()[1].value
-            unfolded_state = tf.reshape(self.dense, shape=[-1, num_envs, dense_size], name='unfolded_state')
         
         with tf.variable_scope('lstm'):
-            #self.lstm_output, self.hidden_in, self.hidden_out = lstm(unfolded_state, cell_size=cell_size, fold_output=True, time_major=True)
-            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(unfolded_state, cell_size=cell_size, batch_size=num_envs, fold_output=True, time_major=True)
+            # dense is unfolded to [time, batch, dense_size] with the batch size of hidden_in, so any number of envs can be fed
+            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(self.dense, cell_size=cell_size, fold_output=True, time_major=True, fused=fused_lstm)
 
         with tf.variable_scope('critic'):
             self.V = tf.reshape( mlp_layer(self.lstm_output, 1, name='state_value', activation=None), shape=[-1])
@@ -130,11 +133,16 @@ class ActorCritic_LSTM(object):
         return hidden * np.stack([idxs for i in range(self.cell_size)], axis=1)
 
     def forward(self, state, hidden):
-        mask = np.zeros((1, self.num_envs)) # state = [time*batch, ...]
+        mask = np.zeros((1, len(hidden[0]))) # state = [time*batch, ...]
         feed_dict = {self.state:state, self.hidden_in[0]:hidden[0], self.hidden_in[1]:hidden[1], self.mask:mask}
         policy, value, hidden = self.sess.run([self.policy_distrib, self.V, self.hidden_out], feed_dict = feed_dict)
         return policy, value, hidden
 
+    def inference_tensors(self):
+        inputs = {'state':self.state, 'cell_in':self.hidden_in[0], 'hidden_in':self.hidden_in[1], 'mask':self.mask}
+        outputs = {'policy':self.policy_distrib, 'value':self.V, 'cell_out':self.hidden_out[0], 'hidden_out':self.hidden_out[1]}
+        return inputs, outputs
+
     def backprop(self, state, R, a, hidden, dones):
         feed_dict = {self.state : state, self.R : R, self.actions: a, self.hidden_in[0]:hidden[0], self.hidden_in[1]:hidden[1], self.mask:dones}
         *_,l = self.sess.run([self.train_op, self.loss], feed_dict=feed_dict)
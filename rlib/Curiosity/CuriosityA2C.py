@@ -253,7 +253,6 @@ class Curiosity_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
 
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 start = time.time()
                 policies, values = self.model.forward(self.states)
@@ -265,10 +264,10 @@ class Curiosity_Trainer(SyncMultiEnvTrainer):
                 #print('intr_rewards', intr_rewards)
                 rewards = extr_rewards + intr_rewards
                 #print('rewards', rewards)
-                rollout.append((self.states, next_states, actions, rewards, values, dones))
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, rewards=rewards, values=values, dones=dones)
                 self.states = next_states
            
-            states, next_states, actions, rewards, values, dones = stack_many(zip(*rollout))
+            states, next_states, actions, rewards, values, dones = self.rollout.get('states', 'next_states', 'actions', 'rewards', 'values', 'dones')
             return states, next_states, actions, rewards, dones, values
             
 
@@ -307,7 +307,6 @@ class Curiosity_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
 
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 start = time.time()
                 policies, extr_values, intr_values = self.model.forward(self.states)
@@ -315,10 +314,12 @@ class Curiosity_Trainer(SyncMultiEnvTrainer):
                 next_states, extr_rewards, dones, infos = self.env.step(actions)
                 intr_rewards = self.model.intrinsic_reward(self.states, actions, next_states, self.state_mean, self.state_std)
                 #print('intr_rewards', self.model.intr_coeff * intr_rewards)
-                rollout.append((self.states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, np.array(infos)))
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards, intr_rewards=intr_rewards,
+                                    extr_values=extr_values, intr_values=intr_values, dones=dones, infos=infos)
                 self.states = next_states
             
-            states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos = stack_many(zip(*rollout))
+            states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos = \
+                self.rollout.get('states', 'next_states', 'actions', 'extr_rewards', 'intr_rewards', 'extr_values', 'intr_values', 'dones', 'infos')
             return states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos
             
 
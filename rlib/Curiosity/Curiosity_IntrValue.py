@@ -370,16 +370,17 @@ class RND_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
         
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 policies, values_extr, values_intr = self.model.forward(self.states)
                 actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
                 next_states, extr_rewards, dones, infos = self.env.step(actions)
-                rollout.append((self.states, next_states, actions, extr_rewards, values_extr, values_intr, policies, dones))
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards,
+                                    values_extr=values_extr, values_intr=values_intr, policies=policies, dones=dones)
                 self.states = next_states
 
-            states, next_states, actions, extr_rewards, values_extr, values_intr, policies, dones = stack_many(zip(*rollout))
-            intr_rewards = self.model.intrinsic_reward(fold_batch(states), fold_batch(actions), fold_batch(next_states), self.state_mean, self.state_std)
+            states, next_states, actions, extr_rewards, values_extr, values_intr, policies, dones = \
+                self.rollout.get('states', 'next_states', 'actions', 'extr_rewards', 'values_extr', 'values_intr', 'policies', 'dones')
+            intr_rewards = self.model.intrinsic_reward(*self.rollout.folded('states', 'actions', 'next_states'), self.state_mean, self.state_std)
             intr_rewards = unfold_batch(intr_rewards, self.num_steps, len(self.env))
             return states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones
     
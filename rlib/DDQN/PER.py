@@ -92,7 +92,7 @@ class DQN(object):
 
         with tf.variable_scope(name):
             with tf.variable_scope('encoder_network'):
-                self.state = tf.placeholder(tf.float32, shape=[None, *input_shape])
+                self.state = observation_placeholder(input_shape)
                 dense = model(self.state, **model_args)
     
             with tf.variable_scope("State_Action"):
@@ -8,6 +8,8 @@ from collections import OrderedDict
 from rlib.networks.networks import*
 from rlib.utils.VecEnv import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
+from rlib.utils.Sweep import main_or_sweep, latest_checkpoint
+from rlib.utils.RolloutStorage import RolloutStorage
 from rlib.utils.utils import one_hot, fold_batch, unfold_batch, log_uniform
 
 
@@ -22,8 +24,9 @@ def save_hyperparameters(filename, **kwargs):
 
 
 class DQN(object):
-    def __init__(self, model, input_shape, action_size, name, lr=0.00025, grad_clip = 0.5, decay_steps=50e6, lr_final=0, **model_args):
+    def __init__(self, model, input_shape, action_size, name, lr=0.00025, grad_clip = 0.5, decay_steps=50e6, lr_final=0, loss_scale=1.0, **model_args):
         self.lr = lr
+        self.loss_scale = loss_scale # static loss scale for float16 models e.g. model_args dtype=tf.float16, loss_scale=128
         self.lr_final = lr_final
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
@@ -38,7 +41,7 @@ class DQN(object):
 
         with tf.variable_scope(name):
             with tf.variable_scope('encoder_network'):
-                self.state = tf.placeholder(tf.float32, shape=[None, *input_shape])
+                self.state = observation_placeholder(input_shape)
                 self.dense = model(self.state, **model_args)
     
             with tf.variable_scope("State_Action"):
@@ -56,7 +59,7 @@ class DQN(object):
             optimiser = tf.train.AdamOptimizer(lr)
             
             self.weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
-            grads = tf.gradients(self.loss, self.weights)
+            grads = scaled_gradients(self.loss, self.weights, loss_scale)
             grads, _ = tf.clip_by_global_norm(grads, grad_clip)
             grads_vars = list(zip(grads, self.weights))
             self.train_op = optimiser.apply_gradients(grads_vars, global_step=global_step)
@@ -65,6 +68,10 @@ class DQN(object):
     def forward(self, state):
         return self.sess.run(self.Qsa, feed_dict = {self.state: state})
 
+    def inference_tensors(self):
+        # inputs and outputs of forward, see rlib.utils.InferencePolicy
+        return {'state':self.state}, {'Q':self.Qsa}
+
     def backprop(self, states, R, actions):
         _,l = self.sess.run([self.train_op,self.loss], feed_dict = {self.state:states, self.R:R, self.actions:actions})
         return l
@@ -121,15 +128,31 @@ class SyncDDQN(SyncMultiEnvTrainer):
         else:
             action = np.argmax(self.model.forward(state))
         return action
+    
+    def get_batch_actions(self, states, val_state):
+        actions = np.argmax(self.model.forward(states), axis=1)
+        explore = np.random.uniform(size=len(actions)) < self.epsilon_test
+        actions[explore] = np.random.randint(self.action_size, size=explore.sum())
+        return actions, val_state
 
     def update_target(self):
         self.sess.run(self.update_weights)
 
     
     def local_attr(self, attr):
-        attr['update_target_freq':self.target_freq]
+        attr['update_target_freq'] = self.target_freq
         return attr
     
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['epsilon'], state['epsilon_counter'] = self.epsilon.copy(), self.runner.schedule._counter
+        return state
+    
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.epsilon[:] = state['epsilon'] # in place as the runner and schedule share the epsilon array
+        self.runner.schedule._counter = state['epsilon_counter']
+    
     class Runner(object):
         def __init__(self, Q, TargetQ, epsilon, epsilon_schedule, env, num_envs, num_steps, action_size):
             self.Q = Q
@@ -140,10 +163,10 @@ class SyncDDQN(SyncMultiEnvTrainer):
             self.num_envs = num_envs
             self.num_steps = num_steps
             self.action_size = action_size
+            self.rollout = RolloutStorage(num_steps)
             self.states = self.env.reset()
         
         def run(self):
-            rollout = []
             for t in range(self.num_steps):
                 Qsa = self.Q.forward(self.states)
                 actions = np.argmax(Qsa, axis=1)
@@ -151,13 +174,12 @@ class SyncDDQN(SyncMultiEnvTrainer):
                 random_actions = np.random.randint(self.action_size, size=(self.num_envs))
                 actions = np.where(random < self.epsilon, random_actions, actions)
                 next_states, rewards, dones, infos = self.env.step(actions)
-                rollout.append((self.states, actions, rewards, dones, infos))
+                self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, dones=dones, infos=infos)
                 self.states = next_states
                 self.schedule.step()
                 #print('epsilon', self.epsilon)
             
-            states, actions, rewards, dones, infos = zip(*rollout)
-            states, actions, rewards, dones = np.stack(states), np.stack(actions), np.stack(rewards), np.stack(dones)
+            states, actions, rewards, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'dones', 'infos')
             TargetQsa = unfold_batch(self.TargetQ.forward(fold_batch(states)), self.num_steps, self.num_envs) # Q(s,a; theta-1)
             values = np.sum(TargetQsa * one_hot(actions, self.action_size), axis=-1) # Q(s, argmax_a Q(s,a; theta); theta-1)
             
@@ -189,24 +211,24 @@ def stackFireReset(env):
     return StackEnv(FireResetEnv(env))
 
 
-def main(env_id):
+def main(env_id, seed=None, run_dir=None):
 
     num_envs = 8
     nsteps = 128
 
-    time.sleep(np.random.uniform(1,30))
-
     current_time = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
     train_log_dir = 'logs/SyncDDQN/' + env_id + '/n-step/RMSprop/' + current_time
     model_dir = "models/SyncDDQN/" + env_id + '/' + current_time
+    if run_dir is not None: # launched by a Sweep, logs and checkpoints are kept in the run's directory
+        train_log_dir, model_dir = run_dir + '/logs', run_dir + '/models'
 
     env = gym.make(env_id)
     
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(16)]
-        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
+        val_envs = BatchEnv(DummyEnv, env_id, 16, blocking=False)
+        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False, seed=seed)
 
     else:
         print('Atari')
@@ -217,11 +239,11 @@ def main(env_id):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
-        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False , k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500)
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, episodic=False, reset=reset, clip_reward=False)
+        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False , k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500, seed=seed)
 
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
 
     env.close()
     print('action space', action_size)
@@ -232,29 +254,33 @@ def main(env_id):
 
     
 
-    DDQN = SyncDDQN(envs=envs,
-                    model=Q,
-                    target_model=TargetQ,
-                    model_dir = model_dir,
-                    log_dir = train_log_dir,
-                    val_envs=val_envs,
-                    action_size=action_size,
-                    train_mode='nstep',
-                    return_type='lambda',
-                    total_steps=50e6,
-                    nsteps=nsteps,
-                    gamma=0.99,
-                    lambda_=0.95,
-                    save_freq=0,
-                    render_freq=0,
-                    validate_freq=1e6,
-                    num_val_episodes=50,
-                    update_target_freq=1024,
-                    epsilon_start=1,
-                    epsilon_final=0.01,
-                    epsilon_steps=2e6,
-                    epsilon_test=0.01,
-                    log_scalars=True)
+    checkpoint = latest_checkpoint(model_dir) if run_dir is not None else None
+    if checkpoint is not None: # resume an unfinished sweep run
+        DDQN = SyncDDQN.load(SyncDDQN, Q, checkpoint[0], envs, val_envs, checkpoint[1], target_model=TargetQ, action_size=action_size)
+    else:
+        DDQN = SyncDDQN(envs=envs,
+                        model=Q,
+                        target_model=TargetQ,
+                        model_dir = model_dir,
+                        log_dir = train_log_dir,
+                        val_envs=val_envs,
+                        action_size=action_size,
+                        train_mode='nstep',
+                        return_type='lambda',
+                        total_steps=50e6,
+                        nsteps=nsteps,
+                        gamma=0.99,
+                        lambda_=0.95,
+                        save_freq=1e6 if run_dir is not None else 0, # sweep runs checkpoint so they can be resumed
+                        render_freq=0,
+                        validate_freq=1e6,
+                        num_val_episodes=50,
+                        update_target_freq=1024,
+                        epsilon_start=1,
+                        epsilon_final=0.01,
+                        epsilon_steps=2e6,
+                        epsilon_test=0.01,
+                        log_scalars=True)
     
     DDQN.train()
     del DDQN
@@ -264,6 +290,5 @@ if __name__ == "__main__":
     env_id_list = [ 'SpaceInvadersDeterministic-v4', 'FreewayDeterministic-v4','MontezumaRevengeDeterministic-v4', ]
     #env_id_list = ['MontezumaRevengeDeterministic-v4']
     #env_id_list = ['MountainCar-v0', 'CartPole-v1', 'Acrobot-v1', ]
-    for env_id in env_id_list:
-        main(env_id)
+    main_or_sweep(main, env_id_list, 'sweeps/SyncDDQN', cores_per_run=4) # single run of the first env, --sweep for every env x seed
    # 
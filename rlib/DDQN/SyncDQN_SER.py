@@ -135,7 +135,7 @@ class SyncDDQN(SyncMultiEnvTrainer):
 
     
     def local_attr(self, attr):
-        attr['update_target_freq':self.target_freq]
+        attr['update_target_freq'] = self.target_freq
         return attr
     
     class Runner(object):
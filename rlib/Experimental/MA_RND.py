@@ -9,6 +9,7 @@ from rlib.networks.networks import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
 from rlib.utils.VecEnv import*
 from rlib.utils.utils import fold_batch, one_hot, rolling_stats, stack_many, RunningMeanStd
+from rlib.utils.RolloutStorage import MinibatchSampler
 
 os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
 
@@ -284,6 +285,7 @@ class MA_RND_Trainer(SyncMultiEnvTrainer):
         self.pred_prob = 1 / (self.num_envs / 32.0)
         self.lambda_ = 0.95
         self.num_epochs, self.num_minibatches = num_epochs, num_minibatches
+        self.minibatches = MinibatchSampler(num_minibatches)
         hyper_paras = {'learning_rate':model.lr, 'learning_rate_final':model.lr_final, 'lr_decay_steps':model.decay_steps,
          'grad_clip':model.grad_clip, 'nsteps':self.nsteps, 'num_workers':self.num_envs, 'total_steps':self.total_steps,
           'entropy_coefficient':0.001, 'value_coefficient':0.5, 'intr_coeff':model.intr_coeff,
@@ -383,21 +385,14 @@ class MA_RND_Trainer(SyncMultiEnvTrainer):
 
             # perform minibatch gradient descent for K epochs 
             l = 0
-            idxs = np.arange(len(states))
-            for epoch in range(self.num_epochs):
-                batch_size = self.nsteps//self.num_minibatches
-                np.random.shuffle(idxs)
-                for batch in range(0,len(states),batch_size):
-                    batch_idxs = idxs[batch:batch+batch_size]
-                    # stack all states, next_states, actions and Rs across all workers into a single batch
-                    mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = fold_batch(states[batch_idxs]), fold_batch(next_states[batch_idxs]), \
-                                                    fold_batch(actions[batch_idxs]), fold_batch(R_extr[batch_idxs]), fold_batch(R_intr[batch_idxs]), \
-                                                    fold_batch(total_Adv[batch_idxs]), fold_batch(old_policies[batch_idxs])
-                
-                    mb_nextstates = mb_nextstates[np.where(np.random.uniform(size=(batch_size)) < self.pred_prob)][:,:,:,-1:]
-                    #mb_nextstates = (mb_nextstates  - self.runner.state_mean[np.newaxis,:,:,np.newaxis]) / self.runner.state_std[np.newaxis,:,:,np.newaxis]
-                    mean, std = self.runner.state_mean, self.runner.state_std
-                    l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, self.alpha, mean, std)
+            for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                # gather the minibatch across all workers into a single batch
+                mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = \
+                    self.minibatches.gather(batch_idxs, states, next_states[...,-1:], actions, R_extr, R_intr, total_Adv, old_policies)
+                mb_nextstates = mb_nextstates[np.random.uniform(size=(len(mb_nextstates))) < self.pred_prob]
+                #mb_nextstates = (mb_nextstates  - self.runner.state_mean[np.newaxis,:,:,np.newaxis]) / self.runner.state_std[np.newaxis,:,:,np.newaxis]
+                mean, std = self.runner.state_mean, self.runner.state_std
+                l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, self.alpha, mean, std)
             
             l /= (self.num_epochs * self.num_minibatches)
 
@@ -434,14 +429,11 @@ class MA_RND_Trainer(SyncMultiEnvTrainer):
             R_intr = Adv_intr + values_intr
             total_Adv = self.model.extr_coeff * Adv_extr + self.model.intr_coeff * Adv_intr
 
-            for batch in range(0,len(obs),batch_size):
-                batch_idxs = idxs[batch:batch+batch_size]
-                # stack all states, next_states, actions and Rs across all workers into a single batch
-                mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = fold_batch(obs[batch_idxs]), fold_batch(next_obs[batch_idxs]), \
-                                                fold_batch(actions[batch_idxs]), fold_batch(R_extr[batch_idxs]), fold_batch(R_intr[batch_idxs]), \
-                                                fold_batch(total_Adv[batch_idxs]), fold_batch(old_policies[batch_idxs])
-            
-                mb_nextstates = mb_nextstates[np.where(np.random.uniform(size=(batch_size)) < self.pred_prob)][...,-1:]
+            for batch_idxs in self.minibatches.shuffle(len(obs)):
+                # gather the minibatch across all workers into a single batch
+                mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = \
+                    self.minibatches.gather(batch_idxs, obs, next_obs[...,-1:], actions, R_extr, R_intr, total_Adv, old_policies)
+                mb_nextstates = mb_nextstates[np.random.uniform(size=(len(mb_nextstates))) < self.pred_prob]
                 #mb_nextstates = (mb_nextstates  - self.runner.state_mean[np.newaxis,:,:,np.newaxis]) / self.runner.state_std[np.newaxis,:,:,np.newaxis]
                 mean, std = self.runner.state_mean, self.runner.state_std
                 l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, self.alpha, mean, std)
@@ -7,20 +7,37 @@ from rlib.networks.networks import *
 from rlib.utils.VecEnv import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
 from rlib.utils.utils import fold_batch
+from rlib.utils.RolloutDataset import RolloutDataset
+from rlib.utils.StagedFeed import StagedFeed
+from rlib.utils.RolloutStorage import MinibatchSampler
+from rlib.utils.Sweep import main_or_sweep, latest_checkpoint
 
 #os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
 
 class PPO(object):
-    def __init__(self, model, input_shape, action_size, lr=1e-3, lr_final=0, decay_steps=6e5, grad_clip=0.5, value_coeff=1.0, entropy_coeff=0.01, name='PPO', **model_args):
+    def __init__(self, model, input_shape, action_size, lr=1e-3, lr_final=0, decay_steps=6e5, grad_clip=0.5, value_coeff=1.0, entropy_coeff=0.01, name='PPO', in_graph_minibatches=False, staged_feeding=False, loss_scale=1.0, **model_args):
         self.lr, self.lr_final = lr, lr_final
         self.value_coeff, self.entropy_coeff = value_coeff, entropy_coeff
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
+        self.loss_scale = loss_scale # static loss scale for float16 models e.g. model_args dtype=tf.float16, loss_scale=128
         self.policy_clip = 0.1
         self.sess = None
+        self.rollout, self.staged = None, None
+        if in_graph_minibatches and staged_feeding:
+            raise ValueError('in_graph_minibatches and staged_feeding are alternative input pipelines, choose one')
         with tf.variable_scope(name):
+            fields = {'state':(observation_dtype(input_shape), input_shape), 'R':(tf.float32, ()), 'Adv':(tf.float32, ()),
+                      'actions':(tf.int32, ()), 'old_policy':(tf.float32, (action_size,))}
+            if in_graph_minibatches: # training inputs default to minibatches gathered in-graph, see backprop_epochs
+                self.rollout = inputs = RolloutDataset(fields)
+            elif staged_feeding: # inputs default to batches staged ahead of the step, see backprop_staged and forward_staged
+                self.staged = inputs = StagedFeed(fields)
+            else:
+                inputs = None
+            
             with tf.variable_scope('encoder_network'):
-                self.state = tf.placeholder(tf.float32, shape=[None, *input_shape])
+                self.state = inputs.default('state') if inputs is not None else observation_placeholder(input_shape)
                 print('state shape', self.state.get_shape().as_list())
                 self.dense = model(self.state, **model_args)
             
@@ -29,19 +46,19 @@ class PPO(object):
             
             with tf.variable_scope("actor"):
                 self.policy = mlp_layer(self.dense, action_size, activation=tf.nn.softmax, name='policy_distribution') + 1e-10
-                self.actions = tf.placeholder(tf.int32, [None])
+                self.actions = inputs.default('actions') if inputs is not None else tf.placeholder(tf.int32, [None])
                 actions_onehot = tf.one_hot(self.actions,action_size)
                 
             with tf.variable_scope('losses'):
-                self.old_policy = tf.placeholder(dtype=tf.float32, shape=[None, action_size], name='old_policies')
+                self.old_policy = inputs.default('old_policy', name='old_policies') if inputs is not None else tf.placeholder(dtype=tf.float32, shape=[None, action_size], name='old_policies')
                 self.alpha = tf.placeholder(dtype=tf.float32, shape=[], name='alpha')
-                self.R = tf.placeholder(dtype=tf.float32, shape=[None])
+                self.R = inputs.default('R') if inputs is not None else tf.placeholder(dtype=tf.float32, shape=[None])
                 value_loss = 0.5 * tf.reduce_mean(tf.square(self.R - self.V))
 
                 policy = tf.reduce_sum(tf.multiply(self.policy, actions_onehot), axis=1)
                 old_policy = tf.reduce_sum(tf.multiply(self.old_policy, actions_onehot), axis=1)
                 
-                self.Advantage = tf.placeholder(dtype=tf.float32, shape=[None], name='Adv')
+                self.Advantage = inputs.default('Adv', name='Adv') if inputs is not None else tf.placeholder(dtype=tf.float32, shape=[None], name='Adv')
 
                 ratio = policy / old_policy
 
@@ -63,7 +80,7 @@ class PPO(object):
             optimiser = tf.train.RMSPropOptimizer(lr, decay=0.9, epsilon=1e-5)
 
             self.weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=tf.get_variable_scope().name)
-            grads = tf.gradients(self.loss, self.weights)
+            grads = scaled_gradients(self.loss, self.weights, loss_scale)
             grads, _ = tf.clip_by_global_norm(grads, grad_clip)
             grads_vars = list(zip(grads, self.weights))
             self.optimiser = optimiser.apply_gradients(grads_vars)
@@ -77,12 +94,38 @@ class PPO(object):
     def get_value(self, state):
         return self.sess.run(self.V, feed_dict = {self.state: state})
 
+    def inference_tensors(self):
+        # inputs and outputs of forward, see rlib.utils.InferencePolicy
+        return {'state':self.state}, {'policy':self.policy, 'value':self.V}
+
     def backprop(self, state, R, Adv, a, old_policy, alpha):
         feed_dict = {self.state : state, self.R:R, self.Advantage:Adv, self.actions:a,
                      self.old_policy:old_policy, self.alpha:alpha}
         *_,l = self.sess.run([self.optimiser, self.loss], feed_dict=feed_dict)
         return l
     
+    def backprop_epochs(self, state, R, Adv, a, old_policy, alpha, num_epochs, num_minibatches):
+        # upload the folded rollout once then run every epoch's shuffled minibatches in-graph, only alpha is fed per step
+        num_batches = self.rollout.upload(self.sess, num_epochs, num_minibatches, state=state, R=R, Adv=Adv, actions=a, old_policy=old_policy)
+        l = 0
+        for i in range(num_batches):
+            *_,loss = self.sess.run([self.optimiser, self.loss], feed_dict={self.alpha:alpha})
+            l += loss
+        return l / num_batches
+
+    def backprop_staged(self, minibatches, alpha):
+        # minibatches of (state, R, Adv, a, old_policy), each update trains on a staged minibatch while the next is put
+        batches = ({'state':state, 'R':R, 'Adv':Adv, 'actions':a, 'old_policy':old_policy} for state, R, Adv, a, old_policy in minibatches)
+        losses = [loss for _, loss in self.staged.iterate(self.sess, [self.optimiser, self.loss], batches, feed_dict={self.alpha:alpha})]
+        return sum(losses)
+
+    def stage_forward(self, state):
+        # put the states of the next forward_staged, copied from a background thread while the runner carries on
+        self.staged.stage_async(self.sess, state=state)
+
+    def forward_staged(self):
+        return self.staged.run(self.sess, [self.policy, self.V])
+    
     def set_session(self, sess):
         self.sess = sess
 
@@ -103,6 +146,8 @@ class PPO_Trainer(SyncMultiEnvTrainer):
         self.alpha = 1
         self.lambda_ = 0.95
         self.num_epochs, self.num_minibatches = num_epochs, num_minibatches
+        # staged minibatches are read a step after they are gathered so gathers alternate between two sets of buffers
+        self.minibatches = MinibatchSampler(num_minibatches, num_buffers=2 if model.staged is not None else 1)
 
         hyper_paras = {'learning_rate':model.lr, 'learning_rate_final':model.lr_final, 'lr_decay_steps':model.decay_steps,
             'grad_clip':model.grad_clip, 'nsteps':self.nsteps, 'num_workers':self.num_envs, 'total_steps':self.total_steps,
@@ -118,28 +163,36 @@ class PPO_Trainer(SyncMultiEnvTrainer):
         batch_size = self.num_envs * self.nsteps
         num_updates = self.total_steps // batch_size
         alpha_step = 1/num_updates
-        s = 0
-        mini_batch_size = self.nsteps//self.num_minibatches
         start = time.time()
         # main loop
-        for t in range(1,num_updates+1):
+        for t in range(self.t,num_updates+1):
             states, actions, rewards, values, last_values, old_policies, dones, infos = self.runner.run()
-            Adv = self.GAE(rewards, values, last_values, dones, gamma=0.99, lambda_=self.lambda_)
-            R = Adv + values
-            l = 0
-            idxs = np.arange(len(states))
-            for epoch in range(self.num_epochs):
-                np.random.shuffle(idxs)
-                for batch in range(0,len(states), mini_batch_size):
-                    batch_idxs = idxs[batch:batch + mini_batch_size]
-                    # stack all states, actions and Rs across all workers into a single batch
-                    mb_states, mb_actions, mb_R, mb_Adv, mb_old_policies = fold_batch(states[batch_idxs]), \
-                                                    fold_batch(actions[batch_idxs]), fold_batch(R[batch_idxs]), \
-                                                    fold_batch(Adv[batch_idxs]), fold_batch(old_policies[batch_idxs])
+            with self.timer.phase('returns'):
+                Adv = self.GAE(rewards, values, last_values, dones, gamma=0.99, lambda_=self.lambda_)
+                R = Adv + values
+            if self.model.rollout is not None:
+                # rollout uploaded once, minibatches of individual samples are shuffled and gathered in-graph
+                with self.timer.phase('backprop'):
+                    l = self.model.backprop_epochs(fold_batch(states), fold_batch(R), fold_batch(Adv), fold_batch(actions), fold_batch(old_policies),
+                                                   self.alpha, self.num_epochs, self.num_minibatches)
+            elif self.model.staged is not None:
+                # minibatches gathered on the host are staged one step ahead so each copy overlaps the previous update
+                with self.timer.phase('backprop'):
+                    minibatches = (self.minibatches.gather(batch_idxs, states, R, Adv, actions, old_policies)
+                                   for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs))
+                    l = self.model.backprop_staged(minibatches, self.alpha) / (self.num_epochs*self.num_minibatches)
+            else:
+                l = 0
+                for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                    # gather the minibatch across all workers into a single batch
+                    with self.timer.phase('minibatch'):
+                        mb_states, mb_actions, mb_R, mb_Adv, mb_old_policies = self.minibatches.gather(batch_idxs, states, actions, R, Adv, old_policies)
                     
-                    l += self.model.backprop(mb_states, mb_R, mb_Adv, mb_actions, mb_old_policies, self.alpha)
-            
-            l /= (self.num_epochs*self.num_minibatches)
+                    with self.timer.phase('backprop'):
+                        l += self.model.backprop(mb_states, mb_R, mb_Adv, mb_actions, mb_old_policies, self.alpha)
+                
+                l /= (self.num_epochs*self.num_minibatches)
+            self.profile_update(t, t * batch_size)
            
             #self.alpha -= alpha_step
             
@@ -153,38 +206,51 @@ class PPO_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir + '/' + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
             
+            self.t += 1
+            
     
     def get_action(self, state):
         policy, value = self.model.forward(state)
         action = int(np.random.choice(policy.shape[1], p=policy[0]))
         return action
 
+    def get_batch_actions(self, states, val_state):
+        policies, values = self.model.forward(states)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, val_state
+
     class Runner(SyncMultiEnvTrainer.Runner):
         def __init__(self, model, env, num_steps):
             super().__init__(model, env, num_steps)
         
         def run(self,):
-            rollout = []
+            staged = getattr(self.model, 'staged', None) is not None # next states are staged while each step is stored
             for t in range(self.num_steps):
-                policies, values = self.model.forward(self.states)
-                actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
-                next_states, rewards, dones, infos = self.env.step(actions)
-                rollout.append((self.states, actions, rewards, values, policies, dones, infos))
+                with self.timer.phase('forward'):
+                    policies, values = self.model.forward_staged() if staged and t > 0 else self.model.forward(self.states)
+                with self.timer.phase('sample'):
+                    actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+                with self.timer.phase('env_step'):
+                    next_states, rewards, dones, infos = self.env.step(actions)
+                if staged:
+                    self.model.stage_forward(next_states)
+                with self.timer.phase('store'):
+                    self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, values=values, policies=policies, dones=dones, infos=infos)
                 self.states = next_states
 
-            states, actions, rewards, values, policies, dones, infos = zip(*rollout)
-            states, actions, rewards, values, policies, dones = np.stack(states), np.stack(actions), np.stack(rewards), np.stack(values), np.stack(policies), np.stack(dones)
-            policy, last_values, = self.model.forward(next_states)
+            states, actions, rewards, values, policies, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'values', 'policies', 'dones', 'infos')
+            with self.timer.phase('forward'):
+                policy, last_values, = self.model.forward_staged() if staged else self.model.forward(next_states)
             return states, actions, rewards, values, last_values, policies, dones, infos   
     
     
 
 
-def main(env_id, Atari=True):
+def main(env_id, Atari=True, seed=None, run_dir=None):
     num_envs = 32
     nsteps = 512
 
@@ -196,8 +262,8 @@ def main(env_id, Atari=True):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(16)]
-        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
+        val_envs = BatchEnv(DummyEnv, env_id, 16, blocking=False)
+        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False, seed=seed)
 
     else:
         print('Atari')
@@ -208,19 +274,21 @@ def main(env_id, Atari=True):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, rescale=84, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
-        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, rescale=84, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500)
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, rescale=84, episodic=False, reset=reset, clip_reward=False)
+        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, rescale=84, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500, seed=seed)
         
     
     env.close()
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     
 
     current_time = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
     train_log_dir = 'logs/PPO/' + env_id + '/RMSprop/' + current_time
     model_dir = "models/PPO/" + env_id + '/' + current_time
+    if run_dir is not None: # launched by a Sweep, logs and checkpoints are kept in the run's directory
+        train_log_dir, model_dir = run_dir + '/logs', run_dir + '/models'
     
 
     ac_cnn_args = {'conv1_size':32, 'conv2_size':64, 'conv3_size':64, 'dense_size':512}
@@ -243,26 +311,31 @@ def main(env_id, Atari=True):
                 grad_clip=0.5,
                 value_coeff=0.5,
                 entropy_coeff=1.0,
-                name='Policy')
+                name='Policy',
+                in_graph_minibatches=True)
                  #'activation':tf.nn.leaky_relu
     
 
-    curiosity = PPO_Trainer(envs = envs,
-                            model = model,
-                            model_dir = model_dir,
-                            log_dir = train_log_dir,
-                            val_envs = val_envs,
-                            train_mode = 'nstep',
-                            total_steps = 2e6,
-                            nsteps = nsteps,
-                            num_epochs=4,
-                            num_minibatches=8,
-                            validate_freq = 4e4,
-                            save_freq = 0,
-                            render_freq = 0,
-                            num_val_episodes = 50,
-                            log_scalars=False,
-                            gpu_growth=False)
+    checkpoint = latest_checkpoint(model_dir) if run_dir is not None else None
+    if checkpoint is not None: # resume an unfinished sweep run
+        curiosity = PPO_Trainer.load(PPO_Trainer, model, checkpoint[0], envs, val_envs, checkpoint[1], log_scalars=False, allow_gpu_growth=False)
+    else:
+        curiosity = PPO_Trainer(envs = envs,
+                                model = model,
+                                model_dir = model_dir,
+                                log_dir = train_log_dir,
+                                val_envs = val_envs,
+                                train_mode = 'nstep',
+                                total_steps = 2e6,
+                                nsteps = nsteps,
+                                num_epochs=4,
+                                num_minibatches=8,
+                                validate_freq = 4e4,
+                                save_freq = 4e5 if run_dir is not None else 0, # sweep runs checkpoint so they can be resumed
+                                render_freq = 0,
+                                num_val_episodes = 50,
+                                log_scalars=False,
+                                gpu_growth=False)
     curiosity.train()
     
     del curiosity
@@ -273,7 +346,5 @@ def main(env_id, Atari=True):
 if __name__ == "__main__":
     env_id_list = ['FreewayDeterministic-v4']# 'SpaceInvadersDeterministic-v4',]# , ]
     env_id_list = ['MountainCar-v0', 'Acrobot-v1', 'CartPole-v1', ]
-    for i in range(5):
-        for env_id in env_id_list:
-            main(env_id)
+    main_or_sweep(main, env_id_list, 'sweeps/PPO', cores_per_run=4) # single run of the first env, --sweep for every env x seed
             
\ No newline at end of file
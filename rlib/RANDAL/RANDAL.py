@@ -4,12 +4,14 @@ import scipy
 import gym
 import os, time, datetime
 import threading
+import copy
 from rlib.networks.networks import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
 from rlib.utils.VecEnv import*
 from rlib.utils.utils import fold_batch, one_hot, Welfords_algorithm, stack_many, RunningMeanStd
 
 from rlib.RND.RND import PPO, predictor_cnn, predictor_mlp, rolling_obs, RewardForwardFilter
+from rlib.utils.RolloutStorage import MinibatchSampler
 
 
 
@@ -38,10 +40,10 @@ class RANDAL(object):
             next_state_shape = input_shape[:-1] + (1,)
         else: 
             next_state_shape = input_shape
-        self.next_state = tf.placeholder(tf.float32, shape=[None, *next_state_shape], name='next_state')
+        self.next_state = observation_placeholder(next_state_shape, name='next_state')
         self.state_mean = tf.placeholder(tf.float32, shape=[*next_state_shape], name="mean")
         self.state_std = tf.placeholder(tf.float32, shape=[*next_state_shape], name="std")
-        norm_next_state = tf.clip_by_value((self.next_state - self.state_mean) / self.state_std, -5, 5)
+        norm_next_state = tf.clip_by_value((tf.cast(self.next_state, tf.float32) - self.state_mean) / self.state_std, -5, 5)
 
         with tf.variable_scope('target_model'):
             target_state = target_model(norm_next_state, trainable=False)
@@ -65,7 +67,7 @@ class RANDAL(object):
             replay_loss = 0.5 * tf.reduce_mean(tf.square(self.replay_policy.R_extr - self.replay_policy.Ve))
 
 
-        self.reward_state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='reward_state')
+        self.reward_state = observation_placeholder(input_shape, name='reward_state')
         with tf.variable_scope('Policy/encoder_network', reuse=True):
             reward_enc = policy_model(self.reward_state)
 
@@ -78,6 +80,13 @@ class RANDAL(object):
             #reward_loss = 0.5 * tf.reduce_mean(tf.square(self.reward_target - pred_reward)) #mse
             reward_loss = tf.reduce_mean(tf.losses.softmax_cross_entropy(logits=pred_reward, onehot_labels=self.reward_target))  # cross entropy over caterogical reward 
             print('reward loss ', reward_loss)
+        
+        with tf.variable_scope('reward_model', reuse=True): # reward prediction of each state from the replay encoder, for fetch
+            replay_pred_reward = mlp_layer(mlp_layer(self.replay_policy.dense, 128, activation=tf.nn.relu, name='reward_hidden'), 3, activation=None, name='pred_reward')
+
+        # every head built on the replay_policy encoder, any combination is computed in one encoder pass by fetch
+        self.heads = {'policy':self.replay_policy.policy_distrib, 'extr_value':self.replay_policy.Ve, 'intr_value':self.replay_policy.Vi,
+                      'pixel_control':self.Qaux, 'reward':tf.nn.softmax(replay_pred_reward)}
 
         self.loss = self.policy.loss + feat_loss + reward_loss 
         if pixel_control:
@@ -113,9 +122,12 @@ class RANDAL(object):
     def forward(self, state):
         return self.policy.forward(state)
     
+    def fetch(self, heads, state):
+        ''' any combination of self.heads from a single encoder pass and sess.run e.g. extr_values, Qaux = model.fetch(['extr_value', 'pixel_control'], state) '''
+        return self.sess.run([self.heads[head] for head in heads], feed_dict={self.replay_policy.state:state})
+    
     def get_pixel_control(self, state):
-        feed_dict = {self.replay_policy.state:state}
-        return self.sess.run(self.Qaux, feed_dict=feed_dict)
+        return self.fetch(['pixel_control'], state)[0]
     
     def intrinsic_reward(self, next_state, state_mean, state_std):
         feed_dict={self.next_state:next_state, self.state_mean:state_mean, self.state_std:state_std}
@@ -155,12 +167,18 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
         self.replay = deque([], maxlen=2000)
 
         self.runner = self.Runner(self.model, self.env, self.nsteps, self.replay)
+        obs = self.runner.states[0]
+        obs = obs[...,-1:] if len(obs.shape) == 3 else obs
+        self.state_rolling = rolling_obs(shape=obs.shape)
+        self.reward_rolling = RunningMeanStd(shape=())
+        self.forward_filter = RewardForwardFilter(0.99)
         self.alpha = 1
         self.pred_prob = 1 / (self.num_envs / 32.0)
         self.lambda_ = 0.95
         self.init_obs_steps = init_obs_steps
         self.state_min, self.state_max = 0, 0 
         self.num_epochs, self.num_minibatches = num_epochs, num_minibatches
+        self.minibatches = MinibatchSampler(num_minibatches)
         self.normalise_obs = True
         hyper_paras = {'learning_rate':model.lr,
          'grad_clip':model.grad_clip, 'nsteps':self.nsteps, 'num_workers':self.num_envs, 'total_steps':self.total_steps,
@@ -171,6 +189,11 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
             filename = log_dir + '/hyperparameters.txt'
             self.save_hyperparameters(filename, **hyper_paras)
     
+    def get_batch_actions(self, states, val_state):
+        policies, values_extr, values_intr = self.model.forward(states)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, val_state
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -199,6 +222,23 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
             with self.lock:
                 env.close()
     
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        # copied as checkpoints may be written from a background thread while training updates the normalisers
+        state.update(copy.deepcopy({'state_rolling':self.state_rolling, 'reward_rolling':self.reward_rolling, 'forward_filter':self.forward_filter,
+                      'state_mean':self.runner.state_mean, 'state_std':self.runner.state_std,
+                      'state_min':self.state_min, 'state_max':self.state_max}))
+        state['replay'] = list(self.replay)
+        return state
+    
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.state_rolling, self.reward_rolling, self.forward_filter = state['state_rolling'], state['reward_rolling'], state['forward_filter']
+        self.runner.state_mean, self.runner.state_std = state['state_mean'], state['state_std']
+        self.state_min, self.state_max = state['state_min'], state['state_max']
+        self.replay.clear()
+        self.replay.extend(state['replay']) # runner shares the same deque
+
     def populate_memory(self):
         for t in range(2000//self.nsteps):
             states, *_ = self.runner.run()
@@ -259,12 +299,14 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
         #print('replay_hiddens dones shape', replay_dones.shape)
         
         next_state = self.replay[sample_start+self.nsteps][0] # get state 
-        _, replay_extr_last_values, replay_intr_last_values = self.model.forward(next_state)
+        if self.model.pixel_control: # bootstrap value and pixel control from one encoder pass
+            replay_extr_last_values, Qaux_value = self.model.fetch(['extr_value', 'pixel_control'], next_state)
+        else:
+            replay_extr_last_values, = self.model.fetch(['extr_value'], next_state)
         replay_R = self.GAE(replay_rewards, replay_extr_values, replay_extr_last_values, replay_dones, gamma=0.99, lambda_=0.95) + replay_extr_values
 
         if self.model.pixel_control:
             prev_states = self.replay[sample_start-1][0]
-            Qaux_value = self.model.get_pixel_control(next_state)
             pixel_rewards = self.pixel_rewards(prev_states, replay_states)
             
             Qaux_target = self.auxiliary_target(pixel_rewards, np.max(Qaux_value, axis=-1), replay_dones)
@@ -296,7 +338,7 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
         return reward_states[np.newaxis], reward
     
     def init_state_obs(self, num_steps):
-        states = 0
+        states = 0.0 # float accumulator, summing uint8 frames in place would wrap
         for i in range(1, num_steps+1):
             rand_actions = np.random.randint(0, self.model.action_size, size=self.num_envs)
             next_states, rewards, dones, infos = self.env.step(rand_actions)
@@ -308,15 +350,11 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
     def _train_nstep(self):
         batch_size = self.num_envs * self.nsteps
         num_updates = self.total_steps // batch_size
-        s = 0
-        rolling = RunningMeanStd(shape=())
-        obs = self.runner.states[0]
-        obs = obs[...,-1:] if len(obs.shape) == 3 else obs
-        self.state_rolling = rolling_obs(shape=obs.shape)
-        self.init_state_obs(self.init_obs_steps)
-        self.populate_memory()
-        self.runner.states = self.env.reset()
-        forward_filter = RewardForwardFilter(0.99)
+        if not self.warmed_up: # observation normalisation warm up and replay filling, skipped when resuming with a restored .state file
+            self.init_state_obs(self.init_obs_steps)
+            self.populate_memory()
+            self.runner.states = self.env.reset()
+            self.warmed_up = True
 
         # main loop
         start = time.time()
@@ -326,8 +364,8 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
 
             self.runner.state_mean, self.runner.state_std = self.state_rolling.update(next_states) # update state normalisation statistics 
 
-            int_rff = np.array([forward_filter.update(intr_rewards[i]) for i in range(len(intr_rewards))])
-            R_intr_mean, R_intr_std = rolling.update(int_rff.ravel()) 
+            int_rff = np.array([self.forward_filter.update(intr_rewards[i]) for i in range(len(intr_rewards))])
+            R_intr_mean, R_intr_std = self.reward_rolling.update(int_rff.ravel()) 
             intr_rewards /= R_intr_std # normalise intr reward
 
             reward_states, sample_rewards = self.sample_reward()
@@ -341,28 +379,21 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
 
             # perform minibatch gradient descent for K epochs 
             l = 0
-            idxs = np.arange(len(states))
-            for epoch in range(self.num_epochs):
-                mini_batch_size = self.nsteps//self.num_minibatches
-                np.random.shuffle(idxs)
-                for batch in range(0,len(states), mini_batch_size):
-                    batch_idxs = idxs[batch:batch + mini_batch_size]
-                    # stack all states, next_states, actions and Rs across all workers into a single batch
-                    mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = fold_batch(states[batch_idxs]), fold_batch(next_states[batch_idxs]), \
-                                                    fold_batch(actions[batch_idxs]), fold_batch(R_extr[batch_idxs]), fold_batch(R_intr[batch_idxs]), \
-                                                    fold_batch(total_Adv[batch_idxs]), fold_batch(old_policies[batch_idxs])
-                    
-                    mb_replay_states, mb_replay_actions, mb_replay_Rextr, mb_Qaux_target, mb_replay_dones = fold_batch(replay_states[batch_idxs]), fold_batch(replay_actions[batch_idxs]), \
-                                                                                           fold_batch(replay_Rextr[batch_idxs]), fold_batch(Qaux_target[batch_idxs]), fold_batch(replay_dones[batch_idxs])
+            last_frames = next_states[...,-1:] if len(next_states.shape) == 5 else next_states # only the final frame is gathered
+            for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                # gather the minibatch across all workers into a single batch, the replay sample shares the same time step indices
+                mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies, \
+                    mb_replay_states, mb_replay_actions, mb_replay_Rextr, mb_Qaux_target, mb_replay_dones = \
+                    self.minibatches.gather(batch_idxs, states, last_frames, actions, R_extr, R_intr, total_Adv, old_policies,
+                                            replay_states, replay_actions, replay_Rextr, Qaux_target, replay_dones)
+                mb_nextstates = mb_nextstates[np.random.uniform(size=(len(mb_nextstates))) < self.pred_prob]
                 
-                    mb_nextstates = mb_nextstates[np.where(np.random.uniform(size=(mini_batch_size)) < self.pred_prob)]
-                    mb_nextstates = mb_nextstates[...,-1:] if len(mb_nextstates.shape) == 4 else mb_nextstates
-                    
-                    mean, std = self.runner.state_mean, self.runner.state_std
-                    l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, mean, std,
-                                            mb_replay_states, mb_replay_actions, mb_replay_Rextr, mb_Qaux_target, mb_replay_dones, reward_states, sample_rewards)
+                mean, std = self.runner.state_mean, self.runner.state_std
+                l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, mean, std,
+                                        mb_replay_states, mb_replay_actions, mb_replay_Rextr, mb_Qaux_target, mb_replay_dones, reward_states, sample_rewards)
             
             l /= (self.num_epochs * self.num_minibatches)
+            self.profile_update(t, t * batch_size)
         
             if self.render_freq > 0 and t % (self.validate_freq // batch_size * self.render_freq) == 0:
                 render = True
@@ -374,10 +405,12 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir + '/' + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
             
+            self.t += 1
+            
     
     def get_action(self, state):
         policy, value = self.model.forward(state)
@@ -392,7 +425,6 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
         
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 policies, values_extr, values_intr = self.model.forward(self.states)
                 actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
@@ -401,11 +433,13 @@ class RANDAL_Trainer(SyncMultiEnvTrainer):
                 next_states__ = next_states[...,-1:] if len(next_states.shape) == 4 else next_states
                 intr_rewards = self.model.intrinsic_reward(next_states__, self.state_mean, self.state_std)
                 #print('intr rewards', intr_rewards)
-                rollout.append((self.states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones))
-                self.replay.append((self.states, actions, extr_rewards, values_extr, dones)) # add to replay memory
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards, intr_rewards=intr_rewards,
+                                    values_extr=values_extr, values_intr=values_intr, policies=policies, dones=dones)
+                self.replay.append((self.states, actions, extr_rewards, values_extr, dones)) # add to replay memory, holds the env's arrays not the reused rollout buffers
                 self.states = next_states
 
-            states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones = stack_many(zip(*rollout))
+            states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones = \
+                self.rollout.get('states', 'next_states', 'actions', 'extr_rewards', 'intr_rewards', 'values_extr', 'values_intr', 'policies', 'dones')
             return states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones
     
     
@@ -422,7 +456,7 @@ def main(env_id, Atari=True):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(1)]
+        val_envs = BatchEnv(DummyEnv, env_id, 1, blocking=False)
         envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
 
     else:
@@ -434,13 +468,13 @@ def main(env_id, Atari=True):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, rescale=84, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, rescale=84, episodic=False, reset=reset, clip_reward=False)
         envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, rescale=84, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500)
         
     
     env.close()
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     #time.sleep(np.random.uniform(1,30)) # stop processes sharing same log dir
     
@@ -4,11 +4,16 @@ import scipy
 import gym
 import os, time, datetime
 import threading
+import copy
 from rlib.A2C.A2C import ActorCritic
 from rlib.networks.networks import*
 from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
 from rlib.utils.VecEnv import*
 from rlib.utils.utils import fold_batch, one_hot, Welfords_algorithm, stack_many, RunningMeanStd
+from rlib.utils.RolloutDataset import RolloutDataset
+from rlib.utils.StagedFeed import StagedFeed
+from rlib.utils.RolloutStorage import MinibatchSampler
+from rlib.utils.Sweep import main_or_sweep, latest_checkpoint
 
 class rolling_obs(object):
     def __init__(self, shape=()):
@@ -35,7 +40,7 @@ class RewardForwardFilter(object):
 
 
 class PPO(object):
-    def __init__(self, model, input_shape, action_size, value_coeff=1.0, entropy_coeff=0.001, extr_coeff=2.0, intr_coeff=1.0, lr=1e-3, lr_final=0, decay_steps=6e5, grad_clip=0.5, build_optimiser=False, **model_args):
+    def __init__(self, model, input_shape, action_size, value_coeff=1.0, entropy_coeff=0.001, extr_coeff=2.0, intr_coeff=1.0, lr=1e-3, lr_final=0, decay_steps=6e5, grad_clip=0.5, build_optimiser=False, rollout=None, loss_scale=1.0, **model_args):
         self.lr, self.lr_final = lr, lr_final
         self.value_coeff, self.entropy_coeff = value_coeff, entropy_coeff
         self.decay_steps = decay_steps
@@ -43,7 +48,8 @@ class PPO(object):
         self.policy_clip = 0.1
         self.sess = None
         with tf.variable_scope('encoder_network'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape])
+            # training inputs default to the in-graph minibatches or staged batches of rollout (RolloutDataset or StagedFeed) when given
+            self.state = rollout.default('state') if rollout is not None else observation_placeholder(input_shape)
             print('state shape', self.state.get_shape().as_list())
             self.dense = model(self.state, **model_args)
         
@@ -55,13 +61,13 @@ class PPO(object):
         
         with tf.variable_scope("actor"):
             self.policy_distrib = mlp_layer(self.dense, action_size, activation=tf.nn.softmax, name='policy_distribution') + 1e-10
-            self.actions = tf.placeholder(tf.int32, [None])
+            self.actions = rollout.default('actions') if rollout is not None else tf.placeholder(tf.int32, [None])
             actions_onehot = tf.one_hot(self.actions,action_size)
             
         with tf.variable_scope('losses'):
-            self.old_policy = tf.placeholder(dtype=tf.float32, shape=[None, action_size], name='old_policies')
-            self.R_extr = tf.placeholder(dtype=tf.float32, shape=[None])
-            self.R_intr = tf.placeholder(dtype=tf.float32, shape=[None])
+            self.old_policy = rollout.default('old_policy', name='old_policies') if rollout is not None else tf.placeholder(dtype=tf.float32, shape=[None, action_size], name='old_policies')
+            self.R_extr = rollout.default('R_extr') if rollout is not None else tf.placeholder(dtype=tf.float32, shape=[None])
+            self.R_intr = rollout.default('R_intr') if rollout is not None else tf.placeholder(dtype=tf.float32, shape=[None])
 
             extr_value_loss = 0.5 * tf.reduce_mean(tf.square(self.R_extr - self.Ve))
             intr_value_loss = 0.5 * tf.reduce_mean(tf.square(self.R_intr - self.Vi))
@@ -69,7 +75,7 @@ class PPO(object):
             policy_actions = tf.reduce_sum(tf.multiply(self.policy_distrib, actions_onehot), axis=1)
             old_policy_actions = tf.reduce_sum(tf.multiply(self.old_policy, actions_onehot), axis=1)
             
-            self.Advantage = tf.placeholder(dtype=tf.float32, shape=[None], name='Adv')
+            self.Advantage = rollout.default('Adv', name='Adv') if rollout is not None else tf.placeholder(dtype=tf.float32, shape=[None], name='Adv')
 
             ratio = policy_actions / old_policy_actions
 
@@ -88,7 +94,7 @@ class PPO(object):
             global_step = tf.Variable(0, trainable=False)
             lr = tf.train.polynomial_decay(lr, global_step, decay_steps, end_learning_rate=lr_final, power=1.0, cycle=False, name=None)
             optimiser = tf.train.AdamOptimizer(lr)
-            grads = tf.gradients(self.loss, self.weights)
+            grads = scaled_gradients(self.loss, self.weights, loss_scale)
             grads, _ = tf.clip_by_global_norm(grads, grad_clip)
             grads_vars = list(zip(grads, self.weights))
             self.train_op = optimiser.apply_gradients(grads_vars, global_step=global_step)
@@ -102,6 +108,10 @@ class PPO(object):
     def get_values(self, state):
         return self.sess.run([self.Ve, self.Vi] , feed_dict = {self.state: state})
 
+    def inference_tensors(self):
+        # inputs and outputs of forward, see rlib.utils.InferencePolicy
+        return {'state':self.state}, {'policy':self.policy_distrib, 'extr_value':self.Ve, 'intr_value':self.Vi}
+
     def backprop(self, state, R_extr, R_intr, Adv, a, old_policy):
         feed_dict = {self.state : state, self.R_extr:R_extr, self.R_intr:R_intr,
                      self.Advantage:Adv, self.actions:a,
@@ -130,11 +140,12 @@ def predictor_mlp(x, num_layers=2, dense_size=64, activation=tf.nn.leaky_relu, i
     return x
 
 class RND(object):
-    def __init__(self, policy_model, target_model, input_shape, action_size, entropy_coeff=0.001, value_coeff=1.0, intr_coeff=0.5, extr_coeff=1.0, lr=1e-4, grad_clip = 0.5, policy_args ={}, RND_args={}):
+    def __init__(self, policy_model, target_model, input_shape, action_size, entropy_coeff=0.001, value_coeff=1.0, intr_coeff=0.5, extr_coeff=1.0, lr=1e-4, grad_clip = 0.5, policy_args ={}, RND_args={}, in_graph_minibatches=False, staged_feeding=False, loss_scale=1.0):
         self.intr_coeff, self.extr_coeff =  intr_coeff, extr_coeff
         self.entropy_coeff, self.value_coeff = entropy_coeff, value_coeff
         self.lr = lr
         self.grad_clip = grad_clip
+        self.loss_scale = loss_scale # static loss scale for float16 policies e.g. policy_args={'dtype':tf.float16}, loss_scale=128
         self.action_size = action_size
         self.sess = None
         #self.pred_prob = 1
@@ -144,19 +155,35 @@ class RND(object):
         except TypeError:
             input_size = (input_shape,)
         
+        if len(input_shape) == 3: # if obs is img, only use final frame
+            next_state_shape = tuple(input_shape[:-1]) + (1,)
+        else: 
+            next_state_shape = input_shape
+        
+        self.rollout, self.staged = None, None
+        if in_graph_minibatches and staged_feeding:
+            raise ValueError('in_graph_minibatches and staged_feeding are alternative input pipelines, choose one')
+        fields = {'state':(observation_dtype(input_shape), input_shape), 'next_state':(observation_dtype(next_state_shape), next_state_shape), 'R_extr':(tf.float32, ()),
+                  'R_intr':(tf.float32, ()), 'Adv':(tf.float32, ()), 'actions':(tf.int32, ()), 'old_policy':(tf.float32, (action_size,))}
+        if in_graph_minibatches: # see backprop_epochs
+            self.rollout = inputs = RolloutDataset(fields)
+        elif staged_feeding: # see backprop_staged and forward_staged
+            self.staged = inputs = StagedFeed(fields)
+        else:
+            inputs = None
 
         with tf.variable_scope('Policy', reuse=tf.AUTO_REUSE):
             self.policy = PPO(policy_model, input_shape, action_size, entropy_coeff=entropy_coeff,
-                    value_coeff=value_coeff, intr_coeff=intr_coeff, extr_coeff=extr_coeff, lr=lr, **policy_args)
+                    value_coeff=value_coeff, intr_coeff=intr_coeff, extr_coeff=extr_coeff, lr=lr, rollout=inputs, **policy_args)
         
-        if len(input_shape) == 3: # if obs is img, only use final frame
-            next_state_shape = input_shape[:-1] + (1,)
-        else: 
-            next_state_shape = input_shape
-        self.next_state = tf.placeholder(tf.float32, shape=[None, *next_state_shape], name='next_state') # GPU obs normalisation
+        if inputs is not None:
+            self.next_state = inputs.default('next_state', name='next_state')
+        else:
+            self.next_state = observation_placeholder(next_state_shape, name='next_state') # GPU obs normalisation
+        self.pred_prob = tf.placeholder_with_default(1.0, shape=[], name='pred_prob') # proportion of next states the predictor is trained on
         self.state_mean = tf.placeholder(tf.float32, shape=[*next_state_shape], name="mean")
         self.state_std = tf.placeholder(tf.float32, shape=[*next_state_shape], name="std")
-        norm_next_state = tf.clip_by_value((self.next_state - self.state_mean) / self.state_std, -5, 5)
+        norm_next_state = tf.clip_by_value((tf.cast(self.next_state, tf.float32) - self.state_mean) / self.state_std, -5, 5)
 
         with tf.variable_scope('target_model'):
             target_state = target_model(norm_next_state, trainable=False)
@@ -164,7 +191,11 @@ class RND(object):
         with tf.variable_scope('predictor_model'):
             pred_next_state = target_model(norm_next_state, trainable=True)
             self.intr_reward = tf.reduce_mean(tf.square(pred_next_state - tf.stop_gradient(target_state)), axis=-1)
-            feat_loss = tf.reduce_mean(self.intr_reward)
+            if in_graph_minibatches: # subsample predictor training in-graph rather than slicing next states on the host
+                pred_mask = tf.cast(tf.random_uniform(tf.shape(self.intr_reward)) < self.pred_prob, tf.float32)
+                feat_loss = tf.reduce_sum(self.intr_reward * pred_mask) / tf.maximum(tf.reduce_sum(pred_mask), 1.0)
+            else:
+                feat_loss = tf.reduce_mean(self.intr_reward)
 
         self.loss = self.policy.loss + feat_loss
 
@@ -172,7 +203,7 @@ class RND(object):
         #self.optimiser = tf.train.RMSPropOptimizer(lr, decay=0.99, epsilon=1e-5)
         
         weights = self.policy.weights + tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='predictor_model')
-        grads = tf.gradients(self.loss, weights)
+        grads = scaled_gradients(self.loss, weights, loss_scale)
         grads, _ = tf.clip_by_global_norm(grads, grad_clip)
         grads_vars = list(zip(grads, weights))
 
@@ -182,6 +213,9 @@ class RND(object):
     def forward(self, state):
         return self.policy.forward(state)
     
+    def inference_tensors(self):
+        return self.policy.inference_tensors()
+    
     def intrinsic_reward(self, next_state, state_mean, state_std):
         feed_dict={self.next_state:next_state, self.state_mean:state_mean, self.state_std:state_std}
         intr_reward = self.sess.run(self.intr_reward, feed_dict=feed_dict)
@@ -196,6 +230,32 @@ class RND(object):
         _, l = self.sess.run([self.train_op,self.loss], feed_dict=feed_dict)
         return l
     
+    def backprop_epochs(self, state, next_state, R_extr, R_intr, Adv, actions, old_policy, state_mean, state_std, pred_prob, num_epochs, num_minibatches):
+        # upload the folded rollout once then run every epoch's shuffled minibatches in-graph, only normalisation statistics are fed per step
+        num_batches = self.rollout.upload(self.sess, num_epochs, num_minibatches, state=state, next_state=next_state, R_extr=R_extr, R_intr=R_intr,
+                                          Adv=Adv, actions=actions, old_policy=old_policy)
+        feed_dict = {self.state_mean:state_mean, self.state_std:state_std, self.pred_prob:pred_prob}
+        l = 0
+        for i in range(num_batches):
+            _, loss = self.sess.run([self.train_op,self.loss], feed_dict=feed_dict)
+            l += loss
+        return l / num_batches
+
+    def backprop_staged(self, minibatches, state_mean, state_std):
+        # minibatches of (state, next_state, R_extr, R_intr, Adv, actions, old_policy), each update trains on a staged minibatch while the next is put
+        fields = ('state', 'next_state', 'R_extr', 'R_intr', 'Adv', 'actions', 'old_policy')
+        batches = (dict(zip(fields, minibatch)) for minibatch in minibatches)
+        feed_dict = {self.state_mean:state_mean, self.state_std:state_std}
+        losses = [loss for _, loss in self.staged.iterate(self.sess, [self.train_op, self.loss], batches, feed_dict=feed_dict)]
+        return sum(losses)
+
+    def stage_forward(self, state):
+        # put the states of the next forward_staged, copied from a background thread while the runner carries on
+        self.staged.stage_async(self.sess, state=state)
+
+    def forward_staged(self):
+        return self.staged.run(self.sess, [self.policy.policy_distrib, self.policy.Ve, self.policy.Vi])
+    
     def set_session(self, sess):
         self.sess = sess
         self.policy.set_session(sess)
@@ -211,11 +271,18 @@ class RND_Trainer(SyncMultiEnvTrainer):
 
 
         self.runner = self.Runner(self.model, self.env, self.nsteps)
+        obs = self.runner.states[0]
+        obs = obs[...,-1:] if len(obs.shape) == 3 else obs
+        self.state_rolling = rolling_obs(shape=obs.shape)
+        self.reward_rolling = RunningMeanStd(shape=())
+        self.forward_filter = RewardForwardFilter(0.99)
         self.alpha = 1
         self.pred_prob = 1 / (self.num_envs / 32.0)
         self.lambda_ = 0.95
         self.init_obs_steps = init_obs_steps
         self.num_epochs, self.num_minibatches = num_epochs, num_minibatches
+        # staged minibatches are read a step after they are gathered so gathers alternate between two sets of buffers
+        self.minibatches = MinibatchSampler(num_minibatches, num_buffers=2 if model.staged is not None else 1)
         hyper_paras = {'learning_rate':model.lr,
          'grad_clip':model.grad_clip, 'nsteps':self.nsteps, 'num_workers':self.num_envs, 'total_steps':self.total_steps,
           'entropy_coefficient':0.001, 'value_coefficient':0.5, 'intr_coeff':model.intr_coeff,
@@ -225,6 +292,11 @@ class RND_Trainer(SyncMultiEnvTrainer):
             filename = log_dir + '/hyperparameters.txt'
             self.save_hyperparameters(filename, **hyper_paras)
     
+    def get_batch_actions(self, states, val_state):
+        policies, values_extr, values_intr = self.model.forward(states)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, val_state
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -254,8 +326,20 @@ class RND_Trainer(SyncMultiEnvTrainer):
                 env.close()
 
     
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        # copied as checkpoints may be written from a background thread while training updates the normalisers
+        state.update(copy.deepcopy({'state_rolling':self.state_rolling, 'reward_rolling':self.reward_rolling, 'forward_filter':self.forward_filter,
+                      'state_mean':self.runner.state_mean, 'state_std':self.runner.state_std}))
+        return state
+    
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.state_rolling, self.reward_rolling, self.forward_filter = state['state_rolling'], state['reward_rolling'], state['forward_filter']
+        self.runner.state_mean, self.runner.state_std = state['state_mean'], state['state_std']
+
     def init_state_obs(self, num_steps):
-        states = 0
+        states = 0.0 # float accumulator, summing uint8 frames in place would wrap
         for i in range(1, num_steps+1):
             rand_actions = np.random.randint(0, self.model.action_size, size=self.num_envs)
             next_states, rewards, dones, infos = self.env.step(rand_actions)
@@ -267,54 +351,65 @@ class RND_Trainer(SyncMultiEnvTrainer):
     def _train_nstep(self):
         batch_size = self.num_envs * self.nsteps
         num_updates = self.total_steps // batch_size
-        s = 0
-        rolling = RunningMeanStd(shape=())
-        obs = self.runner.states[0]
-        obs = obs[...,-1:] if len(obs.shape) == 3 else obs
-        self.state_rolling = rolling_obs(shape=obs.shape)
-        self.init_state_obs(self.init_obs_steps)
-        self.runner.states = self.env.reset()
-        forward_filter = RewardForwardFilter(0.99)
+        if not self.warmed_up: # observation normalisation warm up, skipped when resuming with a restored .state file
+            self.init_state_obs(self.init_obs_steps)
+            self.runner.states = self.env.reset()
+            self.warmed_up = True
 
         # main loop
         start = time.time()
-        for t in range(1,num_updates+1):
+        for t in range(self.t,num_updates+1):
             states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, old_policies, dones = self.runner.run()
-            policy, extr_last_values, intr_last_values = self.model.forward(next_states[-1])
+            with self.timer.phase('forward'):
+                policy, extr_last_values, intr_last_values = self.model.forward(next_states[-1])
 
-            self.runner.state_mean, self.runner.state_std = self.state_rolling.update(next_states) # update state normalisation statistics 
+            with self.timer.phase('normalise'):
+                self.runner.state_mean, self.runner.state_std = self.state_rolling.update(next_states) # update state normalisation statistics 
 
-            int_rff = np.array([forward_filter.update(intr_rewards[i]) for i in range(len(intr_rewards))]) 
-            R_intr_mean, R_intr_std = rolling.update(int_rff.ravel()) # normalise intr reward
-            intr_rewards /= R_intr_std
+                int_rff = np.array([self.forward_filter.update(intr_rewards[i]) for i in range(len(intr_rewards))]) 
+                R_intr_mean, R_intr_std = self.reward_rolling.update(int_rff.ravel()) # normalise intr reward
+                intr_rewards /= R_intr_std
 
-
-            Adv_extr = self.GAE(extr_rewards, values_extr, extr_last_values, dones, gamma=0.999, lambda_=self.lambda_)
-            Adv_intr = self.GAE(intr_rewards, values_intr, intr_last_values, np.zeros_like(dones), gamma=0.99, lambda_=self.lambda_) # non episodic intr reward signal 
-            R_extr = Adv_extr + values_extr
-            R_intr = Adv_intr + values_intr
-            total_Adv = self.model.extr_coeff * Adv_extr + self.model.intr_coeff * Adv_intr
+            with self.timer.phase('returns'):
+                Adv_extr = self.GAE(extr_rewards, values_extr, extr_last_values, dones, gamma=0.999, lambda_=self.lambda_)
+                Adv_intr = self.GAE(intr_rewards, values_intr, intr_last_values, np.zeros_like(dones), gamma=0.99, lambda_=self.lambda_) # non episodic intr reward signal 
+                R_extr = Adv_extr + values_extr
+                R_intr = Adv_intr + values_intr
+                total_Adv = self.model.extr_coeff * Adv_extr + self.model.intr_coeff * Adv_intr
 
             # perform minibatch gradient descent for K epochs 
-            l = 0
-            idxs = np.arange(len(states))
-            for epoch in range(self.num_epochs):
-                mini_batch_size = self.nsteps//self.num_minibatches
-                np.random.shuffle(idxs)
-                for batch in range(0,len(states), mini_batch_size):
-                    batch_idxs = idxs[batch:batch + mini_batch_size]
-                    # stack all states, next_states, actions and Rs across all workers into a single batch
-                    mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = fold_batch(states[batch_idxs]), fold_batch(next_states[batch_idxs]), \
-                                                    fold_batch(actions[batch_idxs]), fold_batch(R_extr[batch_idxs]), fold_batch(R_intr[batch_idxs]), \
-                                                    fold_batch(total_Adv[batch_idxs]), fold_batch(old_policies[batch_idxs])
-                
-                    mb_nextstates = mb_nextstates[np.where(np.random.uniform(size=(mini_batch_size)) < self.pred_prob)]
-                    mb_nextstates = mb_nextstates[...,-1:] if len(mb_nextstates.shape) == 4 else mb_nextstates
+            if self.model.rollout is not None:
+                # rollout uploaded once, minibatches of individual samples are shuffled and gathered in-graph
+                with self.timer.phase('backprop'):
+                    nextstates = fold_batch(next_states[...,-1:] if len(next_states.shape) == 5 else next_states)
+                    l = self.model.backprop_epochs(fold_batch(states), nextstates, fold_batch(R_extr), fold_batch(R_intr), fold_batch(total_Adv),
+                                                   fold_batch(actions), fold_batch(old_policies), self.runner.state_mean, self.runner.state_std,
+                                                   min(self.pred_prob, 1.0), self.num_epochs, self.num_minibatches)
+            elif self.model.staged is not None:
+                # minibatches gathered on the host are staged one step ahead so each copy overlaps the previous update
+                with self.timer.phase('backprop'):
+                    last_frames = next_states[...,-1:] if len(next_states.shape) == 5 else next_states
+                    def minibatches():
+                        for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                            mb = self.minibatches.gather(batch_idxs, states, last_frames, R_extr, R_intr, total_Adv, actions, old_policies)
+                            yield (mb[0], mb[1][np.random.uniform(size=(len(mb[1]))) < self.pred_prob], *mb[2:])
+                    l = self.model.backprop_staged(minibatches(), self.runner.state_mean, self.runner.state_std) / (self.num_epochs * self.num_minibatches)
+            else:
+                l = 0
+                last_frames = next_states[...,-1:] if len(next_states.shape) == 5 else next_states # only the final frame is gathered
+                for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                    # gather the minibatch across all workers into a single batch
+                    with self.timer.phase('minibatch'):
+                        mb_states, mb_nextstates, mb_actions, mb_Rextr, mb_Rintr, mb_Adv, mb_old_policies = \
+                            self.minibatches.gather(batch_idxs, states, last_frames, actions, R_extr, R_intr, total_Adv, old_policies)
+                        mb_nextstates = mb_nextstates[np.random.uniform(size=(len(mb_nextstates))) < self.pred_prob]
                     
                     mean, std = self.runner.state_mean, self.runner.state_std
-                    l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, mean, std)
-            
-            l /= (self.num_epochs * self.num_minibatches)
+                    with self.timer.phase('backprop'):
+                        l += self.model.backprop(mb_states, mb_nextstates, mb_Rextr, mb_Rintr, mb_Adv, mb_actions, mb_old_policies, mean, std)
+                
+                l /= (self.num_epochs * self.num_minibatches)
+            self.profile_update(t, t * batch_size)
         
             if self.render_freq > 0 and t % (self.validate_freq // batch_size * self.render_freq) == 0:
                 render = True
@@ -326,10 +421,12 @@ class RND_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir + '/' + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
             
+            self.t += 1
+            
     
     def get_action(self, state):
         policy, value = self.model.forward(state)
@@ -343,25 +440,34 @@ class RND_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
         
         def run(self,):
-            rollout = []
+            staged = getattr(self.model, 'staged', None) is not None # next states are staged while intrinsic rewards are computed and the step stored
             for t in range(self.num_steps):
-                policies, values_extr, values_intr = self.model.forward(self.states)
-                actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
-                next_states, extr_rewards, dones, infos = self.env.step(actions)
+                with self.timer.phase('forward'):
+                    policies, values_extr, values_intr = self.model.forward_staged() if staged and t > 0 else self.model.forward(self.states)
+                with self.timer.phase('sample'):
+                    actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+                with self.timer.phase('env_step'):
+                    next_states, extr_rewards, dones, infos = self.env.step(actions)
+                if staged and t < self.num_steps - 1: # the last next states are fed to the trainer's bootstrap forward
+                    self.model.stage_forward(next_states)
     
                 next_states__ = next_states[...,-1:] if len(next_states.shape) == 4 else next_states
-                intr_rewards = self.model.intrinsic_reward(next_states__, self.state_mean, self.state_std)
+                with self.timer.phase('intrinsic_reward'):
+                    intr_rewards = self.model.intrinsic_reward(next_states__, self.state_mean, self.state_std)
                 
-                rollout.append((self.states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones))
+                with self.timer.phase('store'):
+                    self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards, intr_rewards=intr_rewards,
+                                        values_extr=values_extr, values_intr=values_intr, policies=policies, dones=dones)
                 self.states = next_states
 
-            states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones = stack_many(zip(*rollout))
+            states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones = \
+                self.rollout.get('states', 'next_states', 'actions', 'extr_rewards', 'intr_rewards', 'values_extr', 'values_intr', 'policies', 'dones')
             return states, next_states, actions, extr_rewards, intr_rewards, values_extr, values_intr, policies, dones
     
     
 
 
-def main(env_id, Atari=True):
+def main(env_id, Atari=True, seed=None, run_dir=None):
     num_envs = 32
     nsteps = 128
 
@@ -370,8 +476,8 @@ def main(env_id, Atari=True):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(10)]
-        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
+        val_envs = BatchEnv(DummyEnv, env_id, 10, blocking=False)
+        envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False, seed=seed)
 
     else:
         print('Atari')
@@ -382,18 +488,20 @@ def main(env_id, Atari=True):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, rescale=84, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
-        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, rescale=84, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500)
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, rescale=84, episodic=False, reset=reset, clip_reward=False)
+        envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, rescale=84, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500, seed=seed)
         
     
     env.close()
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     
     current_time = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
     train_log_dir = 'logs/RND/' + env_id + '/' + current_time
     model_dir = "models/RND/" + env_id + '/' + current_time
+    if run_dir is not None: # launched by a Sweep, logs and checkpoints are kept in the run's directory
+        train_log_dir, model_dir = run_dir + '/logs', run_dir + '/models'
 
     
 
@@ -419,27 +527,32 @@ def main(env_id, Atari=True):
                 lr=1e-4,
                 grad_clip=0.5,
                 policy_args={},
-                RND_args={}) #
+                RND_args={},
+                in_graph_minibatches=True) #
 
     
 
-    curiosity = RND_Trainer(envs = envs,
-                            model = model,
-                            model_dir = model_dir,
-                            log_dir = train_log_dir,
-                            val_envs = val_envs,
-                            train_mode = 'nstep',
-                            total_steps = 50e6,
-                            nsteps = nsteps,
-                            init_obs_steps=128*50,
-                            num_epochs=4,
-                            num_minibatches=4,
-                            validate_freq = 1e6,
-                            save_freq = 5e6,
-                            render_freq = 0,
-                            num_val_episodes = 50,
-                            log_scalars=True,
-                            gpu_growth=True)
+    checkpoint = latest_checkpoint(model_dir) if run_dir is not None else None
+    if checkpoint is not None: # resume an unfinished sweep run
+        curiosity = RND_Trainer.load(RND_Trainer, model, checkpoint[0], envs, val_envs, checkpoint[1])
+    else:
+        curiosity = RND_Trainer(envs = envs,
+                                model = model,
+                                model_dir = model_dir,
+                                log_dir = train_log_dir,
+                                val_envs = val_envs,
+                                train_mode = 'nstep',
+                                total_steps = 50e6,
+                                nsteps = nsteps,
+                                init_obs_steps=128*50,
+                                num_epochs=4,
+                                num_minibatches=4,
+                                validate_freq = 1e6,
+                                save_freq = 5e6,
+                                render_freq = 0,
+                                num_val_episodes = 50,
+                                log_scalars=True,
+                                gpu_growth=True)
     curiosity.train()
     
     del curiosity
@@ -450,7 +563,5 @@ def main(env_id, Atari=True):
 if __name__ == "__main__":
     env_id_list = ['MontezumaRevengeDeterministic-v4', 'SpaceInvadersDeterministic-v4', 'FreewayDeterministic-v4']
     #env_id_list = ['MountainCar-v0', 'CartPole-v1' , 'Acrobot-v1', ]
-    for i in range(2):
-        for env_id in env_id_list:
-            main(env_id)
+    main_or_sweep(main, env_id_list, 'sweeps/RND', cores_per_run=8) # single run of the first env, --sweep for every env x seed
     
\ No newline at end of file
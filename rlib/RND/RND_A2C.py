@@ -45,7 +45,7 @@ class ActorCritic(object):
         self.sess = None
 
         with tf.variable_scope('input'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='time_batch_state') # [time*batch, *input_shape]
+            self.state = observation_placeholder(input_shape, name='time_batch_state') # [time*batch, *input_shape]
 
         with tf.variable_scope('encoder_network'):
             self.dense = model_head(self.state, **model_head_args)
@@ -126,10 +126,10 @@ class RND(object):
         
         next_state_shape = input_shape[:-1] + (1,) if len(input_shape) == 3 else input_shape
         
-        self.next_state = tf.placeholder(tf.float32, shape=[None, *next_state_shape], name='next_state')
+        self.next_state = observation_placeholder(next_state_shape, name='next_state')
         self.state_mean = tf.placeholder(tf.float32, shape=[*next_state_shape], name="mean")
         self.state_std = tf.placeholder(tf.float32, shape=[*next_state_shape], name="std")
-        norm_next_state = tf.clip_by_value((self.next_state - self.state_mean) / self.state_std, -5, 5)
+        norm_next_state = tf.clip_by_value((tf.cast(self.next_state, tf.float32) - self.state_mean) / self.state_std, -5, 5)
 
         with tf.variable_scope('target_model'):
             target_state = target_model(norm_next_state, trainable=False, **RND_args)
@@ -274,7 +274,6 @@ class RND_Trainer(SyncMultiEnvTrainer):
             self.state_std = None
 
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 start = time.time()
                 policies, extr_values, intr_values = self.model.forward(self.states)
@@ -283,10 +282,12 @@ class RND_Trainer(SyncMultiEnvTrainer):
                 next_states_ = next_states[...,-1:] if len(next_states.shape) == 4 else next_states
                 intr_rewards = self.model.intrinsic_reward(next_states_, self.state_mean, self.state_std)
                 #print('intr_rewards', self.model.intr_coeff * intr_rewards)
-                rollout.append((self.states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, np.array(infos)))
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards, intr_rewards=intr_rewards,
+                                    extr_values=extr_values, intr_values=intr_values, dones=dones, infos=infos)
                 self.states = next_states
             
-            states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos = stack_many(zip(*rollout))
+            states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos = \
+                self.rollout.get('states', 'next_states', 'actions', 'extr_rewards', 'intr_rewards', 'extr_values', 'intr_values', 'dones', 'infos')
             return states, next_states, actions, extr_rewards, intr_rewards, extr_values, intr_values, dones, infos
             
 
@@ -12,7 +12,7 @@ from rlib.Curiosity.Curiosity import ICM
 
 class ActorCritic_LSTM(object):
     def __init__(self, model_head, input_shape, action_size, num_envs, cell_size, intr_coeff=0.5, extr_coeff=1.0,
-                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, opt=False, **model_head_args):
+                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, opt=False, fused_lstm=False, **model_head_args):
         self.lr, self.lr_final = lr, lr_final
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
@@ -21,16 +21,14 @@ class ActorCritic_LSTM(object):
         self.sess = None
 
         with tf.variable_scope('input'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='time_batch_state') # [time*batch, *input_shape]
+            self.state = observation_placeholder(input_shape, name='time_batch_state') # [time*batch, *input_shape]
 
         with tf.variable_scope('encoder_network'):
             self.dense = model_head(self.state, **model_head_args)
-            dense_size = self.dense.get_shape()[1].value
-            unfolded_state = tf.reshape(self.dense, shape=[-1, num_envs, dense_size], name='unfolded_state')
         
         with tf.variable_scope('lstm'):
-            #self.lstm_output, self.hidden_in, self.hidden_out = lstm(unfolded_state, cell_size=cell_size, fold_output=True, time_major=True)
-            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(unfolded_state, cell_size=cell_size, batch_size=num_envs, fold_output=True, time_major=True)
+            # dense is unfolded to [time, batch, dense_size] with the batch size of hidden_in, so any number of envs can be fed
+            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(self.dense, cell_size=cell_size, fold_output=True, time_major=True, fused=fused_lstm)
 
         with tf.variable_scope('extr_critic'):
             self.Ve = tf.reshape( mlp_layer(self.lstm_output, 1, name='state_value_extr', activation=None), shape=[-1])
@@ -82,7 +80,7 @@ class ActorCritic_LSTM(object):
         return hidden * np.stack([idxs for i in range(self.cell_size)], axis=1)
 
     def forward(self, state, hidden):
-        mask = np.zeros((1, self.num_envs)) # state = [time, batch, ...]
+        mask = np.zeros((1, len(hidden[0]))) # state = [time, batch, ...]
         feed_dict = {self.state:state, self.hidden_in[0]:hidden[0], self.hidden_in[1]:hidden[1], self.mask:mask}
         policy, value_extr, value_intr, hidden = self.sess.run([self.policy_distrib, self.Ve, self.Vi, self.hidden_out], feed_dict = feed_dict)
         return policy, value_extr, value_intr, hidden
@@ -114,15 +112,15 @@ class RND(object):
 
         with tf.variable_scope('ActorCritic', reuse=tf.AUTO_REUSE):
             self.train_policy = ActorCritic_LSTM(policy_model, input_shape, action_size, num_envs, cell_size, intr_coeff=intr_coeff, extr_coeff=extr_coeff, **policy_args)
-            self.validate_policy = ActorCritic_LSTM(policy_model, input_shape, action_size, 1, cell_size, **policy_args)
             
-        self.next_state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='next_state')
+        self.next_state = observation_placeholder(input_shape, name='next_state')
+        next_state = tf.cast(self.next_state, tf.float32)
 
         with tf.variable_scope('target_model'):
-            target_state = target_model(self.next_state, trainable=False, **RND_args)
+            target_state = target_model(next_state, trainable=False, **RND_args)
         
         with tf.variable_scope('predictor_model'):
-            pred_next_state = target_model(self.next_state, **RND_args)
+            pred_next_state = target_model(next_state, **RND_args)
             self.intr_reward = tf.reduce_mean(tf.square(pred_next_state - target_state), axis=-1)
             feat_loss = tf.reduce_mean(self.intr_reward)
 
@@ -141,8 +139,8 @@ class RND(object):
         self.train_op = self.optimiser.apply_gradients(grads_vars)
 
     def forward(self, state, hidden, validate=False):
-        if validate:
-            return self.validate_policy.forward(state, hidden)
+        if validate: # state = [batch, ...]
+            return self.train_policy.forward(state, hidden)
         else :
             return self.train_policy.forward(fold_batch(state), hidden)
     
@@ -170,7 +168,6 @@ class RND(object):
     def set_session(self, sess):
         self.sess = sess
         self.train_policy.set_session(sess)
-        self.validate_policy.set_session(sess)
 
 
 class RND_LSTM_Trainer(SyncMultiEnvTrainer):
@@ -225,6 +222,17 @@ class RND_LSTM_Trainer(SyncMultiEnvTrainer):
                 print('saved model')
     
     
+    def get_batch_actions(self, states, hidden):
+        policies, values_extr, values_intr, hidden = self.model.forward(states, hidden, validate=True)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, hidden
+    
+    def init_validate_state(self, num_envs):
+        return self.model.get_initial_hidden(num_envs)
+    
+    def reset_validate_state(self, hidden, actions, rewards, dones):
+        return self.model.reset_batch_hidden(hidden, 1-dones)
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -261,7 +269,6 @@ class RND_LSTM_Trainer(SyncMultiEnvTrainer):
             self.R_std = np.ones((len(env)))
         
         def run(self,):
-            memory = []
             for t in range(self.num_steps):
                 policies, values_extr, values_intr, hidden = self.model.forward(self.states[np.newaxis], self.prev_hidden)
                 #actions = np.argmax(policies, axis=1)
@@ -271,13 +278,14 @@ class RND_LSTM_Trainer(SyncMultiEnvTrainer):
                 intr_rewards = self.model.intrinsic_reward(next_states)
                 intr_rewards = intr_rewards / self.R_std
                 #print('intr rewards', intr_rewards)
-                memory.append((self.states, next_states, actions, extr_rewards, intr_rewards, self.prev_hidden, dones, infos))
+                self.rollout.insert(t, states=self.states, next_states=next_states, actions=actions, extr_rewards=extr_rewards, intr_rewards=intr_rewards,
+                                    hidden=self.prev_hidden, dones=dones, infos=infos)
                 self.states = next_states
                 
                 self.prev_hidden = self.model.reset_batch_hidden(hidden, 1-dones) # reset hidden state at end of episode
 
-            states, next_states, actions, extr_rewards, intr_rewards, hidden_batch, dones, infos = zip(*memory)
-            states, next_states, actions, extr_rewards, intr_rewards, dones = np.stack(states), np.stack(next_states), np.stack(actions), np.stack(extr_rewards), np.stack(intr_rewards), np.stack(dones)
+            states, next_states, actions, extr_rewards, intr_rewards, hidden_batch, dones, infos = self.rollout.get('states', 'next_states', 'actions', 'extr_rewards',
+                                                                                                                'intr_rewards', 'hidden', 'dones', 'infos')
             return states, next_states, actions, extr_rewards, intr_rewards, hidden_batch, dones, infos, values_extr, values_intr
             
 
@@ -291,7 +299,7 @@ def main(env_id):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(10)]
+        val_envs = BatchEnv(DummyEnv, env_id, 10, blocking=False)
         envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
 
     elif 'SuperMarioBros' in env_id:
@@ -299,7 +307,7 @@ def main(env_id):
         
         #envs = gym_super_mario_bros.make('SuperMarioBros-1-1-v0')
         envs = BatchEnv(MarioEnv, env_id, num_envs)
-        val_envs = [MarioEnv(gym.make(env_id)) for i in range(16)] 
+        val_envs = BatchEnv(MarioEnv, env_id, 16, blocking=False)
 
     else:
         print('Atari')
@@ -310,11 +318,11 @@ def main(env_id):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, rescale=42, episodic=False, reset=reset, clip_reward=False) for i in range(10)]
+        val_envs = BatchEnv(AtariEnv, env_id, 10, blocking=False, k=4, rescale=42, episodic=False, reset=reset, clip_reward=False)
         envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False , rescale=42, k=4, reset=reset, episodic=False, clip_reward=True)
     
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     
     
@@ -1,10 +1,26 @@
 from rlib.RND.RND import*
+from rlib.utils.InferencePolicy import InferencePolicy
 import argparse
 
 
 
 
-def main(env_id, model_dir):
+def play_frozen(env_id, filename):
+    # plays from an exported inference graph, no trainer or training graph is built
+    env = gym.make(env_id)
+    if env.unwrapped.get_action_meanings()[1] == 'FIRE':
+        reset = True
+    else:
+        reset = False
+    env.close()
+    val_env = AtariEnv(gym.make(env_id), k=4, rescale=84, episodic=False, reset=reset, clip_reward=False)
+    policy = InferencePolicy(filename)
+    env = gym.wrappers.Monitor(val_env, "vids/RND/" + env_id, force=True)
+    policy.validate(env, 1, 10000, True)
+    policy.close()
+
+
+def main(env_id, model_dir, export=False):
     num_envs = 1
     nsteps = 128
 
@@ -63,6 +79,8 @@ def main(env_id, model_dir):
                             gpu_growth=True)
     
     curiosity.load_model('10', model_dir)
+    if export:
+        curiosity.export_inference(model_dir + '/inference.pb')
     
     env = gym.wrappers.Monitor(val_envs[0], "vids/RND/" + env_id, force=True)
     curiosity.validate(env, 1, 10000, True)
@@ -77,6 +95,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--env', nargs='?', default='MontezumaRevenge')
     parser.add_argument('--model_dir', nargs='?', default='models/MontezumaRevenge')
+    parser.add_argument('--export', action='store_true', help='also write model_dir/inference.pb for play from --frozen')
+    parser.add_argument('--frozen', nargs='?', default=None, help='play from an exported inference graph instead of the checkpoint')
     args = parser.parse_args()
 
-    main(args.env + 'Deterministic-v4', args.model_dir)
\ No newline at end of file
+    if args.frozen is not None:
+        play_frozen(args.env + 'Deterministic-v4', args.frozen)
+    else:
+        main(args.env + 'Deterministic-v4', args.model_dir, args.export)
\ No newline at end of file
@@ -49,7 +49,7 @@ def AtariEnv__(env, k=4, episodic=True, reset=True, clip_reward=True, Noop=True,
 
 class UNREAL_ActorCritic_LSTM(ActorCritic_LSTM):
     def __init__(self, model_head, input_shape, action_size, num_envs, cell_size, entropy_coeff=0.001, value_coeff=0.5,
-                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, opt=False, **model_head_args):
+                 lr=1e-3, lr_final=1e-6, decay_steps=6e5, grad_clip = 0.5, opt=False, fused_lstm=False, **model_head_args):
         self.lr, self.lr_final = lr, lr_final
         self.decay_steps = decay_steps
         self.grad_clip = grad_clip
@@ -59,21 +59,19 @@ class UNREAL_ActorCritic_LSTM(ActorCritic_LSTM):
         print('action_size', action_size)
 
         with tf.variable_scope('input'):
-            self.state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='time_batch_state') # [time*batch, *input_shape]
+            self.state = observation_placeholder(input_shape, name='time_batch_state') # [time*batch, *input_shape]
 
         with tf.variable_scope('encoder_network'):
             self.dense = model_head(self.state, **model_head_args)
-            dense_size = self.dense.get_shape()[1].value
-            unfolded_state = tf.reshape(self.dense, shape=[-1, num_envs, dense_size], name='unfolded_state')
         
         with tf.variable_scope('lstm'):
             # feed previous reward and previous action into lstm 
-            self.action_reward = tf.placeholder(tf.float32, shape=[None, num_envs, action_size+1], name='last_action_reward') # [action_t-1, reward_t-1]
-            lstm_input = tf.concat([unfolded_state, self.action_reward], axis=2)
+            self.action_reward = tf.placeholder(tf.float32, shape=[None, None, action_size+1], name='last_action_reward') # [time, batch, [action_t-1, reward_t-1]]
+            folded_action_reward = tf.reshape(self.action_reward, shape=[-1, action_size+1])
+            lstm_input = tf.concat([self.dense, folded_action_reward], axis=1) # [time*batch, dense_size + action_size+1]
             print('lstm input ', lstm_input.get_shape().as_list())
-            #self.mask = tf.placeholder(tf.float32, shape=[None, None])
-            #self.lstm_output, self.hidden_in, self.hidden_out = lstm(unfolded_state, cell_size=cell_size, fold_output=True, time_major=True)
-            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(lstm_input, cell_size=cell_size, batch_size=num_envs, fold_output=True, time_major=True)
+            # unfolded with the batch size of hidden_in, so rollout, validation and replay batches share one graph shape
+            self.lstm_output, self.hidden_in, self.hidden_out, self.mask = lstm_masked(lstm_input, cell_size=cell_size, fold_output=True, time_major=True, fused=fused_lstm)
 
         with tf.variable_scope('critic'):
             self.V = tf.reshape( mlp_layer(self.lstm_output, 1, name='state_value', activation=None), shape=[-1])
@@ -110,11 +108,16 @@ class UNREAL_ActorCritic_LSTM(ActorCritic_LSTM):
             self.train_op = optimiser.apply_gradients(grads_vars, global_step=global_step)
 
     def forward(self, state, hidden, action_reward):
-        mask = np.zeros((1, self.num_envs)) # state = [time, batch, ...]
+        mask = np.zeros((1, len(hidden[0]))) # state = [time, batch, ...]
         feed_dict = {self.state:state, self.hidden_in[0]:hidden[0], self.hidden_in[1]:hidden[1], self.mask:mask, self.action_reward:action_reward}
         policy, value, hidden = self.sess.run([self.policy_distrib, self.V, self.hidden_out], feed_dict = feed_dict)
         return policy, value, hidden
 
+    def inference_tensors(self):
+        inputs, outputs = super().inference_tensors()
+        inputs['action_reward'] = self.action_reward
+        return inputs, outputs
+
     def backprop(self, state, R, a, hidden, dones, action_reward):
         feed_dict = {self.state : state, self.R : R, self.actions: a,
         self.hidden_in[0]:hidden[0], self.hidden_in[1]:hidden[1],
@@ -143,7 +146,7 @@ class UnrealA2C(object):
         
         with tf.variable_scope('ActorCritic', reuse=tf.AUTO_REUSE):
             self.train_policy = UNREAL_ActorCritic_LSTM(policy_model, input_shape, action_size, num_envs, cell_size, entropy_coeff=entropy_coeff, value_coeff=value_coeff, lr=lr, lr_final=lr, decay_steps=decay_steps, grad_clip=grad_clip, **policy_args)
-            self.validate_policy = UNREAL_ActorCritic_LSTM(policy_model, input_shape, action_size, 1, cell_size, entropy_coeff=entropy_coeff, value_coeff=value_coeff, lr=lr, lr_final=lr, decay_steps=decay_steps, grad_clip=grad_clip, **policy_args)
+            # replay is fed alongside the rollout in backprop so needs its own placeholders, variables are shared and batch size is dynamic
             self.replay_policy = UNREAL_ActorCritic_LSTM(policy_model, input_shape, action_size, 1, cell_size, entropy_coeff=entropy_coeff, value_coeff=value_coeff, lr=lr, lr_final=lr, decay_steps=decay_steps, grad_clip=grad_clip, **policy_args)
 
         with tf.variable_scope('pixel_control', reuse=tf.AUTO_REUSE):
@@ -162,7 +165,7 @@ class UnrealA2C(object):
             #self.replay_R = tf.placeholder(dtype=tf.float32, shape=[None])
             replay_loss = 0.5 * tf.reduce_mean(tf.square(self.replay_policy.R - self.replay_policy.V))
         
-        self.reward_state = tf.placeholder(tf.float32, shape=[3, *input_shape], name='reward_state')
+        self.reward_state = tf.placeholder(observation_dtype(input_shape), shape=[3, *input_shape], name='reward_state')
         with tf.variable_scope('ActorCritic/encoder_network', reuse=True):
             reward_enc = policy_model(self.reward_state)
         with tf.variable_scope('reward_model'):
@@ -179,6 +182,10 @@ class UnrealA2C(object):
         
         
 
+        # heads built on the train_policy encoder and lstm, any combination is computed in one pass by fetch
+        # (reward prediction is not included as it needs three consecutive states)
+        self.heads = {'policy':self.train_policy.policy_distrib, 'value':self.train_policy.V, 'hidden':self.train_policy.hidden_out, 'pixel_control':self.Qaux_batch}
+
         self.on_policy_loss = self.train_policy.loss
         self.auxiliary_loss = PC * pixel_loss +  RP * reward_loss +  VR * replay_loss 
         self.loss = self.on_policy_loss + self.auxiliary_loss 
@@ -219,24 +226,25 @@ class UnrealA2C(object):
         return Qaux
 
     def forward(self, state, hidden, action_reward, validate=False):
-        if validate:
-            return self.validate_policy.forward(state, hidden, action_reward)
+        if validate: # state = [batch, ...]
+            return self.train_policy.forward(state, hidden, action_reward)
         else: 
             return self.train_policy.forward(fold_batch(state), hidden, action_reward)
 
-    def forward_all(self, state, hidden, action_reward):
-        mask = np.zeros((1, state.shape[0]))
+    def fetch(self, heads, state, hidden, action_reward):
+        ''' any combination of self.heads for one step of a batch from a single encoder pass and sess.run
+            e.g. values, Qaux = model.fetch(['value', 'pixel_control'], state, hidden, action_reward) '''
+        mask = np.zeros((1, len(hidden[0])))
         feed_dict = {self.train_policy.state:state, self.train_policy.hidden_in[0]:hidden[0],
          self.train_policy.hidden_in[1]:hidden[1], self.train_policy.mask:mask,
          self.train_policy.action_reward:action_reward}
-        return self.sess.run([self.train_policy.policy_distrib, self.train_policy.V, self.train_policy.hidden_out, self.Qaux_batch], feed_dict=feed_dict)
+        return self.sess.run([self.heads[head] for head in heads], feed_dict=feed_dict)
+
+    def forward_all(self, state, hidden, action_reward):
+        return self.fetch(['policy', 'value', 'hidden', 'pixel_control'], state, hidden, action_reward)
     
     def get_pixel_control(self, state, hidden, action_reward):
-        mask = np.zeros((1, state.shape[0]))
-        feed_dict = {self.replay_policy.state:state, self.replay_policy.hidden_in[0]:hidden[0],
-         self.replay_policy.hidden_in[1]:hidden[1], self.replay_policy.mask:mask,
-         self.replay_policy.action_reward:action_reward}
-        return self.sess.run(self.Qaux, feed_dict=feed_dict)
+        return self.fetch(['pixel_control'], state, hidden, action_reward)[0]
     
     # def A2Cbackprop(self, states, R, actions, hidden, dones, action_reward):
     #     feed_dict = {self.train_policy.state:states, self.train_policy.actions:actions, self.train_policy.R:R,
@@ -268,6 +276,9 @@ class UnrealA2C(object):
         _, l = self.sess.run([self.train_op, self.loss], feed_dict=feed_dict)
         return l
     
+    def inference_tensors(self):
+        return self.train_policy.inference_tensors()
+
     def get_initial_hidden(self, batch_size):
         return self.train_policy.get_initial_hidden(batch_size)
     
@@ -277,7 +288,6 @@ class UnrealA2C(object):
     def set_session(self, sess):
         self.sess = sess
         self.train_policy.set_session(sess)
-        self.validate_policy.set_session(sess)
 
 
 class Unreal_Trainer(SyncMultiEnvTrainer):
@@ -292,9 +302,19 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
                   'total_steps':self.total_steps, 'entropy_coefficient':model.entropy_coeff, 'value_coefficient':0.5}
         
         if log_scalars:
-            filename = log_dir + self.current_time + '/hyperparameters.txt'
+            filename = log_dir + '/hyperparameters.txt'
             self.save_hyperparameters(filename, **hyper_paras)
     
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['replay'] = list(self.replay)
+        return state
+    
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.replay.clear()
+        self.replay.extend(state['replay']) # runner shares the same deque
+
     def populate_memory(self):
         for t in range(2000//self.nsteps):
             self.runner.run()
@@ -339,11 +359,12 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
         #print('replay_hiddens dones shape', replay_dones.shape)
         
         next_state = self.replay[sample_start+self.nsteps][0][worker][np.newaxis] # get state 
-        _, replay_values, *_ = self.model.forward(next_state, replay_hiddens[-1,:,worker].reshape(2,1,-1), replay_actsrews[-1][np.newaxis,np.newaxis], validate=True)
+        # bootstrap value and pixel control from one encoder pass
+        replay_values, Qaux_value = self.model.fetch(['value', 'pixel_control'], next_state, replay_hiddens[-1,:,worker].reshape(2,1,-1), replay_actsrews[-1][np.newaxis,np.newaxis])
         replay_R = self.nstep_return(replay_rewards, replay_values, replay_dones)
 
         prev_states = self.replay[sample_start-1][0][worker]
-        Qaux_value = self.model.get_pixel_control(next_state, replay_hiddens[-1,:,worker].reshape(2,1,-1), replay_actsrews[-1][np.newaxis,np.newaxis])[0]
+        Qaux_value = Qaux_value[0]
         #print('Qaux_value shape', Qaux_value.shape)
         Qaux_target = self.auxiliary_target(prev_states, replay_states, np.max(Qaux_value, axis=-1), replay_dones)
         #print('Qaux target shape', Qaux_target.shape)
@@ -385,11 +406,11 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
         batch_size = (self.num_envs * self.nsteps)
         start = time.time()
         num_updates = self.total_steps // batch_size
-        s = 0
         #self.validate(self.val_envs[0], 1, 1000)
-        self.populate_memory()
+        if len(self.replay) == 0: # skipped when resuming with a restored replay
+            self.populate_memory()
         # main loop
-        for t in range(1,num_updates+1):
+        for t in range(self.t,num_updates+1):
             states, actions, rewards, hidden_batch, prev_acts_rewards, Qauxs, dones, infos, last_values = self.runner.run()
 
             R = self.nstep_return(rewards, last_values, dones, clip=False)
@@ -401,6 +422,7 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
             
             l = self.model.backprop(states, R, actions, hidden_batch[0], dones, prev_acts_rewards,
                 reward_states, sample_rewards, Qaux_target, replay_actions, replay_states, replay_R, replay_hiddens[0], replay_dones, replay_actsrews)
+            self.profile_update(t, t * batch_size)
             
             if self.render_freq > 0 and t % ((self.validate_freq // batch_size) * self.render_freq) == 0:
                 render = True
@@ -412,9 +434,11 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir + '/' + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
+            
+            self.t += 1
 
 
     class Runner(SyncMultiEnvTrainer.Runner):
@@ -427,21 +451,21 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
             self.prev_actions_rewards = concat_action_reward(zeros, zeros, self.action_size+1) # start with action 0 and reward 0 
 
         def run(self,):
-            rollout = []
+            hidden_batch = []
             for t in range(self.num_steps):
                 policies, values, hidden, Qaux = self.model.forward_all(self.states, self.prev_hidden, self.prev_actions_rewards[np.newaxis])
                 #Qaux = self.model.get_pixel_control(self.states, self.prev_hidden, self.prev_actions_rewards[np.newaxis])
                 actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
                 next_states, rewards, dones, infos = self.env.step(actions)
 
-                rollout.append((self.states, actions, rewards, self.prev_hidden, self.prev_actions_rewards, Qaux, dones, infos))
+                self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, prev_actions_rewards=self.prev_actions_rewards, Qaux=Qaux, dones=dones, infos=infos)
+                hidden_batch.append(self.prev_hidden)
                 self.replay.append((self.states, actions, rewards, self.prev_hidden, self.prev_actions_rewards, Qaux, dones, infos)) # add to replay memory
                 self.states = next_states
                 self.prev_hidden = self.model.reset_batch_hidden(hidden, 1-dones) # reset hidden state at end of episode
                 self.prev_actions_rewards = concat_action_reward(actions , rewards, self.action_size+1)
             
-            states, actions, rewards, hidden_batch, prev_actions_rewards, Qaux, dones, infos = zip(*rollout)
-            states, actions, rewards, prev_actions_rewards, Qaux, dones = np.stack(states), np.stack(actions), np.stack(rewards), np.stack(prev_actions_rewards), np.stack(Qaux), np.stack(dones)
+            states, actions, rewards, prev_actions_rewards, Qaux, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'prev_actions_rewards', 'Qaux', 'dones', 'infos')
             _, last_values, _ = self.model.forward(self.states[np.newaxis], self.prev_hidden, self.prev_actions_rewards[np.newaxis])
             return states, actions, rewards, hidden_batch, prev_actions_rewards, Qaux, dones, infos, last_values
 
@@ -451,6 +475,24 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
         #action = np.argmax(policy)
         return action
 
+    def get_batch_actions(self, states, val_state):
+        hidden, prev_actrew = val_state
+        policies, values, hidden = self.model.forward(states, hidden, prev_actrew[np.newaxis], validate=True)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, (hidden, prev_actrew)
+    
+    def init_validate_state(self, num_envs):
+        hidden = self.model.get_initial_hidden(num_envs)
+        prev_actrew = concat_action_reward(np.zeros((num_envs),dtype=np.int32), np.zeros((num_envs),dtype=np.int32), self.model.action_size+1)
+        return hidden, prev_actrew
+    
+    def reset_validate_state(self, val_state, actions, rewards, dones):
+        # envs which finished an episode restart with zero hidden state and zero previous action and reward
+        hidden, prev_actrew = val_state
+        hidden = self.model.reset_batch_hidden(hidden, 1-dones)
+        prev_actrew = concat_action_reward(np.where(dones, 0, actions), rewards * (1-dones), self.model.action_size+1)
+        return hidden, prev_actrew
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -495,7 +537,7 @@ def main(env_id, Atari=True):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(16)]
+        val_envs = BatchEnv(DummyEnv, env_id, 16, blocking=False)
         envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
 
     else:
@@ -507,13 +549,13 @@ def main(env_id, Atari=True):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv__(gym.make(env_id), k=1, episodic=False, reset=reset, clip_reward=False) for i in range(1)]
+        val_envs = BatchEnv(AtariEnv__, env_id, 1, blocking=False, k=1, episodic=False, reset=reset, clip_reward=False)
         envs = BatchEnv(AtariEnv__, env_id, num_envs, blocking=False, k=1, reset=reset, episodic=True, clip_reward=True, time_limit=4500)
         
     
     env.close()
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     
 
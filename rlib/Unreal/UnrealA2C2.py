@@ -57,7 +57,7 @@ class UnrealA2C2(object):
             replay_loss = 0.5 * tf.reduce_mean(tf.square(self.replay_policy.R - self.replay_policy.V))
         
 
-        self.reward_state = tf.placeholder(tf.float32, shape=[None, *input_shape], name='reward_state')
+        self.reward_state = observation_placeholder(input_shape, name='reward_state')
         with tf.variable_scope('ActorCritic/encoder_network', reuse=True):
             reward_enc = policy_model(self.reward_state)
 
@@ -70,9 +70,14 @@ class UnrealA2C2(object):
             #reward_loss = 0.5 * tf.reduce_mean(tf.square(self.reward_target - pred_reward)) #mse
             reward_loss = tf.reduce_mean(tf.losses.softmax_cross_entropy(logits=pred_reward, onehot_labels=self.reward_target))  # cross entropy over caterogical reward 
             print('reward loss ', reward_loss)
-            
         
+        with tf.variable_scope('reward_model', reuse=True): # reward prediction of each state from the replay encoder, for fetch
+            replay_pred_reward = mlp_layer(mlp_layer(self.replay_policy.dense, 128, activation=tf.nn.relu, name='reward_hidden'), 3, activation=None, name='pred_reward')
         
+        # every head built on the replay_policy encoder, any combination is computed in one encoder pass by fetch
+        self.heads = {'policy':self.replay_policy.policy_distrib, 'value':self.replay_policy.V, 'reward':tf.nn.softmax(replay_pred_reward)}
+        if pixel_control:
+            self.heads['pixel_control'] = self.Qaux
 
         self.on_policy_loss = self.policy.loss
         self.auxiliary_loss = RP * reward_loss +  VR * replay_loss 
@@ -110,13 +115,15 @@ class UnrealA2C2(object):
     def forward(self, state):
         return self.policy.forward(state)
 
+    def fetch(self, heads, state):
+        ''' any combination of self.heads from a single encoder pass and sess.run e.g. values, Qaux = model.fetch(['value', 'pixel_control'], state) '''
+        return self.sess.run([self.heads[head] for head in heads], feed_dict={self.replay_policy.state:state})
+
     def forward_all(self, state):
-        feed_dict = {self.policy.state:state, self.replay_policy.state:state}
-        return self.sess.run([self.policy.policy_distrib, self.policy.V, self.Qaux], feed_dict=feed_dict)
+        return self.fetch(['policy', 'value', 'pixel_control'], state)
     
     def get_pixel_control(self, state):
-        feed_dict = {self.replay_policy.state:state}
-        return self.sess.run(self.Qaux, feed_dict=feed_dict)
+        return self.fetch(['pixel_control'], state)[0]
 
     def backprop(self, states, R, actions, dones,
                     reward_states, rewards, Qaux_target, Qaux_actions, replay_states, replay_R, replay_dones):
@@ -161,6 +168,18 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
             self.state_std = np.ones_like(self.runner.states)
             self.aux_reward_rolling = RunningMeanStd()
     
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['replay'] = list(self.replay)
+        state['state_min'], state['state_max'] = self.state_min, self.state_max
+        return state
+    
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.replay.clear()
+        self.replay.extend(state['replay']) # runner shares the same deque
+        self.state_min, self.state_max = state['state_min'], state['state_max']
+
     def populate_memory(self):
         for t in range(2000//self.nsteps):
             states, *_ = self.runner.run()
@@ -222,12 +241,14 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
         #print('replay_hiddens dones shape', replay_dones.shape)
         
         next_state = self.replay[sample_start+self.nsteps][0] # get state 
-        _, replay_last_values = self.model.forward(next_state)
+        if self.model.pixel_control: # bootstrap value and pixel control from one encoder pass
+            replay_last_values, Qaux_value = self.model.fetch(['value', 'pixel_control'], next_state)
+        else:
+            replay_last_values, = self.model.fetch(['value'], next_state)
         replay_R = self.GAE(replay_rewards, replay_values, replay_last_values, replay_dones, gamma=0.99, lambda_=0.95) + replay_values
 
         if self.model.pixel_control:
             prev_states = self.replay[sample_start-1][0]
-            Qaux_value = self.model.get_pixel_control(next_state)
             pixel_rewards = self.pixel_rewards(prev_states, replay_states)
             Qaux_target = self.auxiliary_target(pixel_rewards, np.max(Qaux_value, axis=-1), replay_dones)
         else:
@@ -264,13 +285,13 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
     def _train_nstep(self):
         batch_size = self.num_envs * self.nsteps
         num_updates = self.total_steps // batch_size
-        s = 0
-        self.state_min = 0
-        self.state_max = 0
-        self.populate_memory()
+        if len(self.replay) == 0: # skipped when resuming with a restored replay and observation range
+            self.state_min = 0
+            self.state_max = 0
+            self.populate_memory()
         # main loop
         start = time.time()
-        for t in range(1,num_updates+1):
+        for t in range(self.t,num_updates+1):
             states, actions, rewards, values, dones, infos, last_values = self.runner.run()
             
             # R = self.nstep_return(rewards, last_values, dones, clip=False)
@@ -287,6 +308,7 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
             
             l = self.model.backprop(states, R, actions,  dones,
                 reward_states, sample_rewards, Qaux_target, replay_actions, replay_states, replay_R, replay_dones)
+            self.profile_update(t, t * batch_size)
             
             if self.render_freq > 0 and t % ((self.validate_freq // batch_size) * self.render_freq) == 0:
                 render = True
@@ -298,9 +320,11 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
                 start = time.time()
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0:
-                s += 1
-                self.saver.save(self.sess, str(self.model_dir + '/' + str(s) + ".ckpt") )
+                self.s += 1
+                self.save(self.s)
                 print('saved model')
+            
+            self.t += 1
 
 
     class Runner(SyncMultiEnvTrainer.Runner):
@@ -310,19 +334,17 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
             self.action_size = self.model.action_size
 
         def run(self,):
-            rollout = []
             for t in range(self.num_steps):
                 policies, values = self.model.forward(self.states)
                 #Qaux = self.model.get_pixel_control(self.states, self.prev_hidden, self.prev_actions_rewards[np.newaxis])
                 actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
                 next_states, rewards, dones, infos = self.env.step(actions)
 
-                rollout.append((self.states, actions, rewards, values, dones, infos))
+                self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, values=values, dones=dones, infos=infos)
                 self.replay.append((self.states, actions, rewards, values, dones, infos)) # add to replay memory
                 self.states = next_states
             
-            states, actions, rewards, values, dones, infos = zip(*rollout)
-            states, actions, rewards, values, dones = np.stack(states), np.stack(actions), np.stack(rewards), np.stack(values), np.stack(dones)
+            states, actions, rewards, values, dones, infos = self.rollout.get('states', 'actions', 'rewards', 'values', 'dones', 'infos')
             _, last_values = self.model.forward(next_states)
             return states, actions, rewards, values, dones, infos, last_values
 
@@ -332,6 +354,11 @@ class Unreal_Trainer(SyncMultiEnvTrainer):
         #action = np.argmax(policy)
         return action
 
+    def get_batch_actions(self, states, val_state):
+        policies, values = self.model.forward(states)
+        actions = [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+        return actions, val_state
+
     def validate(self,env,num_ep,max_steps,render=False):
         episode_scores = []
         for episode in range(num_ep):
@@ -370,7 +397,7 @@ def main(env_id, Atari=True):
     classic_list = ['MountainCar-v0', 'Acrobot-v1', 'LunarLander-v2', 'CartPole-v0', 'CartPole-v1']
     if any(env_id in s for s in classic_list):
         print('Classic Control')
-        val_envs = [gym.make(env_id) for i in range(16)]
+        val_envs = BatchEnv(DummyEnv, env_id, 16, blocking=False)
         envs = BatchEnv(DummyEnv, env_id, num_envs, blocking=False)
 
     else:
@@ -382,13 +409,13 @@ def main(env_id, Atari=True):
             reset = False
             print('only stack frames')
         
-        val_envs = [AtariEnv(gym.make(env_id), k=4, episodic=False, reset=reset, clip_reward=False) for i in range(16)]
+        val_envs = BatchEnv(AtariEnv, env_id, 16, blocking=False, k=4, episodic=False, reset=reset, clip_reward=False)
         envs = BatchEnv(AtariEnv, env_id, num_envs, blocking=False, k=4, reset=reset, episodic=False, clip_reward=True, time_limit=4500)
         
     
     env.close()
-    action_size = val_envs[0].action_space.n
-    input_size = val_envs[0].reset().shape
+    action_size = envs.action_space.n
+    input_size = envs.reset().shape[1:]
     
     
     current_time = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
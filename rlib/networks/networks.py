@@ -1,5 +1,39 @@
 import tensorflow as tf 
 import numpy as np
+import re
+import contextlib
+
+def float32_master_getter(getter, name, *args, **kwargs):
+    # half precision layers read a cast of a float32 master variable, so optimisers and checkpoints only ever see float32 weights
+    dtype = kwargs.get('dtype')
+    if dtype in (tf.float16, tf.bfloat16):
+        kwargs['dtype'] = tf.float32
+        return tf.cast(getter(name, *args, **kwargs), dtype)
+    return getter(name, *args, **kwargs)
+
+@contextlib.contextmanager
+def compute_dtype_scope(dtype):
+    ''' layers built inside with dtype=float16/bfloat16 compute in half precision on float32 master variables, no-op for float32 '''
+    if dtype == tf.float32:
+        yield
+    else:
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=float32_master_getter, auxiliary_name_scope=False):
+            yield
+
+def scaled_gradients(loss, weights, loss_scale=1.0):
+    ''' gradients of loss computed on loss * loss_scale then unscaled, static loss scaling keeps small float16 gradients from flushing to zero '''
+    if loss_scale == 1.0:
+        return tf.gradients(loss, weights)
+    grads = tf.gradients(loss * loss_scale, weights)
+    return [grad / loss_scale if grad is not None else None for grad in grads]
+
+def observation_dtype(input_shape):
+    # image observations are fed as the envs' uint8 frames and cast in-graph (the cnn builders cast and /255),
+    # a quarter of the bytes of converting them to float32 on the host every feed
+    return tf.uint8 if len(input_shape) == 3 else tf.float32
+
+def observation_placeholder(input_shape, name=None):
+    return tf.placeholder(observation_dtype(input_shape), shape=[None, *input_shape], name=name)
 
 def flatten(x, name='flatten'):
     return tf.reshape(x, [-1, np.prod(x.get_shape().as_list()[1:])], name=name)
@@ -99,8 +133,9 @@ class LSTMCell(object):
     
     def __call__(self, x, state, mask):
         prev_cell, prev_hidden = state 
-        prev_cell *= tf.stack([1-mask for i in range(self._cell_size)], axis=-1)
-        prev_hidden *= tf.stack([1-mask for i in range(self._cell_size)], axis=-1)
+        keep = tf.expand_dims(1-mask, axis=-1) # [batch, 1] broadcast over the cell
+        prev_cell *= keep
+        prev_hidden *= keep
         f = tf.nn.sigmoid(tf.matmul(x, self._Wxf) + tf.matmul(prev_hidden, self._Whf) + self._bf)
         i = tf.nn.sigmoid(tf.matmul(x, self._Wxi) + tf.matmul(prev_hidden, self._Whi) + self._bi)
         o = tf.nn.sigmoid(tf.matmul(x, self._Wxo) + tf.matmul(prev_hidden, self._Who) + self._bo)
@@ -120,6 +155,72 @@ class LSTMCell(object):
     @property
     def output_size(self):
         return self._cell_size
+
+
+class FusedLSTMCell(LSTMCell):
+    def __init__(self, cell_size, input_size=None, dtype=tf.float32, name='lstm_cell', trainable=True):
+        ''' LSTMCell with all gates computed by a single [input+hidden, 4*cell] matmul then split, 
+            gates are ordered input, forget, output, cell. Checkpoints of LSTMCell convert with convert_lstm_checkpoint
+        '''
+        self._cell_size = cell_size
+        input_size = input_size if input_size is not None else cell_size # input_size == cell_size by default 
+        self._input_size = input_size
+        with tf.variable_scope(name):
+            self._W = tf.get_variable(name=name+'_W', shape=[input_size+cell_size, 4*cell_size], dtype=dtype, trainable=trainable, initializer=_fused_gate_initialiser(input_size, cell_size))
+            self._b = tf.get_variable(name=name+'_b', shape=[4*cell_size], dtype=dtype, trainable=trainable, initializer=tf.zeros_initializer)
+    
+    def __call__(self, x, state, mask):
+        prev_cell, prev_hidden = state 
+        keep = tf.expand_dims(1-mask, axis=-1) # [batch, 1] broadcast over the cell
+        prev_cell *= keep
+        prev_hidden *= keep
+        gates = tf.nn.bias_add(tf.matmul(tf.concat([x, prev_hidden], axis=1), self._W), self._b)
+        i, f, o, c = tf.split(gates, 4, axis=1)
+        cell = prev_cell * tf.nn.sigmoid(f) + tf.nn.sigmoid(i) * tf.math.tanh(c)
+        hidden = tf.nn.sigmoid(o) * tf.math.tanh(cell)
+        return hidden, tf.nn.rnn_cell.LSTMStateTuple(cell, hidden)
+
+def _fused_gate_initialiser(input_size, cell_size):
+    # glorot uniform per gate block as LSTMCell, rather than over the whole fused matrix which would shrink the initial weights
+    def _initialiser(shape, dtype=tf.float32, partition_info=None):
+        glorot = tf.glorot_uniform_initializer(dtype=dtype)
+        gates = [tf.concat([glorot([input_size, cell_size]), glorot([cell_size, cell_size])], axis=0) for gate in range(4)]
+        return tf.concat(gates, axis=1)
+    return _initialiser
+
+def convert_lstm_checkpoint(checkpoint, output_checkpoint):
+    ''' rewrite a checkpoint's LSTMCell variables (and their optimiser slots) as FusedLSTMCell variables, all other variables are copied
+        e.g. convert_lstm_checkpoint('models/A2C_LSTM/.../3.ckpt', 'models/A2C_LSTM/.../fused/3.ckpt')
+    '''
+    gates = ['i', 'f', 'o', 'c']
+    reader = tf.train.load_checkpoint(checkpoint)
+    values = {name:reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+    lstm = re.compile(r'^(.*)_(Wx|Wh|b)([ifoc])(/.*)?$') # e.g. ActorCritic/lstm/lstm_cell/lstm_cell_Wxi/RMSProp
+    converted, fused = {}, {}
+    for name, value in values.items():
+        match = lstm.match(name)
+        if match is None:
+            converted[name] = value
+        else:
+            prefix, kind, gate, slot = match.groups()
+            fused.setdefault((prefix, slot or ''), {})[kind + gate] = (name, value)
+    
+    for (prefix, slot), parts in list(fused.items()):
+        if len(parts) != 12: # not a complete LSTMCell, copy unchanged
+            converted.update(dict(parts.values()))
+            del fused[(prefix, slot)]
+            continue
+        parts = {key:value for key, (name, value) in parts.items()}
+        converted[prefix + '_W' + slot] = np.concatenate([np.concatenate([parts['Wx'+g], parts['Wh'+g]], axis=0) for g in gates], axis=1)
+        converted[prefix + '_b' + slot] = np.concatenate([parts['b'+g] for g in gates], axis=0)
+    
+    with tf.Graph().as_default():
+        variables = [tf.Variable(value, name=name) for name, value in converted.items()]
+        saver = tf.train.Saver(variables)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            saver.save(sess, output_checkpoint, write_meta_graph=False)
+    print('converted %i lstm cells, %i variables written to %s' %(len([k for k in fused if k[1] == '']), len(converted), output_checkpoint))
         
 
 
@@ -206,31 +307,38 @@ def one_to_many_rnn(cell, X, hidden_init, num_timesteps, parallel_iterations=32,
     return stacked_output, hidden
 
 
-def universe_cnn(input, conv_size=32, trainable=True):
-    x = input / 255
-    h1 = conv2d(x , conv_size, [3,3], [2,2], padding='SAME', name='conv_1', activation=tf.nn.elu, trainable=trainable)
-    h2 = conv2d(h1, conv_size, [3,3], [2,2], padding='SAME', name='conv_2', activation=tf.nn.elu, trainable=trainable)
-    h3 = conv2d(h2, conv_size, [3,3], [2,2], padding='SAME', name='conv_3', activation=tf.nn.elu, trainable=trainable)
-    h4 = conv2d(h3, conv_size, [3,3], [2,2], padding='SAME', name='conv_4', activation=tf.nn.elu, trainable=trainable)
-    fc = flatten(h4)
-    return fc
-
-def nips_cnn(input, conv1_size=16 ,conv2_size=32, dense_size=256, padding='VALID'):
-    x = input/255
-    h1 = conv2d(x,  output_channels=conv1_size, kernel_size=[8,8], strides=[4,4], padding=padding, activation=tf.nn.relu, dtype=tf.float32, name='conv_1')
-    h2 = conv2d(h1, output_channels=conv2_size, kernel_size=[4,4], strides=[2,2], padding=padding, activation=tf.nn.relu, dtype=tf.float32, name='conv_2')
-    fc = flatten(h2)
-    dense = mlp_layer(fc, dense_size, activation=tf.nn.relu)
-    return dense
-
-def nature_cnn(input, conv1_size=32 ,conv2_size=64, conv3_size=64, dense_size=512, padding='VALID', conv_activation=tf.nn.relu, dense_activation=tf.nn.relu, weight_initialiser=tf.initializers.glorot_uniform, scale=True, trainable=True):
-    x = input/255 if scale else input
-    h1 = conv2d(x,  output_channels=conv1_size, kernel_size=[8,8],  strides=[4,4], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=tf.float32, name='conv_1', trainable=trainable)
-    h2 = conv2d(h1, output_channels=conv2_size, kernel_size=[4,4],  strides=[2,2], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=tf.float32, name='conv_2', trainable=trainable)
-    h3 = conv2d(h2, output_channels=conv3_size, kernel_size=[3,3],  strides=[1,1], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=tf.float32, name='conv_3', trainable=trainable)
-    fc = flatten(h3)
-    dense = mlp_layer(fc, dense_size, activation=dense_activation, weight_initialiser=weight_initialiser, trainable=trainable)
-    return dense
+# cnn and mlp builders take dtype=tf.float16/tf.bfloat16 for mixed precision, computing in half precision on float32 master weights
+# (see compute_dtype_scope) and returning float32 features so heads, losses and optimisers stay float32
+
+def universe_cnn(input, conv_size=32, trainable=True, dtype=tf.float32):
+    with compute_dtype_scope(dtype):
+        x = tf.cast(input, dtype) / 255
+        h1 = conv2d(x , conv_size, [3,3], [2,2], padding='SAME', name='conv_1', activation=tf.nn.elu, dtype=dtype, trainable=trainable)
+        h2 = conv2d(h1, conv_size, [3,3], [2,2], padding='SAME', name='conv_2', activation=tf.nn.elu, dtype=dtype, trainable=trainable)
+        h3 = conv2d(h2, conv_size, [3,3], [2,2], padding='SAME', name='conv_3', activation=tf.nn.elu, dtype=dtype, trainable=trainable)
+        h4 = conv2d(h3, conv_size, [3,3], [2,2], padding='SAME', name='conv_4', activation=tf.nn.elu, dtype=dtype, trainable=trainable)
+        fc = flatten(h4)
+    return tf.cast(fc, tf.float32)
+
+def nips_cnn(input, conv1_size=16 ,conv2_size=32, dense_size=256, padding='VALID', dtype=tf.float32):
+    with compute_dtype_scope(dtype):
+        x = tf.cast(input, dtype)/255
+        h1 = conv2d(x,  output_channels=conv1_size, kernel_size=[8,8], strides=[4,4], padding=padding, activation=tf.nn.relu, dtype=dtype, name='conv_1')
+        h2 = conv2d(h1, output_channels=conv2_size, kernel_size=[4,4], strides=[2,2], padding=padding, activation=tf.nn.relu, dtype=dtype, name='conv_2')
+        fc = flatten(h2)
+        dense = mlp_layer(fc, dense_size, activation=tf.nn.relu, dtype=dtype)
+    return tf.cast(dense, tf.float32)
+
+def nature_cnn(input, conv1_size=32 ,conv2_size=64, conv3_size=64, dense_size=512, padding='VALID', conv_activation=tf.nn.relu, dense_activation=tf.nn.relu, weight_initialiser=tf.initializers.glorot_uniform, scale=True, trainable=True, dtype=tf.float32):
+    with compute_dtype_scope(dtype):
+        x = tf.cast(input, dtype)
+        x = x/255 if scale else x
+        h1 = conv2d(x,  output_channels=conv1_size, kernel_size=[8,8],  strides=[4,4], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=dtype, name='conv_1', trainable=trainable)
+        h2 = conv2d(h1, output_channels=conv2_size, kernel_size=[4,4],  strides=[2,2], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=dtype, name='conv_2', trainable=trainable)
+        h3 = conv2d(h2, output_channels=conv3_size, kernel_size=[3,3],  strides=[1,1], padding=padding, activation=conv_activation, kernel_initialiser=weight_initialiser, dtype=dtype, name='conv_3', trainable=trainable)
+        fc = flatten(h3)
+        dense = mlp_layer(fc, dense_size, activation=dense_activation, weight_initialiser=weight_initialiser, dtype=dtype, trainable=trainable)
+    return tf.cast(dense, tf.float32)
 
 def nature_deconv(input):
     feat_map = mlp_layer(input, 7*7*64, activation=tf.nn.relu, name='featmap1')
@@ -241,10 +349,12 @@ def nature_deconv(input):
     deconv3 = conv_transpose_layer(deconv2, output_shape=[batch_size,84,84,4], kernel_size=[8,8], strides=[4,4], padding='VALID', activation=tf.nn.relu, name='deconv3')
     return deconv3
 
-def mlp(x, num_layers=2, dense_size=64, activation=tf.nn.relu, weight_initialiser=tf.glorot_uniform_initializer, bias_initialiser=tf.zeros_initializer, trainable=True):
-    for i in range(num_layers):
-        x = mlp_layer(x, dense_size, activation=activation, weight_initialiser=weight_initialiser, bias_initialiser=bias_initialiser, name='dense_' + str(i), trainable=trainable)
-    return x
+def mlp(x, num_layers=2, dense_size=64, activation=tf.nn.relu, weight_initialiser=tf.glorot_uniform_initializer, bias_initialiser=tf.zeros_initializer, trainable=True, dtype=tf.float32):
+    with compute_dtype_scope(dtype):
+        x = tf.cast(x, dtype)
+        for i in range(num_layers):
+            x = mlp_layer(x, dense_size, activation=activation, weight_initialiser=weight_initialiser, bias_initialiser=bias_initialiser, dtype=dtype, name='dense_' + str(i), trainable=trainable)
+    return tf.cast(x, tf.float32)
 
 def lstm(input, cell_size=256, fold_output=True, time_major=True):
     hidden_in = tf.placeholder(tf.float32, [None, cell_size], name='hidden_in')
@@ -260,14 +370,23 @@ def lstm(input, cell_size=256, fold_output=True, time_major=True):
     return lstm_output, hidden_tuple, hidden_out
 
 
-def lstm_masked(input, cell_size, batch_size, fold_output=True, time_major=True, parallel_iterations=32, swap_memory=False, trainable=True):
-    hidden_in = tf.placeholder(tf.float32, [None, cell_size], name='hidden_in')
-    cell_in = tf.placeholder(tf.float32, [None, cell_size], name='cell_in')
+def lstm_masked(input, cell_size, batch_size=None, fold_output=True, time_major=True, parallel_iterations=32, swap_memory=False, trainable=True, fused=False):
+    ''' masked lstm over input of rank [time, batch, features] or folded [time*batch, features],
+        folded input is unfolded with the batch size of the fed hidden state so one graph serves any number of envs
+        args :
+            batch_size - static batch size of the mask, None (default) for any batch size
+            fused - FusedLSTMCell instead of LSTMCell, their checkpoints are not interchangeable, LSTMCell checkpoints convert with convert_lstm_checkpoint
+    '''
+    hidden_in = tf.placeholder(tf.float32, [batch_size, cell_size], name='hidden_in')
+    cell_in = tf.placeholder(tf.float32, [batch_size, cell_size], name='cell_in')
     mask = tf.placeholder(shape=[None, batch_size], dtype=tf.float32, name='mask') # hidden state mask
     hidden_tuple = (cell_in, hidden_in)
     
     input_size = input.get_shape()[-1].value
-    lstm_cell = LSTMCell(cell_size, input_size, trainable=trainable)
+    if input.get_shape().ndims == 2:
+        batch = tf.shape(hidden_in)[0]
+        input = tf.reshape(input, shape=[-1, batch, input_size] if time_major else [batch, -1, input_size], name='unfolded_input')
+    lstm_cell = FusedLSTMCell(cell_size, input_size, trainable=trainable) if fused else LSTMCell(cell_size, input_size, trainable=trainable)
     state_in = tf.nn.rnn_cell.LSTMStateTuple(cell_in, hidden_in)
 
     lstm_output, hidden_out = dynamic_masked_rnn(lstm_cell, input, hidden_init=state_in, mask=mask, time_major=time_major,
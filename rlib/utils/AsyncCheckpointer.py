@@ -0,0 +1,125 @@
+import time, os, json, pickle, glob
+import threading, queue
+import numpy as np
+import tensorflow as tf
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, sess, model_dir, var_list=None, keep_last=5, verbose=True):
+        '''
+            Non-blocking checkpoint writer, variables are copied to host memory on the training thread
+            and serialised to disk from a background thread
+
+            Args:
+                sess - training session
+                model_dir - directory checkpoints are written to, files are named <s>.ckpt.*, <s>.trainer and <s>.state
+                var_list - variables to checkpoint, defaults to all global variables (weights, optimiser slots, global steps)
+                keep_last - number of most recent checkpoints to keep on disk, 0 to keep all
+                verbose - boolean flag whether to print the latency of each checkpoint
+        '''
+        self.sess = sess
+        self.model_dir = model_dir
+        self.variables = var_list if var_list is not None else tf.global_variables()
+        self.keep_last = keep_last
+        self.verbose = verbose
+        self.tmp_dir = os.path.join(model_dir, '.tmp')
+        self.saved = []
+        self.snapshot_times, self.write_times = [], []
+        self.error = None
+
+        # host side copy of the variables in a separate graph so writing never touches the training session
+        # variables share the training names so checkpoints restore with the trainer's own tf.train.Saver
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in self.variables]
+            host_vars = [tf.Variable(ph, name=var.op.name, trainable=False) for var, ph in zip(self.variables, self.placeholders)]
+            self.init = tf.variables_initializer(host_vars)
+            self.saver = tf.train.Saver(host_vars, max_to_keep=None)
+        self.write_sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count = {'GPU': 0}))
+
+        self.pending = queue.Queue(maxsize=1) # bound host memory to one snapshot waiting behind the one being written
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+        self.open = True
+
+    def __del__(self):
+        self.close()
+
+    def save(self, s, trainer_attrs=None, state=None):
+        ''' snapshot variables and queue checkpoint s to be written,
+            trainer_attrs - json serialisable dict of trainer attributes
+            state - optional picklable object e.g. replay memory or normaliser statistics
+        '''
+        if self.error is not None:
+            raise self.error
+        start = time.time()
+        values = self.sess.run(self.variables)
+        snapshot_time = time.time() - start
+        self.snapshot_times.append(snapshot_time)
+        self.pending.put((s, values, trainer_attrs, state, snapshot_time)) # blocks only if the writer is two checkpoints behind
+
+    def flush(self):
+        # wait for all queued checkpoints to be written
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.pending.put(None)
+            self.thread.join()
+            self.write_sess.close()
+
+    def latency_report(self):
+        ''' mean and max time training was stalled taking snapshots and time taken writing them in the background '''
+        report = {'checkpoints':len(self.snapshot_times)}
+        for key, times in (('snapshot', self.snapshot_times), ('write', self.write_times)):
+            report[key + '_mean'] = np.mean(times) if len(times) > 0 else 0.0
+            report[key + '_max'] = np.max(times) if len(times) > 0 else 0.0
+        return report
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e: # surfaced on the training thread at the next save or flush
+                self.error = e
+            self.pending.task_done()
+
+    def _write(self, s, values, trainer_attrs, state, snapshot_time):
+        start = time.time()
+        if not os.path.exists(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        # write everything into a temporary directory then rename into model_dir,
+        # the .index file is moved last so a checkpoint is never visible half written
+        self.write_sess.run(self.init, feed_dict={ph:value for ph, value in zip(self.placeholders, values)})
+        self.saver.save(self.write_sess, os.path.join(self.tmp_dir, str(s) + '.ckpt'), write_meta_graph=False, write_state=False)
+        if trainer_attrs is not None:
+            with open(os.path.join(self.tmp_dir, str(s) + '.trainer'), 'w') as file:
+                json.dump(trainer_attrs, file)
+        if state is not None:
+            with open(os.path.join(self.tmp_dir, str(s) + '.state'), 'wb') as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        files = sorted(os.listdir(self.tmp_dir), key=lambda f: f.endswith('.index'))
+        for f in files:
+            os.replace(os.path.join(self.tmp_dir, f), os.path.join(self.model_dir, f))
+
+        self.saved.append(s)
+        if self.keep_last > 0:
+            for old in self.saved[:-self.keep_last]:
+                for f in glob.glob(os.path.join(self.model_dir, str(old) + '.*')):
+                    os.remove(f)
+            self.saved = self.saved[-self.keep_last:]
+        tf.train.update_checkpoint_state(self.model_dir, os.path.join(self.model_dir, str(s) + '.ckpt'),
+                                         all_model_checkpoint_paths=[os.path.join(self.model_dir, str(i) + '.ckpt') for i in self.saved])
+
+        write_time = time.time() - start
+        self.write_times.append(write_time)
+        if self.verbose:
+            print('checkpoint %i, training stalled for %fs, written in background in %fs' %(s, snapshot_time, write_time))
@@ -0,0 +1,128 @@
+import time, queue
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+from rlib.utils.SyncMultiEnvTrainer import validation_episodes
+
+
+def sample_policy(model, states):
+    # stochastic actions from models whose forward returns the policy first e.g. ActorCritic, PPO, RND
+    policies = model.forward(states)[0]
+    return [np.random.choice(policies.shape[1], p=policies[i]) for i in range(policies.shape[0])]
+
+def greedy_q(model, states, epsilon=0.01):
+    # epsilon greedy actions from Q value models e.g. DQN
+    Q = model.forward(states)
+    actions = np.argmax(Q, axis=1)
+    explore = np.random.uniform(size=len(actions)) < epsilon
+    actions[explore] = np.random.randint(Q.shape[1], size=explore.sum())
+    return actions
+
+
+class AsyncEvaluator(object):
+    def __init__(self, model_fn, env_fns, num_episodes=50, max_steps=10000, policy_fn=sample_policy, log_dir=None, start_method='spawn', gpu=False):
+        '''
+            Evaluates parameter snapshots of a feedforward model in a separate process so validation does not block training
+
+            Args:
+                model_fn - picklable callable building the model in the evaluator's graph e.g. functools.partial(ActorCritic, nature_cnn, input_size, action_size)
+                env_fns - list of picklable callables building the validation envs e.g. [EnvConstructor(AtariEnv, env_id, k=4) for i in range(16)]
+                num_episodes - number of episodes to average over per snapshot
+                max_steps - maximum number of steps per episode
+                policy_fn - picklable function(model, states) returning a batch of actions
+                log_dir - directory to write tensorboard scalars to, None for printing only
+                start_method - multiprocessing start method, 'spawn' as tensorflow is not fork safe
+                gpu - boolean flag whether the evaluator may use the GPU
+        '''
+        self.num_episodes = num_episodes
+        self.variables = None
+        ctx = mp.get_context(start_method)
+        self.snapshots = ctx.Queue(maxsize=2)
+        worker = AsyncEvaluator.Worker(model_fn, env_fns, self.snapshots, num_episodes, max_steps, policy_fn, log_dir, gpu)
+        self.worker = ctx.Process(target=worker.run, daemon=True)
+        self.worker.start()
+        self.open = True
+
+    def __del__(self):
+        self.close()
+
+    def set_variables(self, variables):
+        # trainer variables to snapshot, matched to the evaluator's variables by name
+        self.variables = variables
+
+    def submit(self, sess, tot_steps):
+        ''' copy current parameters to host memory and queue them for evaluation at tot_steps, returns False if the evaluator is busy '''
+        if self.variables is None:
+            self.variables = tf.trainable_variables()
+        values = sess.run(self.variables)
+        weights = {var.name:value for var, value in zip(self.variables, values)}
+        try:
+            self.snapshots.put_nowait((tot_steps, weights))
+            return True
+        except queue.Full:
+            print('evaluator busy, skipping snapshot at total steps %i' %(tot_steps))
+            return False
+
+    def close(self):
+        # finish any queued evaluations before shutting down
+        if self.open:
+            self.open = False
+            self.snapshots.put(None)
+            self.worker.join()
+
+
+    class Worker(object):
+        def __init__(self, model_fn, env_fns, snapshots, num_episodes, max_steps, policy_fn, log_dir, gpu):
+            self.model_fn = model_fn
+            self.env_fns = env_fns
+            self.snapshots = snapshots
+            self.num_episodes = num_episodes
+            self.max_steps = max_steps
+            self.policy_fn = policy_fn
+            self.log_dir = log_dir
+            self.gpu = gpu
+
+        def run(self):
+            model = self.model_fn()
+            # assign ops for loading snapshots, built once before the graph is used
+            placeholders, assign_ops = {}, {}
+            for var in tf.global_variables():
+                placeholders[var.name] = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                assign_ops[var.name] = var.assign(placeholders[var.name])
+
+            config = tf.ConfigProto() if self.gpu else tf.ConfigProto(device_count = {'GPU': 0})
+            sess = tf.Session(config=config)
+            model.set_session(sess)
+            sess.run(tf.global_variables_initializer())
+            writer = tf.summary.FileWriter(self.log_dir) if self.log_dir is not None else None
+            envs = [env_fn() for env_fn in self.env_fns]
+
+            while True:
+                snapshot = self.snapshots.get()
+                if snapshot is None:
+                    break
+                tot_steps, weights = snapshot
+                names = [name for name in weights if name in assign_ops]
+                sess.run([assign_ops[name] for name in names], feed_dict={placeholders[name]:weights[name] for name in names})
+
+                start = time.time()
+                scores = self.evaluate(model, envs)
+                score = np.mean(scores)
+                print("evaluator, total steps %i, validation score %f, time taken for %i episodes:%fs" %(tot_steps,score,len(scores),time.time()-start))
+                if writer is not None:
+                    summary = tf.Summary(value=[tf.Summary.Value(tag='episode_reward', simple_value=score)])
+                    writer.add_summary(summary, tot_steps)
+                    writer.flush()
+
+            for env in envs:
+                env.close()
+            if writer is not None:
+                writer.close()
+            sess.close()
+
+        def evaluate(self, model, envs):
+            # episodes split evenly across envs
+            num_envs = len(envs)
+            num_eps = [self.num_episodes//num_envs for i in range(num_envs)]
+            num_eps[-1] += self.num_episodes % num_envs
+            return validation_episodes(envs, num_eps, self.max_steps, lambda states, val_state: (self.policy_fn(model, states), val_state))
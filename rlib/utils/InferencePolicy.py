@@ -0,0 +1,119 @@
+import os, json
+import numpy as np
+import tensorflow as tf
+
+
+def export_inference_graph(sess, model, filename, optimise=True):
+    '''
+        Freeze the policy/value subgraph of a model into a constant, pruned GraphDef for fast actors,
+        optimiser slots, losses, rollout storage and target networks are stripped
+        e.g.
+            export_inference_graph(trainer.sess, trainer.model, 'models/PPO/inference.pb')
+            policy = InferencePolicy('models/PPO/inference.pb')
+
+        Args:
+            sess - session holding the trained variables
+            model - model implementing inference_tensors() -> (inputs, outputs) dicts of name -> tensor
+                    e.g. ActorCritic, PPO, RND, DQN, A2C_LSTM, UnrealA2C
+            filename - path of the frozen .pb, input/output names are written alongside as filename.json
+            optimise - constant fold and strip identity/training nodes with the graph transform tool
+    '''
+    inputs, outputs = model.inference_tensors()
+    input_nodes = [tensor.op.name for tensor in inputs.values()]
+    output_nodes = [tensor.op.name for tensor in outputs.values()]
+
+    graph_def = sess.graph.as_graph_def()
+    for node in graph_def.node:
+        if node.name in input_nodes and node.op == 'PlaceholderWithDefault':
+            # cut off the default (e.g. in-graph minibatches) so the rollout storage is pruned, inputs must be fed
+            node.op = 'Placeholder'
+            del node.input[:]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, output_nodes)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_nodes + output_nodes)
+    if optimise:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                                   ['remove_device', 'fold_constants(ignore_errors=true)', 'fold_batch_norms', 'sort_by_execution_order'])
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with tf.gfile.GFile(filename, 'wb') as file:
+        file.write(graph_def.SerializeToString())
+    with open(filename + '.json', 'w') as file:
+        json.dump({'inputs':{name:tensor.name for name, tensor in inputs.items()},
+                   'outputs':{name:tensor.name for name, tensor in outputs.items()}}, file, indent=4)
+    print('exported %i node inference graph to %s' %(len(graph_def.node), filename))
+    return filename
+
+
+class InferencePolicy(object):
+    def __init__(self, filename, num_threads=1, use_gpu=False):
+        '''
+            Loads a graph written by export_inference_graph into its own graph and session without building the model or trainer,
+            forward feeds and fetches through a session callable so per step overhead is minimal
+
+            Args:
+                filename - frozen .pb path, names are read from filename.json
+                num_threads - intra/inter op threads, 1 lets many actors share a machine
+                use_gpu - allow placing the graph on GPU, CPU only by default
+        '''
+        with open(filename + '.json', 'r') as file:
+            names = json.load(file)
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(filename, 'rb') as file:
+            graph_def.ParseFromString(file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.inputs = {name:self.graph.get_tensor_by_name(tensor) for name, tensor in names['inputs'].items()}
+        self.outputs = {name:self.graph.get_tensor_by_name(tensor) for name, tensor in names['outputs'].items()}
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=num_threads,
+                                device_count={} if use_gpu else {'GPU':0})
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self._forward = self.sess.make_callable(list(self.outputs.values()), feed_list=list(self.inputs.values()))
+
+    def forward(self, *inputs):
+        ''' inputs in exported order (see self.inputs) e.g. state or state, cell, hidden, mask, returns outputs in exported order '''
+        return self._forward(*inputs)
+
+    def run(self, **inputs):
+        ''' feed by input name, returns dict of output name -> value '''
+        values = self.forward(*[inputs[name] for name in self.inputs])
+        return dict(zip(self.outputs, values))
+
+    def get_action(self, state, greedy=False):
+        ''' actions for a batch of states of a feedforward policy ('policy' output) or Q network ('Q' output) '''
+        outputs = self.run(state=state)
+        if 'Q' in outputs:
+            return np.argmax(outputs['Q'], axis=-1)
+        policies = outputs['policy']
+        if greedy:
+            return np.argmax(policies, axis=-1)
+        return np.array([np.random.choice(policies.shape[1], p=policy / policy.sum()) for policy in policies])
+
+    def validate(self, env, num_ep, max_steps, render=False, greedy=False):
+        ''' play num_ep episodes of a single env, returns the episode scores '''
+        episode_scores = []
+        for episode in range(num_ep):
+            state = env.reset()
+            episode_score = 0
+            for t in range(max_steps):
+                action = int(self.get_action(state[np.newaxis], greedy)[0])
+                state, reward, done, info = env.step(action)
+                episode_score += reward
+                if render:
+                    env.render()
+                if done:
+                    break
+            episode_scores.append(episode_score)
+            print('episode %i score %f' %(episode, episode_score))
+        if render:
+            env.close()
+        return episode_scores
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,140 @@
+import numpy as np
+import tensorflow as tf
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def _matmul(op):
+    transpose_a, transpose_b = op.get_attr('transpose_a'), op.get_attr('transpose_b')
+    return lambda a, b: np.dot(a.T if transpose_a else a, b.T if transpose_b else b)
+
+def _leaky_relu(op):
+    alpha = op.get_attr('alpha')
+    return lambda x: np.where(x > 0, x, alpha * x)
+
+def _cast(op):
+    dtype = op.get_attr('DstT').as_numpy_dtype
+    return lambda x: x.astype(dtype)
+
+# numpy implementation of each op type used by mlp_layer networks and their heads, built from the tf op's attributes
+_NUMPY_OPS = {'MatMul':_matmul,
+              'Add':lambda op: np.add, 'AddV2':lambda op: np.add, 'BiasAdd':lambda op: np.add,
+              'Sub':lambda op: np.subtract, 'Mul':lambda op: np.multiply, 'RealDiv':lambda op: np.divide,
+              'Maximum':lambda op: np.maximum, 'Minimum':lambda op: np.minimum,
+              'Relu':lambda op: lambda x: np.maximum(x, 0), 'Relu6':lambda op: lambda x: np.clip(x, 0, 6),
+              'Tanh':lambda op: np.tanh, 'Sigmoid':lambda op: lambda x: 1 / (1 + np.exp(-x)),
+              'Elu':lambda op: lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))), 'LeakyRelu':_leaky_relu,
+              'Softmax':lambda op: _softmax, 'Reshape':lambda op: lambda x, shape: x.reshape(shape), 'Cast':_cast,
+              'Identity':lambda op: lambda x: x, 'StopGradient':lambda op: lambda x: x}
+
+
+class NumpyMLP(object):
+    def __init__(self, model, sess=None):
+        '''
+            NumPy/BLAS mirror of a model's forward pass for small mlp_layer networks (e.g. ActorCritic, PPO, DQN with the mlp model head),
+            where a session round trip per step costs far more than the math. Weights are copied out with a single sess.run by sync(),
+            which is done after every backprop (including backprop_epochs and backprop_staged), every other attribute (set_session ...) is the wrapped model's.
+            Staged forwards of a model with staged_feeding are served by NumPy from the states given to stage_forward
+            e.g.
+                trainer.use_numpy_forward() # runner and validation forwards served by NumPy
+
+            Args:
+                model - model implementing inference_tensors() (see rlib.utils.InferencePolicy)
+                sess - session holding the weights, defaults to the model's session
+        '''
+        self.model = model
+        self.sess = sess if sess is not None else model.sess
+        self.staged_state = None # states of the next forward_staged
+        inputs, outputs = model.inference_tensors()
+        if list(inputs) != ['state']:
+            raise ValueError('NumpyMLP mirrors feedforward models with a single state input, got inputs %s' %(list(inputs)))
+        self.state = inputs['state']
+        self.output_names = list(outputs)
+
+        # compile the ops between the state and the outputs into a flat list of numpy steps over value slots
+        self.slots = {}
+        self.values = []
+        self.steps = []
+        self.weight_slots, self.weights = [], []
+        self.output_slots = [self._compile(tensor) for tensor in outputs.values()]
+        self.state_slot = self.slots[self.state]
+        self.sync()
+
+    def _new_slot(self, tensor, value=None):
+        self.slots[tensor] = len(self.values)
+        self.values.append(value)
+        return self.slots[tensor]
+
+    def _compile(self, tensor):
+        if tensor in self.slots:
+            return self.slots[tensor]
+        op = tensor.op
+        if tensor is self.state:
+            return self._new_slot(tensor)
+        if op.type == 'Const':
+            return self._new_slot(tensor, tf.make_ndarray(op.get_attr('value')))
+        if op.type == 'ReadVariableOp' or (op.type == 'Identity' and op.inputs[0].op.type in ('VariableV2', 'Variable')):
+            slot = self._new_slot(tensor)
+            self.weight_slots.append(slot)
+            self.weights.append(tensor)
+            return slot
+        if op.type not in _NUMPY_OPS:
+            raise ValueError('%s (%s) has no NumPy implementation, NumpyMLP only mirrors mlp_layer networks' %(op.name, op.type))
+        input_slots = [self._compile(x) for x in op.inputs]
+        fn = _NUMPY_OPS[op.type](op)
+        slot = self._new_slot(tensor)
+        self.steps.append((fn, input_slots, slot))
+        return slot
+
+    def sync(self):
+        ''' copy the current weights out of the session with a single fetch '''
+        for slot, value in zip(self.weight_slots, self.sess.run(self.weights)):
+            self.values[slot] = value
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def run(self, state):
+        values = list(self.values) # per call copy so threaded validation can forward concurrently
+        values[self.state_slot] = np.asarray(state, dtype=self.state.dtype.as_numpy_dtype)
+        for fn, input_slots, slot in self.steps:
+            values[slot] = fn(*[values[i] for i in input_slots])
+        return [values[slot] for slot in self.output_slots]
+
+    def forward(self, state):
+        outputs = self.run(state)
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def get_policy(self, state):
+        return self.run(state)[self.output_names.index('policy')]
+
+    def get_value(self, state):
+        return self.run(state)[self.output_names.index('value')]
+
+    def backprop(self, *args, **kwargs):
+        l = self.model.backprop(*args, **kwargs)
+        self.sync()
+        return l
+
+    def backprop_epochs(self, *args, **kwargs):
+        l = self.model.backprop_epochs(*args, **kwargs)
+        self.sync()
+        return l
+
+    def backprop_staged(self, *args, **kwargs):
+        l = self.model.backprop_staged(*args, **kwargs)
+        self.sync()
+        return l
+
+    def stage_forward(self, state):
+        # nothing is staged in the graph, forward_staged runs the NumPy forward on the kept states
+        self.staged_state = state
+
+    def forward_staged(self):
+        return self.forward(self.staged_state)
+
+    def set_session(self, sess):
+        self.model.set_session(sess)
+        self.sess = sess
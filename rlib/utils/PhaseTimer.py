@@ -0,0 +1,96 @@
+import time, json, os, threading
+from collections import defaultdict
+import numpy as np
+import tensorflow as tf
+
+
+class _NullPhase(object):
+    # shared no-op context returned when profiling is disabled
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'start')
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class PhaseTimer(object):
+    def __init__(self, enabled=False, log_freq=100, max_trace_events=1000000):
+        '''
+            Lightweight per-phase timer for the training loop e.g.
+                with self.timer.phase('env_step'):
+                    next_states, rewards, dones, infos = self.env.step(actions)
+
+            Args:
+                enabled - boolean flag, when False phase() returns a shared no-op context
+                log_freq - number of updates per aggregated histogram written to tensorboard
+                max_trace_events - maximum number of events kept for chrome trace export, 0 for no tracing
+        '''
+        self.enabled = enabled
+        self.log_freq = log_freq
+        self.max_trace_events = max_trace_events
+        self.durations = defaultdict(list)
+        self.trace_events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name)
+
+    def record(self, name, start, end):
+        self.durations[name].append(end - start)
+        if len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append({'name':name, 'ph':'X', 'pid':self.pid, 'tid':threading.get_ident(),
+                                      'ts':(start - self.origin) * 1e6, 'dur':(end - start) * 1e6})
+
+    def end_update(self, t, writer=None, step=None):
+        ''' call once per update, every log_freq updates the phase histograms are written to writer at step (defaults to t) and reset '''
+        if not self.enabled or t % self.log_freq != 0:
+            return None
+        summary = self.summary()
+        if writer is not None:
+            values = []
+            for name, durations in self.durations.items():
+                durations = np.array(durations) * 1000 # ms
+                values.append(tf.Summary.Value(tag='profile/' + name, histo=self._histogram(durations)))
+                values.append(tf.Summary.Value(tag='profile/' + name + '_total_ms', simple_value=durations.sum() / self.log_freq))
+            writer.add_summary(tf.Summary(value=values), step if step is not None else t)
+        self.durations = defaultdict(list)
+        return summary
+
+    def summary(self):
+        # mean ms per call, calls and total ms for each phase since the last reset
+        return {name:(np.mean(d) * 1000, len(d), np.sum(d) * 1000) for name, d in self.durations.items()}
+
+    def print_summary(self):
+        total = sum(s[2] for s in self.summary().values())
+        for name, (mean, calls, tot) in sorted(self.summary().items(), key=lambda x: -x[1][2]):
+            print('%-16s %8.3fms x %6i = %10.1fms %5.1f%%' %(name, mean, calls, tot, 100 * tot / max(total, 1e-9)))
+
+    def export_chrome_trace(self, filename):
+        ''' write recorded phases as chrome trace json, viewable in chrome://tracing or perfetto '''
+        with open(filename, 'w') as file:
+            json.dump({'traceEvents':self.trace_events, 'displayTimeUnit':'ms'}, file)
+
+    @staticmethod
+    def _histogram(values, bins=30):
+        counts, edges = np.histogram(values, bins=bins)
+        return tf.HistogramProto(min=float(values.min()), max=float(values.max()), num=len(values), sum=float(values.sum()),
+                                 sum_squares=float(np.sum(values**2)), bucket_limit=edges[1:].tolist(), bucket=counts.tolist())
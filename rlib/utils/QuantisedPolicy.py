@@ -0,0 +1,156 @@
+import time, json
+import numpy as np
+import tensorflow as tf
+from rlib.utils.InferencePolicy import InferencePolicy
+
+
+def record_observations(env, num_steps, policy=None):
+    ''' states visited by policy (an InferencePolicy, random actions if None) over num_steps of a single env, used for calibration '''
+    states = []
+    state = env.reset()
+    for t in range(num_steps):
+        states.append(state)
+        if policy is None:
+            action = env.action_space.sample()
+        else:
+            action = int(policy.get_action(state[np.newaxis])[0])
+        state, reward, done, info = env.step(action)
+        if done:
+            state = env.reset()
+    return np.stack(states)
+
+def quantise_policy(frozen_graph, filename, calibration_states, mode='int8', num_calibration=500):
+    '''
+        Post-training quantisation of a feedforward policy exported by export_inference_graph (nature_cnn, nips_cnn, universe_cnn, mlp heads)
+        into a TFLite model for CPU actors, recurrent policies are not supported as the masked lstm while loop does not convert
+
+        Args:
+            frozen_graph - .pb written by export_inference_graph
+            filename - path of the .tflite model, input/output names are written alongside as filename.json
+            calibration_states - recorded observations [N, *input_shape] (see record_observations),
+                                 used for the int8 activation ranges, so should cover the states the actors will see
+            mode - 'int8' weights and activations, 'dynamic' int8 weights with float activations, 'float16' half precision weights
+            num_calibration - number of calibration states run through the float model
+    '''
+    with open(frozen_graph + '.json', 'r') as file:
+        names = json.load(file)
+    if list(names['inputs']) != ['state']:
+        raise ValueError('only feedforward policies with a single state input can be quantised, got inputs %s' %(list(names['inputs'])))
+    input_array = names['inputs']['state'].split(':')[0]
+    output_arrays = [tensor.split(':')[0] for tensor in names['outputs'].values()]
+    calibration_states = np.asarray(calibration_states) # recorded dtype, uint8 frames for cnn policies
+
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(frozen_graph, [input_array], output_arrays,
+                                                          input_shapes={input_array:[1, *calibration_states.shape[1:]]})
+    if mode == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        idxs = np.random.choice(len(calibration_states), min(num_calibration, len(calibration_states)), replace=False)
+        def representative_dataset():
+            for i in idxs:
+                yield [calibration_states[i:i+1]]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    elif mode == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif mode == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        raise ValueError('unknown quantisation mode ' + str(mode))
+
+    with open(filename, 'wb') as file:
+        file.write(converter.convert())
+    with open(filename + '.json', 'w') as file:
+        json.dump({'inputs':names['inputs'], 'outputs':names['outputs'], 'mode':mode}, file, indent=4)
+    print('%s quantised policy written to %s' %(mode, filename))
+    return filename
+
+def compare_policies(float_policy, quantised_policy, states, batch_size=32):
+    '''
+        action agreement (greedy actions of the 'policy' or 'Q' output) and per batch latency of a quantised policy against its float model
+
+        Args:
+            float_policy, quantised_policy - InferencePolicy and QuantisedPolicy of the same export
+            states - held out recorded observations, not the calibration states
+            batch_size - states per forward, the number of envs an actor steps at once
+    '''
+    output = 'Q' if 'Q' in float_policy.outputs else 'policy'
+    agree, max_error = [], 0
+    latency = {'float':[], 'quantised':[]}
+    for start in range(0, len(states) - batch_size + 1, batch_size):
+        batch = np.asarray(states[start:start+batch_size])
+        results = {}
+        for name, policy in (('float', float_policy), ('quantised', quantised_policy)):
+            t = time.perf_counter()
+            results[name] = policy.run(state=batch)[output]
+            latency[name].append(time.perf_counter() - t)
+        agree.append(np.argmax(results['float'], axis=-1) == np.argmax(results['quantised'], axis=-1))
+        max_error = max(max_error, float(np.abs(results['float'] - results['quantised']).max()))
+
+    report = {'action_agreement':float(np.mean(np.concatenate(agree))), 'max_abs_error':max_error, 'batch_size':batch_size,
+              'float_ms':float(np.median(latency['float']) * 1000), 'quantised_ms':float(np.median(latency['quantised']) * 1000)}
+    print('action agreement %f, max %s error %f, median latency per batch of %i: float %fms quantised %fms (%.2fx)' %(report['action_agreement'],
+          output, max_error, batch_size, report['float_ms'], report['quantised_ms'], report['float_ms'] / max(report['quantised_ms'], 1e-9)))
+    return report
+
+
+class QuantisedPolicy(InferencePolicy):
+    def __init__(self, filename, num_threads=1):
+        '''
+            Runs a .tflite policy written by quantise_policy with the same interface as InferencePolicy (forward, run, get_action, validate)
+
+            Args:
+                filename - .tflite path, names are read from filename.json
+                num_threads - interpreter threads where supported by the installed tensorflow
+        '''
+        with open(filename + '.json', 'r') as file:
+            names = json.load(file)
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=filename, num_threads=num_threads)
+        except TypeError: # older interpreters have no num_threads
+            self.interpreter = tf.lite.Interpreter(model_path=filename)
+        self.interpreter.allocate_tensors()
+        details = {detail['name']:detail['index'] for detail in self.interpreter.get_input_details() + self.interpreter.get_output_details()}
+        # tflite tensors are named after the graph's ops, without the output index
+        self.inputs = {name:details[tensor.split(':')[0]] for name, tensor in names['inputs'].items()}
+        self.outputs = {name:details[tensor.split(':')[0]] for name, tensor in names['outputs'].items()}
+        self.state_dtype = [detail['dtype'] for detail in self.interpreter.get_input_details() if detail['index'] == self.inputs['state']][0]
+        self.batch_size = 1
+
+    def forward(self, state):
+        state = np.asarray(state, dtype=self.state_dtype) # uint8 for cnn policies, the cast and /255 are part of the model
+        if len(state) != self.batch_size: # converted with batch 1, resized for the number of envs stepped
+            self.interpreter.resize_tensor_input(self.inputs['state'], state.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(state)
+        self.interpreter.set_tensor(self.inputs['state'], state)
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(index) for index in self.outputs.values()]
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    import argparse, gym
+    from rlib.utils.VecEnv import AtariEnv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frozen', help='inference graph exported by export_inference_graph e.g. models/PPO/inference.pb')
+    parser.add_argument('--env', nargs='?', default='SpaceInvaders')
+    parser.add_argument('--mode', nargs='?', default='int8', choices=['int8', 'dynamic', 'float16'])
+    parser.add_argument('--num_steps', type=int, default=5000, help='recorded steps, half for calibration and half for evaluation')
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    env_id = args.env + 'Deterministic-v4'
+    env = gym.make(env_id)
+    reset = env.unwrapped.get_action_meanings()[1] == 'FIRE'
+    env.close()
+    env = AtariEnv(gym.make(env_id), k=4, rescale=84, episodic=False, reset=reset, clip_reward=False)
+
+    float_policy = InferencePolicy(args.frozen)
+    states = record_observations(env, args.num_steps, float_policy)
+    np.random.shuffle(states)
+    calibration, evaluation = states[:len(states)//2], states[len(states)//2:]
+    filename = quantise_policy(args.frozen, args.frozen[:-len('.pb')] + '_' + args.mode + '.tflite', calibration, mode=args.mode)
+    compare_policies(float_policy, QuantisedPolicy(filename), evaluation, batch_size=args.batch_size)
@@ -0,0 +1,49 @@
+import tensorflow as tf
+
+
+class RolloutDataset(object):
+    def __init__(self, fields, name='rollout'):
+        '''
+            In-graph rollout storage for minibatch epochs, the rollout is uploaded once per update into local variables
+            and shuffled minibatches are gathered in-graph by a tf.data index iterator, so each training step feeds nothing
+
+            Args:
+                fields - dict of field name -> (dtype, shape) where shape excludes the sample dimension
+                         e.g. {'state':(tf.float32, (84,84,4)), 'actions':(tf.int32, ())}
+        '''
+        self.fields = fields
+        with tf.variable_scope(name):
+            self.placeholders, self.variables = {}, {}
+            for key, (dtype, shape) in fields.items():
+                self.placeholders[key] = tf.placeholder(dtype, shape=[None, *shape], name=key)
+                # local variables are not checkpointed, initialised (uploaded) with a new rollout each update
+                self.variables[key] = tf.Variable(self.placeholders[key], trainable=False, validate_shape=False,
+                                                  collections=[tf.GraphKeys.LOCAL_VARIABLES], name=key + '_storage')
+
+            self.num_samples = tf.placeholder(tf.int64, shape=[], name='num_samples')
+            self.batch_size = tf.placeholder(tf.int64, shape=[], name='batch_size')
+            self.num_epochs = tf.placeholder(tf.int64, shape=[], name='num_epochs')
+            dataset = tf.data.Dataset.range(self.num_samples).shuffle(self.num_samples).batch(self.batch_size, drop_remainder=True).repeat(self.num_epochs)
+            iterator = dataset.make_initializable_iterator()
+            idxs = iterator.get_next()
+
+            self.minibatch = {}
+            for key, (dtype, shape) in fields.items():
+                self.minibatch[key] = tf.gather(self.variables[key], idxs)
+                self.minibatch[key].set_shape([None, *shape])
+
+            self.upload_op = tf.group(tf.variables_initializer(list(self.variables.values())), iterator.initializer)
+
+    def default(self, key, name=None):
+        # placeholder that is fed as usual for forward passes but reads the in-graph minibatch when not fed
+        dtype, shape = self.fields[key]
+        return tf.placeholder_with_default(self.minibatch[key], shape=[None, *shape], name=name)
+
+    def upload(self, sess, num_epochs, num_minibatches, **arrays):
+        ''' copy a folded rollout [time*batch, ...] into the graph, returns the number of minibatches to iterate '''
+        num_samples = len(next(iter(arrays.values())))
+        batch_size = num_samples // num_minibatches
+        feed_dict = {self.placeholders[key]:value for key, value in arrays.items()}
+        feed_dict.update({self.num_samples:num_samples, self.batch_size:batch_size, self.num_epochs:num_epochs})
+        sess.run(self.upload_op, feed_dict=feed_dict)
+        return num_epochs * (num_samples // batch_size)
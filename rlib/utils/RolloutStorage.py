@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class RolloutStorage(object):
+    def __init__(self, num_steps, fields=None):
+        '''
+            Preallocated rollout buffers written in place by a runner every step and reused every update,
+            replacing appending step tuples to a list and np.stack-ing each field
+            e.g.
+                self.rollout.insert(t, states=self.states, actions=actions, rewards=rewards, dones=dones)
+                states, actions = self.rollout.get('states', 'actions') # [num_steps, num_envs, ...] views
+
+            arrays handed out are views of the buffers and are overwritten by the next rollout,
+            copy anything kept across updates (the runners' replay memories hold the env's own arrays so are unaffected)
+
+            Args:
+                num_steps - rollout length
+                fields - optional dict of field name -> (per step shape, dtype) e.g. {'states':((32,84,84,4), np.float32)},
+                         fields not given are allocated from the first value written to them
+        '''
+        self.num_steps = num_steps
+        self.buffers = {}
+        if fields is not None:
+            for name, (shape, dtype) in fields.items():
+                self.buffers[name] = np.empty((num_steps, *shape), dtype=dtype)
+
+    def insert(self, t, **step):
+        for name, value in step.items():
+            value = np.asarray(value)
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                buffer = self.buffers[name] = np.empty((self.num_steps, *value.shape), dtype=value.dtype)
+            elif not np.can_cast(value.dtype, buffer.dtype):
+                # e.g. integer rewards on the first step then float rewards, widen rather than truncate
+                buffer = self.buffers[name] = buffer.astype(np.result_type(buffer.dtype, value.dtype))
+            buffer[t] = value
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    def get(self, *names):
+        ''' time-major [num_steps, num_envs, ...] views of the named fields '''
+        return tuple(self.buffers[name] for name in names)
+
+    def folded(self, *names):
+        ''' [num_steps*num_envs, ...] views of the named fields, same layout as fold_batch without copying '''
+        return tuple(self.buffers[name].reshape(-1, *self.buffers[name].shape[2:]) for name in names)
+
+
+class MinibatchSampler(object):
+    def __init__(self, num_minibatches, axis=0, num_buffers=1):
+        '''
+            Shuffled minibatches of time-major rollouts gathered into reusable buffers with np.take(out=),
+            replacing fold_batch(x[batch_idxs]) which allocates a new copy of every field for every minibatch
+            e.g.
+                for batch_idxs in self.minibatches.shuffle(len(states), self.num_epochs):
+                    mb_states, mb_actions = self.minibatches.gather(batch_idxs, states, actions)
+
+            gathered minibatches are folded [minibatch_size*num_envs, ...] views overwritten num_buffers gathers later
+
+            Args:
+                num_minibatches - number of minibatches per epoch
+                axis - 0 to shuffle time steps (keeping every env of a step together), 1 to shuffle envs (keeping whole env trajectories)
+                num_buffers - sets of buffers gathers cycle through, 2 when a minibatch is still read (e.g. staged by StagedFeed.iterate) while the next is gathered
+        '''
+        self.num_minibatches = num_minibatches
+        self.axis = axis
+        self.num_buffers = num_buffers
+        self.buffers = {}
+        self.gathers = 0
+
+    def shuffle(self, length, num_epochs=1):
+        ''' yields index arrays of each minibatch for num_epochs shuffled passes over length steps (or envs for axis=1) '''
+        idxs = np.arange(length)
+        batch_size = length // self.num_minibatches
+        for epoch in range(num_epochs):
+            np.random.shuffle(idxs)
+            for start in range(0, batch_size * self.num_minibatches, batch_size):
+                yield idxs[start:start + batch_size]
+
+    def gather(self, batch_idxs, *arrays):
+        buffer_set = self.gathers % self.num_buffers
+        self.gathers += 1
+        return tuple(self._take((buffer_set, i), x, batch_idxs) for i, x in enumerate(arrays))
+
+    def _take(self, i, x, batch_idxs):
+        shape = x.shape[:self.axis] + (len(batch_idxs),) + x.shape[self.axis+1:]
+        key = (i, shape, x.dtype)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = np.empty(shape, dtype=x.dtype)
+        np.take(x, batch_idxs, axis=self.axis, out=buffer, mode='clip') # 'clip' writes straight into out, 'raise' buffers a temporary copy
+        return buffer.reshape(-1, *shape[2:])
@@ -0,0 +1,105 @@
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+from tensorflow.python.ops.data_flow_ops import StagingArea
+
+
+class StagedFeed(object):
+    def __init__(self, fields, capacity=2, device=None, name='staged_feed'):
+        '''
+            Inputs staged into the graph ahead of the op that reads them, so the host to device copy of the next batch overlaps
+            the current step rather than every sess.run blocking on its own feed_dict copy
+            e.g.
+                for l in feed.iterate(sess, [train_op, loss], minibatches): # each step trains on one batch while the next is put
+                    ...
+                feed.stage_async(sess, state=next_states) # copied while the runner stores the step
+                policy = feed.run(sess, policy_tensor)    # reads the staged states
+
+            each field has its own staging area so a forward only dequeues 'state' while a training step dequeues every field,
+            inputs are read by the model through default() and feeding them as usual bypasses the staging area
+
+            Args:
+                fields - dict of field name -> (dtype, shape) where shape excludes the sample dimension, same as RolloutDataset
+                         e.g. {'state':(tf.uint8, (84,84,4)), 'actions':(tf.int32, ())}
+                capacity - batches each staging area holds before a put blocks
+                device - device of the staging areas e.g. '/gpu:0', placed by tensorflow when None
+        '''
+        self.fields = fields
+        self.executor = None
+        self.pending = None
+        with tf.variable_scope(name), tf.device(device):
+            self.placeholders, self.put_ops, self.staged = {}, {}, {}
+            clear_ops = []
+            for key, (dtype, shape) in fields.items():
+                self.placeholders[key] = tf.placeholder(dtype, shape=[None, *shape], name=key)
+                area = StagingArea([dtype], shapes=[[None, *shape]], names=[key], capacity=capacity)
+                self.put_ops[key] = area.put({key:self.placeholders[key]})
+                self.staged[key] = area.get()[key]
+                clear_ops.append(area.clear())
+            self.clear_op = tf.group(*clear_ops)
+
+    def default(self, key, name=None):
+        # placeholder that is fed as usual but reads the next staged batch of key when not fed
+        dtype, shape = self.fields[key]
+        return tf.placeholder_with_default(self.staged[key], shape=[None, *shape], name=name)
+
+    def _put(self, arrays):
+        return [self.put_ops[key] for key in arrays], {self.placeholders[key]:value for key, value in arrays.items()}
+
+    def stage(self, sess, **arrays):
+        ''' put a batch of the named fields, blocking until it is staged, the arrays must not be modified until the batch is read '''
+        self.wait()
+        put_ops, feed_dict = self._put(arrays)
+        sess.run(put_ops, feed_dict=feed_dict)
+
+    def stage_async(self, sess, **arrays):
+        ''' put a batch from a background thread, the copy runs while the caller carries on until the next run() or wait() '''
+        self.wait()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        put_ops, feed_dict = self._put(arrays)
+        self.pending = self.executor.submit(sess.run, put_ops, feed_dict=feed_dict)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def run(self, sess, fetches, feed_dict=None, stage=None):
+        '''
+            run fetches on the staged batch, putting the batch stage (dict of field -> array) in the same step
+
+            Args:
+                fetches - fetches whose unfed inputs are read from the staging areas
+                feed_dict - other inputs fed as usual e.g. alpha, normalisation statistics
+                stage - next batch to put while fetches run, None to only read
+        '''
+        self.wait()
+        feed_dict = dict(feed_dict) if feed_dict is not None else {}
+        put_ops = []
+        if stage is not None:
+            put_ops, stage_feed = self._put(stage)
+            feed_dict.update(stage_feed)
+        return sess.run([fetches, put_ops], feed_dict=feed_dict)[0]
+
+    def iterate(self, sess, fetches, batches, feed_dict=None):
+        '''
+            yields the fetches of one step per batch where each step reads the batch staged by the step before
+            and puts the following batch. A put can alias the fed arrays rather than copy them, so a batch must not be
+            overwritten until the step after it is put has run, i.e. arrays reused by batches need two sets (e.g. MinibatchSampler(num_buffers=2))
+
+            Args:
+                batches - iterable of dicts of field -> array
+        '''
+        batches = iter(batches)
+        batch = next(batches, None)
+        if batch is None:
+            return
+        self.stage(sess, **batch)
+        for batch in batches:
+            yield self.run(sess, fetches, feed_dict, stage=batch)
+        yield self.run(sess, fetches, feed_dict)
+
+    def clear(self, sess):
+        ''' drop anything left staged e.g. after an interrupted iterate '''
+        self.wait()
+        sess.run(self.clear_op)
@@ -0,0 +1,203 @@
+import os, sys, time, json, csv, glob, random, itertools, argparse
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+
+
+def grid(**params):
+    ''' cartesian product of parameter lists as a list of configs e.g. grid(env_id=['Pong', 'Freeway'], lr=[1e-3, 1e-4]) '''
+    keys = list(params.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[params[key] for key in keys])]
+
+def latest_checkpoint(model_dir):
+    ''' returns (checkpoint number, .trainer filename) of the latest complete checkpoint in model_dir, None if there is none '''
+    checkpoints = []
+    for filename in glob.glob(os.path.join(model_dir, '*.trainer')):
+        s = os.path.basename(filename)[:-len('.trainer')]
+        if s.isdigit() and os.path.exists(os.path.join(model_dir, s + '.ckpt.index')):
+            checkpoints.append((int(s), filename))
+    if len(checkpoints) == 0:
+        return None
+    s, filename = max(checkpoints)
+    return str(s), filename
+
+def read_scalars(log_dir):
+    ''' last and max value of every scalar in the tensorboard event files under log_dir '''
+    scalars = {}
+    for filename in sorted(glob.glob(os.path.join(log_dir, '**', 'events.out.tfevents*'), recursive=True)):
+        try:
+            for event in tf.train.summary_iterator(filename):
+                for value in event.summary.value:
+                    if value.HasField('simple_value'):
+                        last, best = scalars.get(value.tag, (None, -np.inf))
+                        scalars[value.tag] = (value.simple_value, max(best, value.simple_value))
+        except tf.errors.DataLossError: # event file of a run killed mid-write
+            pass
+    return scalars
+
+def _run(run_fn, config, seed, run_dir, cores):
+    # entry point of each run's process
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores) # env worker processes started by the run inherit its cores
+    sys.stdout = sys.stderr = open(os.path.join(run_dir, 'output.log'), 'a', buffering=1)
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    run_fn(seed=seed, run_dir=run_dir, **config)
+
+
+class Sweep(object):
+    def __init__(self, run_fn, configs, sweep_dir, seeds=(0,), cores_per_run=4, max_concurrent=None, start_method='spawn', poll_freq=5):
+        '''
+            Runs every config x seed concurrently as separate processes, each pinned to its own block of CPU cores.
+            Progress is kept in sweep_dir/status.json so re-running the same sweep skips finished runs and restarts unfinished ones,
+            the last and max value of each run's tensorboard scalars are collected into sweep_dir/summary.csv
+
+            Args:
+                run_fn - picklable function called as run_fn(seed=seed, run_dir=run_dir, **config) e.g. A2C.main,
+                         it should log to run_dir and resume from the latest checkpoint in run_dir if there is one (see latest_checkpoint)
+                configs - list of keyword argument dicts for run_fn e.g. grid(env_id=['PongDeterministic-v4', 'FreewayDeterministic-v4'])
+                sweep_dir - directory for each run's logs/models, status.json and summary.csv
+                seeds - seeds run for every config
+                cores_per_run - number of CPU cores each run (and its env workers) is pinned to, 0 for no pinning
+                max_concurrent - maximum number of runs at once, defaults to the number of core blocks available
+                start_method - multiprocessing start method, 'spawn' as tensorflow is not fork safe
+                poll_freq - seconds between checking on running processes
+        '''
+        self.run_fn = run_fn
+        self.sweep_dir = sweep_dir
+        self.poll_freq = poll_freq
+        self.ctx = mp.get_context(start_method)
+        self.status_file = os.path.join(sweep_dir, 'status.json')
+        if not os.path.exists(sweep_dir):
+            os.makedirs(sweep_dir)
+
+        available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(mp.cpu_count()))
+        if cores_per_run > 0:
+            self.core_blocks = [available[i:i+cores_per_run] for i in range(0, len(available) - cores_per_run + 1, cores_per_run)]
+            if len(self.core_blocks) == 0:
+                self.core_blocks = [available]
+        else:
+            self.core_blocks = [None] * (max_concurrent if max_concurrent is not None else len(available))
+        self.max_concurrent = min(max_concurrent, len(self.core_blocks)) if max_concurrent is not None else len(self.core_blocks)
+
+        previous = {}
+        if os.path.exists(self.status_file):
+            with open(self.status_file, 'r') as file:
+                previous = json.load(file)
+
+        self.runs = {}
+        for config in configs:
+            for seed in seeds:
+                name = self.run_name(config, seed)
+                run = previous.get(name, {'config':config, 'seed':seed, 'run_dir':os.path.join(sweep_dir, name), 'attempts':0})
+                if run.get('status') != 'done': # unfinished or failed runs are restarted, resuming from their checkpoints
+                    run['status'] = 'pending'
+                self.runs[name] = run
+        self.save_status()
+
+    @staticmethod
+    def run_name(config, seed):
+        return '_'.join('%s=%s' %(key, value) for key, value in sorted(config.items())) + '_seed=%i' %(seed)
+
+    def save_status(self):
+        # write then rename so a killed launcher never leaves a corrupt status file
+        tmp = self.status_file + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(self.runs, file, indent=4)
+        os.replace(tmp, self.status_file)
+
+    def run(self):
+        pending = [name for name, run in self.runs.items() if run['status'] == 'pending']
+        print('%i runs to do, %i finished, %i at once on %s' %(len(pending), len(self.runs) - len(pending), self.max_concurrent,
+              'cores ' + str(self.core_blocks[:self.max_concurrent]) if self.core_blocks[0] is not None else 'unpinned cores'))
+        free_blocks = list(range(self.max_concurrent))
+        running = {}
+        start = time.time()
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(free_blocks) > 0:
+                name = pending.pop(0)
+                block = free_blocks.pop(0)
+                running[name] = (self._launch(name, self.core_blocks[block]), block)
+
+            time.sleep(self.poll_freq)
+            for name, (process, block) in list(running.items()):
+                if not process.is_alive():
+                    process.join()
+                    run = self.runs[name]
+                    run['status'] = 'done' if process.exitcode == 0 else 'failed'
+                    run['exitcode'] = process.exitcode
+                    run['time'] = run.get('time', 0) + time.time() - run.pop('start_time')
+                    print('%s %s after %fs, see %s' %(name, run['status'], run['time'], os.path.join(run['run_dir'], 'output.log')))
+                    del running[name]
+                    free_blocks.append(block)
+                    self.save_status()
+
+        print('sweep finished in %fs' %(time.time() - start))
+        return self.summarise()
+
+    def _launch(self, name, cores):
+        run = self.runs[name]
+        if not os.path.exists(run['run_dir']):
+            os.makedirs(run['run_dir'])
+        # not daemonic, runs start their own env worker processes
+        process = self.ctx.Process(target=_run, args=(self.run_fn, run['config'], run['seed'], run['run_dir'], cores), name=name)
+        process.start()
+        run['status'] = 'running'
+        run['cores'] = cores
+        run['attempts'] += 1
+        run['start_time'] = time.time()
+        self.save_status()
+        print('started %s, attempt %i' %(name, run['attempts']))
+        return process
+
+    def summarise(self, filename=None):
+        ''' write the last and max value of every run's scalars to a csv (default sweep_dir/summary.csv), returns the rows '''
+        filename = filename if filename is not None else os.path.join(self.sweep_dir, 'summary.csv')
+        rows = []
+        for name, run in self.runs.items():
+            row = {'run':name, 'status':run['status'], 'seed':run['seed'], 'time':run.get('time', 0)}
+            row.update(run['config'])
+            for tag, (last, best) in read_scalars(run['run_dir']).items():
+                row[tag] = last
+                row[tag + '_max'] = best
+            rows.append(row)
+
+        fields = []
+        for row in rows:
+            fields += [key for key in row if key not in fields]
+        with open(filename, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        print('summary written to', filename)
+        return rows
+
+
+def main_or_sweep(run_fn, env_ids, sweep_dir, cores_per_run=4):
+    '''
+        command line of a training script's __main__, a single run of run_fn(env_id) by default,
+        --sweep runs every env in env_ids x --num_seeds seeds as a Sweep in sweep_dir
+
+        Args:
+            run_fn - script's main e.g. A2C.main, see Sweep
+            env_ids - envs of a sweep, the first is the default env of a single run
+            sweep_dir - default directory of a sweep
+            cores_per_run - default number of CPU cores each sweep run is pinned to
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--env_id', default=env_ids[0], help='env of a single run')
+    parser.add_argument('--seed', type=int, default=None, help='seed of a single run, unseeded when not given')
+    parser.add_argument('--sweep', action='store_true', help='run every env x seed as parallel processes pinned to their own cores')
+    parser.add_argument('--num_seeds', type=int, default=3, help='seeds per env of a sweep')
+    parser.add_argument('--cores_per_run', type=int, default=cores_per_run, help='cores each sweep run is pinned to, 0 for no pinning')
+    parser.add_argument('--sweep_dir', default=sweep_dir, help='sweep directory, re-running a sweep resumes its unfinished runs')
+    args = parser.parse_args()
+    if args.sweep:
+        Sweep(run_fn, grid(env_id=env_ids), args.sweep_dir, seeds=range(args.num_seeds), cores_per_run=args.cores_per_run).run()
+        return
+    if args.seed is not None: # seeded as a sweep run is
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        tf.set_random_seed(args.seed)
+    run_fn(args.env_id, seed=args.seed)
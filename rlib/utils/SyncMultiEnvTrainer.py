@@ -1,19 +1,87 @@
-import time, datetime, os
+import time, datetime, os, re
 import tensorflow as tf
 import threading
 import numpy as np
 import copy
 import json
+import pickle
+import inspect
 from abc import ABC, abstractmethod
 from rlib.utils.utils import fold_batch
+from rlib.utils.AsyncCheckpointer import AsyncCheckpointer
+from rlib.utils.PhaseTimer import PhaseTimer
+from rlib.utils.TracingSession import TracingSession
+from rlib.utils.RolloutStorage import RolloutStorage
+from rlib.utils.InferencePolicy import export_inference_graph
+from rlib.utils.NumpyMLP import NumpyMLP
+from rlib.utils.VecEnv import BatchEnv
 
 
 
 
+def validation_episodes(envs, num_eps, max_steps, policy_fn, val_state=None, reset_state=None, render=False):
+    ''' 
+        steps all validation envs in lockstep with a single batched policy forward per step and returns the episode scores,
+        the envs of a BatchEnv are stepped in parallel by its workers, a list of envs is stepped in turn
+        shared by SyncMultiEnvTrainer.validate_batch and AsyncEvaluator
+        
+        Args:
+            envs - BatchEnv or list of validation envs
+            num_eps - list of number of episodes to run on each env 
+            max_steps - maximum number of steps per episode
+            policy_fn - function(states, val_state) returning a batch of actions and the updated val_state
+            val_state - initial recurrent state passed to policy_fn, None for feedforward policies
+            reset_state - function(val_state, actions, rewards, dones) called after each step e.g. to reset lstm hidden state of finished envs
+            render - boolean flag whether to render the first env 
+    '''
+    vectorised = isinstance(envs, BatchEnv)
+    env_list = envs.envs if vectorised else envs
+    num_envs = len(env_list)
+    states = envs.reset() if vectorised else np.stack([env.reset() for env in envs])
+    episode_scores = np.zeros((num_envs))
+    episode_steps = np.zeros((num_envs), dtype=np.int32)
+    remaining = np.array(num_eps)
+    active = remaining > 0
+    scores = []
+    while np.any(active):
+        # finished envs are still forwarded to keep a fixed batch size (needed by lstm models) but are not stepped
+        actions, val_state = policy_fn(states, val_state)
+        rewards = np.zeros((num_envs))
+        dones = np.zeros((num_envs), dtype=np.bool_)
+        idxs = np.flatnonzero(active)
+        if vectorised: # send every step before collecting so the workers step together
+            results = [env_list[i].step(actions[i], False) for i in idxs]
+            results = [result() for result in results]
+        else:
+            results = [env_list[i].step(actions[i]) for i in idxs]
+        for i, (next_state, reward, done, info) in zip(idxs, results):
+            rewards[i] = reward
+            episode_scores[i] += reward
+            episode_steps[i] += 1
+            
+            if render and i == 0:
+                env_list[i].render()
+
+            if done or episode_steps[i] == max_steps:
+                scores.append(episode_scores[i])
+                episode_scores[i], episode_steps[i] = 0, 0
+                remaining[i] -= 1
+                active[i] = remaining[i] > 0
+                dones[i] = True
+                if active[i] and not (vectorised and done): # BatchEnv workers reset themselves at the end of an episode
+                    next_state = env_list[i].reset()
+            states[i] = next_state
+        if reset_state is not None:
+            val_state = reset_state(val_state, actions, rewards, dones)
+    if render and not vectorised:
+        envs[0].close()
+    return scores
+
+
 class SyncMultiEnvTrainer(object):
     def __init__(self, envs, model, val_envs, train_mode='nstep', return_type='nstep', log_dir='logs/', model_dir='models/', total_steps=50e6, nsteps=5, gamma=0.99, lambda_=0.95, 
                      validate_freq=1e6, save_freq=0, render_freq=0, update_target_freq=0, num_val_episodes=50,
-                     log_scalars=True, gpu_growth=True):
+                     log_scalars=True, gpu_growth=True, async_save=True, profile=False, profile_freq=100, trace_updates=None, xla=False):
         '''
             A synchronous multiple env training framework for tensorflow v.1 api 
 
@@ -21,7 +89,7 @@ class SyncMultiEnvTrainer(object):
                 envs - BatchEnv method which runs multiple environements synchronously 
                 model - reinforcement learning model
                 log_dir, log directory string for location of directory to log scalars log_dir='logs/', model_dir='models/',
-                val_envs - a list of envs for validation 
+                val_envs - a list of envs for validation, or a BatchEnv to step them in parallel worker processes (needs get_batch_actions, see validate_batch)
                 train_mode - 'nstep' or 'onestep' species whether training is done using multiple step TD learning or single step
                 return_type - string to determine whether 'nstep', 'lambda' or 'GAE' returns are to be used
                 total_steps - number of Total training steps across all environements
@@ -33,6 +101,11 @@ class SyncMultiEnvTrainer(object):
                 num_val_episodes - number of episodes to average over when validating
                 log_scalars - boolean flag whether to log tensorboard scalars to log_dir
                 gpu_growth - boolean flag whether to allow gpu growth when allocating initialising CUDNN of GPU
+                async_save - boolean flag whether checkpoints are written from a background thread rather than blocking training
+                profile - boolean flag whether to time each phase of the training loop (env step, forward, backprop ...)
+                profile_freq - number of updates per phase histogram logged to tensorboard, a chrome trace is written to log_dir after training
+                trace_updates - (start, end) window of updates for which every model sess.run captures a FULL_TRACE timeline to log_dir/timeline, None for no tracing
+                xla - boolean flag whether to XLA JIT compile clusters of the forward and train ops, CPU clustering needs TF_XLA_FLAGS set at process start (see session_config and rlib/utils/xla_benchmark.py)
         '''
         self.env = envs
         if train_mode not in ['nstep', 'onestep']:
@@ -44,15 +117,22 @@ class SyncMultiEnvTrainer(object):
         self.num_envs = len(envs)
         self.env_id = envs.spec.id
         self.val_envs = val_envs
+        if isinstance(val_envs, BatchEnv) and not self.can_validate_batch():
+            raise ValueError('%s has no batched validation (get_batch_actions) so cannot validate on a BatchEnv, pass a list of envs' %(type(self).__name__))
         self.validate_rewards = []
+        self.evaluator = None # optional AsyncEvaluator running validation in a separate process
         self.model = model
 
-        config = tf.ConfigProto() # GPU 
-        config.gpu_options.allow_growth = gpu_growth # GPU settings 
+        config = self.session_config(gpu_growth, xla)
         #config.log_device_placement=True
         #config = tf.ConfigProto(device_count = {'GPU': 0}) #CPU ONLY
         self.sess = tf.Session(config=config)
-        self.model.set_session(self.sess)
+        self.tracer = None
+        if trace_updates is not None: # models run through a tracing proxy, the trainer keeps the plain session for saving
+            self.tracer = TracingSession(self.sess, log_dir + '/timeline', trace_updates)
+            self.model.set_session(self.tracer)
+        else:
+            self.model.set_session(self.sess)
     
         self.total_steps = int(total_steps)
         self.nsteps = nsteps
@@ -69,9 +149,13 @@ class SyncMultiEnvTrainer(object):
         self.target_freq = int(update_target_freq)
         self.s = 0 # number of saves made
         self.t = 1 # number of updates done
+        self.warmed_up = False # whether warm up phases (normaliser statistics, replay filling) have run or were restored by load from a .state file
         self.log_scalars = log_scalars
         self.log_dir = log_dir
         self.model_dir = model_dir
+        self.async_save = async_save
+        self.checkpointer = None
+        self.timer = PhaseTimer(enabled=profile, log_freq=profile_freq)
         
 
         if log_scalars:
@@ -80,13 +164,17 @@ class SyncMultiEnvTrainer(object):
             
             tf_epLoss = tf.placeholder('float',name='epsiode_loss')
             tf_epReward =  tf.placeholder('float',name='episode_reward')
-            self.tf_placeholders = (tf_epLoss,tf_epReward)
+            tf_trainReward = tf.placeholder('float',name='train_episode_reward')
+            self.tf_placeholders = (tf_epLoss,tf_epReward,tf_trainReward)
 
             tf_sum_epLoss = tf.summary.scalar('epsiode_loss', tf_epLoss)
             tf_sum_epReward = tf.summary.scalar('episode_reward', tf_epReward)
-            self.tf_summary_scalars= (tf_sum_epLoss,tf_sum_epReward)
+            tf_sum_trainReward = tf.summary.scalar('train_episode_reward', tf_trainReward)
+            self.tf_summary_scalars= (tf_sum_epLoss,tf_sum_epReward,tf_sum_trainReward)
             
             self.train_writer = tf.summary.FileWriter(train_log_dir)
+            if self.tracer is not None:
+                self.tracer.writer = self.train_writer
 
         
         self.saver = tf.train.Saver()
@@ -97,16 +185,62 @@ class SyncMultiEnvTrainer(object):
             os.makedirs(self.model_dir)
     
     def __del__(self):
+        if self.checkpointer is not None: # finish writing queued checkpoints
+            self.checkpointer.close()
         self.env.close()
+        if isinstance(self.val_envs, BatchEnv):
+            self.val_envs.close()
+        if self.evaluator is not None:
+            self.evaluator.close()
+    
+    @staticmethod
+    def session_config(gpu_growth=True, xla=False):
+        config = tf.ConfigProto() # GPU 
+        config.gpu_options.allow_growth = gpu_growth # GPU settings 
+        if xla:
+            # auto-clustering only covers GPU ops, CPU ops also need TF_XLA_FLAGS=--tf_xla_cpu_global_jit in the environment before
+            # tensorflow is first imported, so set it when launching the process or at the top of the entry script (see xla_benchmark.py)
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        return config
+    
+    def attach_evaluator(self, evaluator):
+        ''' hand validation to an AsyncEvaluator, parameter snapshots are sent every validate_freq steps instead of blocking training '''
+        if type(self).init_validate_state is not SyncMultiEnvTrainer.init_validate_state:
+            # the evaluator's policy_fn has no recurrent state to carry between steps
+            raise ValueError('%s validates a recurrent policy, which AsyncEvaluator does not support' %(type(self).__name__))
+        evaluator.set_variables(tf.trainable_variables())
+        self.evaluator = evaluator
+    
+    def use_numpy_forward(self):
+        ''' serve the runner's and validation forward passes from a NumPy copy of the model's mlp weights, synced after every backprop (see NumpyMLP) '''
+        self.model = NumpyMLP(self.model)
+        if hasattr(self, 'runner'):
+            self.runner.model = self.model
         
 
     def train(self):
+        if getattr(self.env, 'time_to_first_batch', None) is not None: # BatchEnv startup timings
+            print('%i envs started in %fs, time to first batch %fs' %(len(self.env), self.env.startup_time, self.env.time_to_first_batch))
+        if hasattr(self, 'runner'):
+            self.runner.timer = self.timer
+        if self.tracer is not None:
+            self.tracer.set_update(self.t)
         if self.train_mode == 'nstep':
             self._train_nstep()
         elif self.train_mode == 'onestep':
             self._train_onestep()
         else:
             raise ValueError('%s is not a valid training mode'%(self.train_mode))
+        if self.timer.enabled:
+            self.timer.export_chrome_trace(self.log_dir + '/trace.json')
+    
+    def profile_update(self, t, tot_steps):
+        # called after each update, aggregates phase timings every profile_freq updates and moves the trace window on
+        if self.tracer is not None:
+            self.tracer.set_update(t + 1)
+        summary = self.timer.end_update(t, self.train_writer if self.log_scalars else None, tot_steps)
+        if summary is not None and not self.log_scalars:
+            self.timer.print_summary()
     
     @abstractmethod
     def _train_nstep(self):
@@ -119,15 +253,19 @@ class SyncMultiEnvTrainer(object):
         # main loop
         for t in range(self.t,num_updates+1):
             states, actions, rewards, dones, infos, values, last_values = self.runner.run()
-            if self.return_type == 'nstep':
-                R = self.nstep_return(rewards, last_values, dones, gamma=self.gamma)
-            elif self.return_type == 'GAE':
-                R = self.GAE(rewards, values, last_values, dones, gamma=self.gamma, lambda_=self.lambda_) + values
-            elif self.return_type == 'lambda':
-                R = self.lambda_return(rewards, values, last_values, dones, gamma=self.gamma, lambda_=self.lambda_, clip=False)
+            with self.timer.phase('returns'):
+                if self.return_type == 'nstep':
+                    R = self.nstep_return(rewards, last_values, dones, gamma=self.gamma)
+                elif self.return_type == 'GAE':
+                    R = self.GAE(rewards, values, last_values, dones, gamma=self.gamma, lambda_=self.lambda_) + values
+                elif self.return_type == 'lambda':
+                    R = self.lambda_return(rewards, values, last_values, dones, gamma=self.gamma, lambda_=self.lambda_, clip=False)
             # stack all states, actions and Rs from all workers into a single batch
-            states, actions, R = fold_batch(states), fold_batch(actions), fold_batch(R)    
-            l = self.model.backprop(states, R, actions)
+            with self.timer.phase('fold_batch'):
+                states, actions, R = fold_batch(states), fold_batch(actions), fold_batch(R)    
+            with self.timer.phase('backprop'):
+                l = self.model.backprop(states, R, actions)
+            self.profile_update(t, t * batch_size)
 
             if self.render_freq > 0 and t % ((self.validate_freq // batch_size) * self.render_freq) == 0:
                 render = True
@@ -140,7 +278,8 @@ class SyncMultiEnvTrainer(object):
             
             if self.save_freq > 0 and  t % (self.save_freq // batch_size) == 0: 
                 self.s += 1
-                self.save(self.s)
+                with self.timer.phase('save'):
+                    self.save(self.s)
                 print('saved model')
             
             if self.target_freq > 0 and t % (self.target_freq // batch_size) == 0: # update target network (for value based learning e.g. DQN)
@@ -196,35 +335,62 @@ class SyncMultiEnvTrainer(object):
         time_taken = time.time() - start
         frames_per_update = (self.validate_freq // batch_size) * batch_size
         fps = frames_per_update /time_taken 
+        train_score = self.train_episode_summary()
         num_val_envs = len(self.val_envs)
+        if self.evaluator is not None: # validation of this snapshot is logged by the evaluator process with the same tot_steps
+            self.evaluator.submit(self.sess, tot_steps)
+        if num_val_envs == 0 or self.evaluator is not None: # score training episodes only 
+            print("update %i, train score %f, total steps %i, loss %f, time taken for %i frames:%fs, fps %f" %(t,train_score,tot_steps,loss,frames_per_update,time_taken,fps))
+            if self.log_scalars:
+                self.log_train_scalars(tot_steps, loss, train_score)
+            return
         num_val_eps = [self.num_val_episodes//num_val_envs for i in range(num_val_envs)]
-        num_val_eps[-1] = num_val_eps[-1] + self.num_val_episodes % self.num_val_episodes//(num_val_envs)
-        render_array = np.zeros((len(self.val_envs)))
-        render_array[0] = render
-        threads = [threading.Thread(daemon=True,target=self.validate, args=(self.val_envs[i], num_val_eps[i], 10000, render_array[i])) for i in range(num_val_envs)]
-        
-        try:
-            for thread in threads:
-                thread.start()
+        num_val_eps[-1] = num_val_eps[-1] + self.num_val_episodes % num_val_envs
+        if self.can_validate_batch():
+            self.validate_batch(self.val_envs, num_val_eps, 10000, render)
+        else:
+            render_array = np.zeros((len(self.val_envs)))
+            render_array[0] = render
+            threads = [threading.Thread(daemon=True,target=self.validate, args=(self.val_envs[i], num_val_eps[i], 10000, render_array[i])) for i in range(num_val_envs)]
             
-            for thread in threads:
-                thread.join()
-    
-        except KeyboardInterrupt:
-            for thread in threads:
-                thread.join()
+            try:
+                for thread in threads:
+                    thread.start()
+                
+                for thread in threads:
+                    thread.join()
+        
+            except KeyboardInterrupt:
+                for thread in threads:
+                    thread.join()
     
             
         score = np.mean(self.validate_rewards)
         self.validate_rewards = []
-        print("update %i, validation score %f, total steps %i, loss %f, time taken for %i frames:%fs, fps %f" %(t,score,tot_steps,loss,frames_per_update,time_taken,fps))
+        print("update %i, validation score %f, train score %f, total steps %i, loss %f, time taken for %i frames:%fs, fps %f" %(t,score,train_score,tot_steps,loss,frames_per_update,time_taken,fps))
         
         if self.log_scalars:
-            tf_epLoss, tf_epScore, = self.tf_placeholders
-            tf_sum_epLoss, tf_sum_epScore, = self.tf_summary_scalars
-            sumscore, sumloss = self.sess.run([tf_sum_epScore, tf_sum_epLoss], feed_dict = {tf_epScore:score, tf_epLoss:loss})
-            self.train_writer.add_summary(sumloss, tot_steps)
+            tf_epLoss, tf_epScore, tf_trainScore = self.tf_placeholders
+            tf_sum_epLoss, tf_sum_epScore, tf_sum_trainScore = self.tf_summary_scalars
+            sumscore = self.sess.run(tf_sum_epScore, feed_dict = {tf_epScore:score})
             self.train_writer.add_summary(sumscore, tot_steps)
+            self.log_train_scalars(tot_steps, loss, train_score)
+    
+    def train_episode_summary(self):
+        # mean unclipped return of training episodes completed since last summary, collected by BatchEnv workers
+        if not hasattr(self.env, 'pop_episode_stats'):
+            return np.nan
+        returns, lengths = self.env.pop_episode_stats()
+        return np.mean(returns) if len(returns) > 0 else np.nan
+    
+    def log_train_scalars(self, tot_steps, loss, train_score):
+        tf_epLoss, tf_epScore, tf_trainScore = self.tf_placeholders
+        tf_sum_epLoss, tf_sum_epScore, tf_sum_trainScore = self.tf_summary_scalars
+        sumloss = self.sess.run(tf_sum_epLoss, feed_dict = {tf_epLoss:loss})
+        self.train_writer.add_summary(sumloss, tot_steps)
+        if not np.isnan(train_score):
+            sumtrain = self.sess.run(tf_sum_trainScore, feed_dict = {tf_trainScore:train_score})
+            self.train_writer.add_summary(sumtrain, tot_steps)
     
     def save_model(self,s):
         model_loc = str(self.model_dir + '/' + str(s))
@@ -232,12 +398,25 @@ class SyncMultiEnvTrainer(object):
         self.saver.save(self.sess, model_loc + ".ckpt")
     
     def load_model(self,modelname, model_dir="models/"):
-        if os.path.exists(model_dir + modelname+ ".ckpt"+ ".meta"):
-            self.saver.restore(self.sess, model_dir+modelname+".ckpt")
+        if os.path.exists(model_dir + modelname+ ".ckpt"+ ".index"):
+            try:
+                self.saver.restore(self.sess, model_dir+modelname+".ckpt")
+            except tf.errors.NotFoundError as e:
+                names = [name for name, shape in tf.train.list_variables(model_dir+modelname+".ckpt")]
+                if any(re.search(r'_Wx[ifoc]$', name) for name in names): # per gate LSTMCell variables
+                    raise ValueError('%s holds LSTMCell weights which a model built with fused_lstm=True cannot restore, build it with fused_lstm=False '
+                                     'or convert the checkpoint with rlib.networks.networks.convert_lstm_checkpoint' %(model_dir+modelname+".ckpt")) from e
+                raise
+            if isinstance(self.model, NumpyMLP):
+                self.model.sync()
             print("loaded:", model_dir+modelname)
         else:
             print(model_dir + modelname, " does not exist")
     
+    def export_inference(self, filename):
+        ''' freeze the model's policy into a pruned graph loadable by InferencePolicy without building the trainer '''
+        return export_inference_graph(self.sess, self.model, filename)
+    
     def base_attr(self):
         attributes = {'train_mode':self.train_mode,
                 'total_steps':self.total_steps,
@@ -250,7 +429,7 @@ class SyncMultiEnvTrainer(object):
                 'save_freq':self.save_freq,
                 'render_freq':self.render_freq,
                 'model_dir':self.model_dir,
-                'train_log_dir':self.train_log_dir,
+                'log_dir':self.log_dir,
                 's':self.s,
                 't':self.t}
 
@@ -260,29 +439,68 @@ class SyncMultiEnvTrainer(object):
         # attr[variable] = z
         return attr
 
+    def checkpoint_state(self):
+        # picklable state saved alongside the model so training resumes exactly, 
+        # subclasses add normalisers, schedules and replay memory, env emulator state cannot be captured so episodes restart on resume
+        # not captured either: the runner's state (current observations, lstm hidden state, partial episode stats) and worker env RNGs,
+        # so the runner starts from freshly reset envs and recurrent models from a zero hidden state
+        return {'np_random':np.random.get_state()}
+    
+    def restore_state(self, state):
+        np.random.set_state(state['np_random'])
+
     def save(self, s):
-        model_loc = str(self.model_dir + '/' + str(s) + '.trainer')
-        file = open(model_loc, 'w+')
         attributes = self.base_attr()
         # add local variables to dict 
         attributes = self.local_attr(attributes)
+        if self.async_save:
+            if self.checkpointer is None:
+                self.checkpointer = AsyncCheckpointer(self.sess, self.model_dir)
+            self.checkpointer.save(s, attributes, self.checkpoint_state())
+            return
+        model_loc = str(self.model_dir + '/' + str(s) + '.trainer')
+        file = open(model_loc, 'w+')
         json.dump(attributes, file)
         # save model 
         self.save_model(s)
         file.close()
+        with open(str(self.model_dir + '/' + str(s) + '.state'), 'wb') as file:
+            pickle.dump(self.checkpoint_state(), file, protocol=pickle.HIGHEST_PROTOCOL)
     
-    def load(self, Class, model, model_checkpoint, envs, val_envs, filename, log_scalars=True, allow_gpu_growth=True, continue_train=True):
+    @staticmethod
+    def load(Class, model, model_checkpoint, envs, val_envs, filename, log_scalars=True, allow_gpu_growth=True, continue_train=True, **kwargs):
+        ''' 
+            rebuild a trainer from a .trainer file and restore its model, optimiser and (if continue_train) full training state
+
+            Args:
+                Class - trainer class e.g. A2C
+                model_checkpoint - checkpoint number e.g. '3' for model_dir/3.ckpt
+                filename - path of the .trainer json e.g. model_dir/3.trainer, a matching .state file is restored if present, otherwise a warning is printed and the trainer's warm up runs again
+                kwargs - any further constructor arguments not saved in the json e.g. target_model, action_size for SyncDDQN
+        '''
         with open(filename, 'r') as file:
             attrs = json.loads(file.read())
         s = attrs.pop('s')
         t = attrs.pop('t')
-        time = attrs.pop('current_time') 
+        # only pass attributes the trainer's constructor accepts 
+        params = inspect.signature(Class.__init__).parameters
+        attrs = {key:value for key, value in attrs.items() if key in params}
+        attrs.update(kwargs)
         print(attrs)
-        trainer = Class(envs=envs, model=model, val_envs=val_envs, log_scalars=log_scalars, gpu_growth=allow_gpu_growth, **attrs)
+        trainer = Class(envs=envs, model=model, val_envs=val_envs, log_scalars=log_scalars, gpu_growth=allow_gpu_growth, **attrs) if 'gpu_growth' in params \
+                    else Class(envs=envs, model=model, val_envs=val_envs, log_scalars=log_scalars, **attrs)
+        trainer.load_model(model_checkpoint, trainer.model_dir + '/')
         if continue_train:
             trainer.s = s
-            trainer.t = t
-        self.load_model(model_checkpoint, trainer.model_dir)
+            trainer.t = t + 1 # checkpoints are written after update t
+            state_file = filename[:-len('.trainer')] + '.state'
+            if os.path.exists(state_file):
+                with open(state_file, 'rb') as file:
+                    trainer.restore_state(pickle.load(file))
+                trainer.warmed_up = True
+            else: # e.g. checkpoints written before .state files existed
+                print('warning: %s not found, resuming with fresh normalisers, replay memory, exploration schedule and RNG state, '
+                      'warm up phases run again' %(state_file))
         return trainer
 
 
@@ -336,10 +554,38 @@ class SyncMultiEnvTrainer(object):
     def get_action(self,state): #include small fn as to reuse validate 
         raise NotImplementedError('get_action method is required, check that this is implemented properly')
     
+    def validate_batch(self,envs,num_eps,max_steps,render=False):
+        ''' 
+            validation episodes with get_batch_actions, see validation_episodes
+            
+            Args:
+                envs - BatchEnv or list of validation envs
+                num_eps - list of number of episodes to run on each env 
+                max_steps - maximum number of steps per episode
+                render - boolean flag whether to render the first env 
+        '''
+        scores = validation_episodes(envs, num_eps, max_steps, self.get_batch_actions, self.init_validate_state(len(envs)),
+                                     self.reset_validate_state, render)
+        self.validate_rewards.extend(scores)
+    
+    def can_validate_batch(self):
+        # batched validation is used when a trainer implements get_batch_actions, otherwise fall back to threaded validate
+        return type(self).get_batch_actions is not SyncMultiEnvTrainer.get_batch_actions
+    
+    def get_batch_actions(self,states,val_state):
+        ''' returns actions for a batch of validation states and the updated recurrent state (e.g. lstm hidden) '''
+        raise NotImplementedError(self, 'does not have a batched validation policy')
+    
+    def init_validate_state(self,num_envs):
+        # initial recurrent state for validation, None for feedforward policies
+        return None
+    
+    def reset_validate_state(self,val_state,actions,rewards,dones):
+        # called after each validation step, recurrent policies reset hidden state of envs which finished an episode
+        return val_state
+    
     def fold_batch(self,x):
-        rows, cols = x.shape[0], x.shape[1]
-        y = x.reshape(rows*cols,*x.shape[2:])
-        return y
+        return fold_batch(x)
             
     
     class Runner(ABC):
@@ -347,6 +593,8 @@ class SyncMultiEnvTrainer(object):
             self.model = model
             self.env = env
             self.num_steps = num_steps
+            self.timer = PhaseTimer(enabled=False) # replaced by the trainer's timer when training starts
+            self.rollout = RolloutStorage(num_steps) # reused every update, allocated on the first rollout
             self.states = self.env.reset()
         
         @abstractmethod
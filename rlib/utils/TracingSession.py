@@ -0,0 +1,71 @@
+import os
+from collections import defaultdict
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class TracingSession(object):
+    def __init__(self, sess, trace_dir, trace_updates, writer=None, top_ops=10):
+        '''
+            Session proxy handed to models which adds FULL_TRACE run options to every sess.run within a window of updates,
+            so op level timelines can be captured without editing any backprop/forward code
+
+            Args:
+                sess - the trainer's tf.Session, all other attributes are forwarded to it
+                trace_dir - directory for chrome trace timelines (update_<t>_run_<i>.json) and step stats (.pbtxt)
+                trace_updates - (start, end) range of updates to trace, end exclusive
+                writer - optional tf.summary.FileWriter to add run metadata to (graph tab in tensorboard)
+                top_ops - number of slowest ops printed per traced update
+        '''
+        self.sess = sess
+        self.trace_dir = trace_dir
+        self.start, self.end = trace_updates
+        self.writer = writer
+        self.top_ops = top_ops
+        self.active = False
+        self.update = 0
+        self.run_count = 0
+        self.op_times = defaultdict(int)
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+    def set_update(self, t):
+        ''' called with the index of the next update, prints a summary of the update just traced '''
+        if self.active:
+            self._print_slowest_ops()
+        self.update = t
+        self.run_count = 0
+        self.active = self.start <= t < self.end
+
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        if not self.active:
+            return self.sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        results = self.sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        self._record(run_metadata)
+        return results
+
+    def _record(self, run_metadata):
+        name = 'update_%i_run_%i' %(self.update, self.run_count)
+        self.run_count += 1
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(os.path.join(self.trace_dir, name + '.json'), 'w') as file:
+            file.write(trace.generate_chrome_trace_format(show_memory=True))
+        with open(os.path.join(self.trace_dir, name + '.pbtxt'), 'w') as file:
+            file.write(str(run_metadata.step_stats))
+        if self.writer is not None:
+            self.writer.add_run_metadata(run_metadata, name)
+        for device in run_metadata.step_stats.dev_stats:
+            for node in device.node_stats:
+                self.op_times[node.node_name] += node.all_end_rel_micros
+
+    def _print_slowest_ops(self):
+        total = max(sum(self.op_times.values()), 1)
+        print('update %i, %i traced runs, slowest ops:' %(self.update, self.run_count))
+        for op, micros in sorted(self.op_times.items(), key=lambda x: -x[1])[:self.top_ops]:
+            print('    %-60s %10.3fms %5.1f%%' %(op, micros / 1000, 100 * micros / total))
+        self.op_times = defaultdict(int)
@@ -3,10 +3,10 @@ import gym
 import multiprocessing as mp
 import threading
 import time
+import pickle
+import copy
 from PIL import Image
-import tensorflow as tf
 from itertools import chain
-import matplotlib.pyplot as plt
 from collections import deque
 
 # Code was inspired from or modified from OpenAI baselines https://github.com/openai/baselines/tree/master/baselines/common
@@ -100,10 +100,15 @@ class NoopResetEnv(gym.Wrapper):
     def __init__(self, env, max_op=7):
         gym.Wrapper.__init__(self, env)
         self.max_op = max_op
+        self._rng = np.random.RandomState()
+    
+    def seed(self, seed=None):
+        self._rng.seed(seed)
+        return self.env.seed(seed)
 
     def reset(self, **kwargs):
         obs = self.env.reset(**kwargs)
-        noops = np.random.randint(0, self.max_op)
+        noops = self._rng.randint(0, self.max_op)
         for i in range(noops):
             obs, reward, done, info = self.env.step(0)
         return obs
@@ -117,6 +122,7 @@ class ClipRewardEnv(gym.Wrapper):
     
     def step(self, action):
         obs, reward, done, info = self.env.step(action)
+        info['raw_reward'] = reward # keep unclipped reward for episode statistics
         reward = np.clip(reward, -1, 1)
         return obs, reward, done, info
     
@@ -164,6 +170,7 @@ class EpisodicLifeEnv(gym.Wrapper):
     def step(self, action):
         obs, reward, done, info = self.env.step(action)
         self.end_of_episode = done 
+        info['end_of_episode'] = done # true end of game rather than loss of life
         lives = self.env.unwrapped.ale.lives()
         if lives < self.lives:
             done = True
@@ -177,6 +184,33 @@ class EpisodicLifeEnv(gym.Wrapper):
             obs, _, _, _ = self.env.step(0)
         return obs
 
+class MaxAndSkipEnv(gym.Wrapper):
+    def __init__(self, env, skip=4):
+        """Repeat each action skip times and max-pool the last two raw frames.
+           Applied directly above the raw env so the rest of the wrapper chain (rescale, stack, clip ...) runs once per agent step.
+           Each step returns a newly allocated frame so callers may keep observations."""
+        gym.Wrapper.__init__(self, env)
+        self._skip = skip
+        shape, dtype = env.observation_space.shape, env.observation_space.dtype
+        self._obs_buffer = np.zeros((2,) + shape, dtype=dtype)
+
+    def step(self, action):
+        total_reward = 0.0
+        for i in range(self._skip):
+            obs, reward, done, info = self.env.step(action)
+            total_reward += reward
+            if done:
+                break
+            if i >= self._skip - 2:
+                self._obs_buffer[i - (self._skip - 2)] = obs
+        if done or self._skip < 2: # pool over final frame only when episode ends early 
+            self._obs_buffer[:] = obs
+        max_frame = np.maximum(self._obs_buffer[0], self._obs_buffer[1])
+        return max_frame, total_reward, done, info
+    
+    def reset(self, **kwargs):
+        return self.env.reset(**kwargs)
+
 class TimeLimitEnv(gym.Wrapper):
     def __init__(self, env, time_limit):
         gym.Wrapper.__init__(self,env)
@@ -276,9 +310,10 @@ class StackEnv(gym.Wrapper):
 #             self._stacked_frames.append(frame)
 #         return np.stack(self._stacked_frames,axis=2)
 
-def AtariEnv(env, k=4, rescale=84, episodic=True, reset=True, clip_reward=True, Noop=True, time_limit=None):
+def AtariEnv(env, k=4, rescale=84, episodic=True, reset=True, clip_reward=True, Noop=True, time_limit=None, skip=1):
     # Wrapper function for Determinsitic Atari env 
     # assert 'Deterministic' in env.spec.id
+    # skip > 1 repeats actions with max-pooling inside the worker, intended for NoFrameskip env ids
     if reset:
         env = FireResetEnv(env)
     if Noop:
@@ -288,6 +323,9 @@ def AtariEnv(env, k=4, rescale=84, episodic=True, reset=True, clip_reward=True,
             max_op = 7
         env = NoopResetEnv(env,max_op)
     
+    if skip > 1:
+        env = MaxAndSkipEnv(env, skip)
+    
     if clip_reward:
         env = ClipRewardEnv(env)
 
@@ -309,26 +347,146 @@ def AtariEnv(env, k=4, rescale=84, episodic=True, reset=True, clip_reward=True,
 
     return env
 
+# per env, per step episode statistics returned by BatchEnv and ChunkEnv instead of a tuple of info dicts
+episode_info_dtype = np.dtype([('episode_return', np.float32), ('episode_length', np.int32), ('lives', np.int32), ('episode_end', np.bool_)])
+
+class EpisodeStats(object):
+    def __init__(self):
+        ''' worker side episode accounting, returns are unclipped and episodes span lives lost under EpisodicLifeEnv '''
+        self.episode_return = 0
+        self.episode_length = 0
+    
+    def update(self, reward, done, info, lives=0):
+        ''' lives - the env's remaining lives after this step, see ale_lives '''
+        self.episode_return += info.get('raw_reward', reward)
+        self.episode_length += 1
+        end = info.get('end_of_episode', done)
+        stats = (self.episode_return, self.episode_length, lives, end)
+        if end:
+            self.episode_return, self.episode_length = 0, 0
+        return stats
+
+
+def ale_lives(env):
+    # remaining lives of an atari env read from the emulator, the step info key differs between atari-py ('ale.lives') and ale-py ('lives')
+    unwrapped = env.unwrapped
+    return unwrapped.ale.lives() if hasattr(unwrapped, 'ale') else 0
+
+
+def _unseeded_space(space):
+    ''' copy of a gym space without its RNG, seeded spaces pickle in the worker but cannot be unpickled in the parent
+        on gym 0.23 with numpy 1.x (deepcopy fails the same way), the parent's copy is seeded lazily if it is ever sampled
+    '''
+    space = copy.copy(space)
+    space._np_random = None
+    nested = getattr(space, 'spaces', None) # Dict and Tuple spaces
+    if isinstance(nested, dict):
+        space.spaces = type(nested)((key, _unseeded_space(value)) for key, value in nested.items())
+    elif nested is not None:
+        space.spaces = tuple(_unseeded_space(value) for value in nested)
+    return space
+
+
+def worker_seeds(seed, num_envs):
+    ''' derive one seed per env from a single master seed, None gives unseeded workers '''
+    if seed is None:
+        return [None for i in range(num_envs)]
+    return [int(s) for s in np.random.RandomState(seed).randint(0, 2**31 - 1, size=num_envs)]
+
+
+class EnvConstructor(object):
+    def __init__(self, env_constructor, env_id, **env_args):
+        ''' picklable recipe for building a wrapped env inside a worker process 
+            e.g. EnvConstructor(AtariEnv, 'PongNoFrameskip-v4', k=4) 
+        '''
+        self.env_constructor = env_constructor
+        self.env_id = env_id
+        self.env_args = env_args
+    
+    def __call__(self):
+        return self.env_constructor(gym.make(self.env_id), **self.env_args)
+
+
 class Env(object):
-    def __init__(self,env,worker_id=0): #, Wrappers=None, **wrapper_args):
-        #self.env_id = env_id
-        #env = gym.make(env_id)
-        self.parent, self.child = mp.Pipe()
-        self.worker = Env.Worker(worker_id,env,self.child)
-        self.worker.daemon = True
+    # attributes looked up directly on the proxy, never forwarded to the worker
+    _local_attrs = ('parent', 'child', 'worker', 'open', '_attr_cache')
+
+    def __init__(self, env, worker_id=0, start_method=None, seed=None):
+        ''' env - either a gym env or a picklable callable (e.g. EnvConstructor) that builds the env inside the worker
+            start_method - multiprocessing start method 'fork', 'spawn' or 'forkserver', None for platform default
+            seed - seed for the worker's numpy, env and action space RNGs, None for a random seed 
+        '''
+        self._attr_cache = None
+        ctx = mp.get_context(start_method)
+        self.parent, self.child = ctx.Pipe()
+        self.worker = ctx.Process(target=Env.Worker(worker_id,env,self.child,seed).run, daemon=True)
         self.worker.start()
+        self.child.close() # only the worker holds the child end, so a dead worker raises EOFError in recv instead of blocking
         self.open = True        
     
     def __del__(self):
-        self.close()
-        self.parent.close()
-        self.child.close()
+        try:
+            self.close()
+            self.parent.close()
+            self.child.close()
+        except Exception: # interpreter teardown or a partly constructed proxy, nothing left to clean up
+            pass
     
     def __getattr__(self, name):
-        attribute = self._send_step('getattr', name)
-        return attribute()
+        if name.startswith('__') or name in Env._local_attrs:
+            raise AttributeError(name)
+        # env metadata (spaces, spec, action meanings ...) is sent once at worker start
+        cache = self.cached_attrs()
+        if name in cache:
+            return cache[name]
+        return self.get_attr(name)
+
+    @property
+    def unwrapped(self):
+        # env.unwrapped.get_action_meanings() is served from the cache, other attributes are fetched from the worker's unwrapped env
+        return UnwrappedEnv(self)
+
+    def failed(self):
+        ''' True if the worker could not build its env '''
+        try:
+            self.cached_attrs()
+        except RuntimeError:
+            return True
+        return False
+
+    def cached_attrs(self):
+        if self._attr_cache is None:
+            try:
+                self._attr_cache = self.parent.recv() # first message from worker is always its metadata
+            except Exception as e: # e.g. the metadata could not be unpickled in the parent
+                self._attr_cache = {'error':'{}: {}'.format(type(e).__name__, e)}
+            if 'error' in self._attr_cache:
+                raise RuntimeError('worker failed to build env, ' + self._attr_cache['error'])
+        return self._attr_cache
+    
+    def get_action_meanings(self):
+        cache = self.cached_attrs()
+        if 'action_meanings' not in cache:
+            raise AttributeError('environment does not have action meanings')
+        return cache['action_meanings']
+
+    def get_attr(self, name):
+        ''' explicit RPC for dynamic attributes, dotted names e.g. 'unwrapped.ale' are resolved in the worker '''
+        return Env._unpack(self._send_step('getattr', name)())
+    
+    def call(self, name, *args, **kwargs):
+        ''' explicit RPC calling method 'name' on the worker env, e.g. env.call('unwrapped.ale.lives') '''
+        return Env._unpack(self._send_step('call', (name, args, kwargs))())
+    
+    @staticmethod
+    def _unpack(reply):
+        success, result = reply
+        if not success:
+            raise AttributeError(result)
+        return result
         
     def _send_step(self,cmd,action):
+        self.cached_attrs() # clear metadata from pipe before any other reply
         self.parent.send((cmd,action))
         return self._recieve
     
@@ -349,33 +507,87 @@ class Env(object):
         return results()
     
     def close(self):
-        if self.open:
-            self.open = False
-            results = self._send_step('close', None)
-            self.worker.join()
+        ''' idempotent, a worker that failed is terminated rather than sent close '''
+        if not self.open:
+            return
+        self.open = False
+        try:
+            if self.failed():
+                self.worker.terminate()
+            else:
+                self._send_step('close', None)
+        except (EOFError, OSError): # worker already gone
+            pass
+        self.worker.join()
     
     def render(self):
         #if self.open:
         self._send_step('render', None)
     
-    class Worker(mp.Process):
-        def __init__(self, worker_id, env, connection):
-            import gym
-            np.random.seed()
-            mp.Process.__init__(self)
-            self.env = env #gym.make(env_id)
+    class Worker(object):
+        def __init__(self, worker_id, env, connection, seed=None):
+            self.env = env
             self.worker_id = worker_id
             self.connection = connection
+            self.seed = seed
+        
+        def _make_env(self):
+            np.random.seed(self.seed)
+            self.stats = EpisodeStats()
+            if not isinstance(self.env, gym.Env): # build env from constructor inside worker process
+                self.env = self.env()
+            if self.seed is not None:
+                self.env.seed(self.seed)
+                self.env.action_space.seed(self.seed)
+        
+        def _metadata(self):
+            metadata = {}
+            for name in ['observation_space', 'action_space', 'reward_range', 'spec', 'metadata']:
+                if hasattr(self.env, name):
+                    metadata[name] = getattr(self.env, name)
+            unwrapped = self.env.unwrapped
+            if hasattr(unwrapped, 'get_action_meanings'):
+                metadata['action_meanings'] = unwrapped.get_action_meanings()
+            if hasattr(unwrapped, 'ale'):
+                metadata['ale_lives'] = unwrapped.ale.lives()
+            for name, value in list(metadata.items()): # only send what round trips through pickle
+                if isinstance(value, gym.Space):
+                    metadata[name] = value = _unseeded_space(value)
+                try:
+                    pickle.loads(pickle.dumps(value))
+                except Exception:
+                    metadata.pop(name)
+            return metadata
+        
+        def _resolve(self, name):
+            attr = self.env
+            for part in name.split('.'):
+                attr = getattr(attr, part)
+            return attr
+        
+        def _reply(self, fn):
+            try:
+                self.connection.send((True, fn()))
+            except Exception as e: # missing or non-picklable attributes are reported back to the parent 
+                self.connection.send((False, '{}: {}'.format(type(e).__name__, e)))
         
         def _step(self):
             try:
+                self._make_env()
+                metadata = self._metadata()
+            except Exception as e:
+                self.connection.send({'error':'{}: {}'.format(type(e).__name__, e)})
+                return
+            try:
+                self.connection.send(metadata)
                 while True:
                     cmd, a = self.connection.recv()
                     if cmd == 'step':
                         obs, r, done, info = self.env.step(a)
+                        stats = self.stats.update(r, done, info, ale_lives(self.env))
                         if done:
                             obs = self.env.reset()
-                        self.connection.send((obs,r,done,info))
+                        self.connection.send((obs,r,done,stats))
                     elif cmd == 'render':
                         self.env.render()
                         #self.connection.send((1))
@@ -383,7 +595,10 @@ class Env(object):
                         obs = self.env.reset()
                         self.connection.send(obs)
                     elif cmd == 'getattr':
-                        self.connection.send(getattr(self.env, a))
+                        self._reply(lambda: self._resolve(a))
+                    elif cmd == 'call':
+                        name, args, kwargs = a
+                        self._reply(lambda: self._resolve(name)(*args, **kwargs))
                     elif cmd == 'close':
                         self.env.close()
                         #self.connection.send((1))
@@ -401,37 +616,112 @@ class Env(object):
 
 
 
+class UnwrappedEnv(object):
+    def __init__(self, env):
+        ''' env.unwrapped of an Env proxy, attributes are fetched from the worker's unwrapped env by get_attr '''
+        self._env = env
+
+    def get_action_meanings(self):
+        return self._env.get_action_meanings()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self._env.get_attr('unwrapped.' + name)
+        except AttributeError as e:
+            # e.g. unwrapped.ale cannot be pickled out of the worker, its methods can still be called there
+            raise AttributeError('unwrapped.%s could not be fetched from the worker (%s), call its methods in the worker instead '
+                                 'e.g. env.call(\'unwrapped.%s.<method>\')' %(name, e, name)) from None
+
+
 class BatchEnv(object):
-    def __init__(self, env_constructor, env_id, num_envs, blocking=False, **env_args):
-        #self.envs = [Env(env_constructor(gym.make(env_id),**env_args),worker_id=i) for i in range(num_envs)]
-        self.envs = []
-        for i in range(num_envs):
-            env = gym.make(env_id)
-            self.envs.append(Env(env_constructor(env, **env_args)))
-        #self.envs = [env_constructor(env_id=env_id,**env_args, worker_id=i) for i in range(num_envs)]
+    def __init__(self, env_constructor, env_id, num_envs, blocking=False, start_method=None, seed=None, **env_args):
+        ''' Runs num_envs environments in parallel worker processes
+            Each worker builds its own env from EnvConstructor(env_constructor, env_id, **env_args),
+            so env_constructor must be picklable (module level function or class) when start_method is 'spawn' or 'forkserver'
+
+            Args:
+                env_constructor - env wrapper function e.g. AtariEnv
+                env_id - gym env id string
+                num_envs - number of worker processes
+                blocking - wait for each worker to step before stepping the next
+                start_method - multiprocessing start method, 'forkserver' pre-imports numpy, gym and this module (which the pickled constructor needs) once for all workers
+                seed - master seed from which each worker's seed is derived, None for unseeded workers
+                env_args - keyword arguments passed to env_constructor
+        '''
+        self._start_time = time.time()
+        self.time_to_first_batch = None
+        if start_method == 'forkserver':
+            mp.get_context(start_method).set_forkserver_preload(['numpy', 'gym', 'rlib.utils.VecEnv'])
+        constructor = EnvConstructor(env_constructor, env_id, **env_args)
+        # start all workers before waiting on any, envs are built in parallel
+        seeds = worker_seeds(seed, num_envs)
+        self.envs = [Env(constructor, worker_id=i, start_method=start_method, seed=seeds[i]) for i in range(num_envs)]
+        for env in self.envs:
+            env.cached_attrs()
+        self.startup_time = time.time() - self._start_time
         self.blocking = blocking
+        self.episode_returns, self.episode_lengths = [], []
 
     def __len__(self):
         return len(self.envs)
     
     def __getattr__(self, name):
+        if name.startswith('__') or name in ('envs', 'blocking', '_start_time', 'time_to_first_batch', 'startup_time', 'episode_returns', 'episode_lengths'):
+            raise AttributeError(name)
         return getattr(self.envs[0], name)
+    
+    @property
+    def unwrapped(self):
+        return self.envs[0].unwrapped
+    
+    def get_attr(self, name):
+        ''' fetch attribute 'name' from every worker, requests are sent to all workers before collecting '''
+        results = [env._send_step('getattr', name) for env in self.envs]
+        return [Env._unpack(result()) for result in results]
+    
+    def call_method(self, name, *args, **kwargs):
+        ''' call method 'name' on every worker env and return the list of results '''
+        results = [env._send_step('call', (name, args, kwargs)) for env in self.envs]
+        return [Env._unpack(result()) for result in results]
 
     def step(self,actions):
         if self.blocking: # wait for each process to return results before starting the next
-            results = [env.step(action,True) for env, action in zip(self.envs,actions)]
+            results = [env.step(action,True)() for env, action in zip(self.envs,actions)]
         else:
             results = [env.step(action,False) for env, action in zip(self.envs,actions)] # apply steps async
             results = [result() for result in results] # collect results
             
         obs, rewards, done, info = zip(*results)
-        np.stack(obs), np.stack(rewards), np.stack(done), info
+        info = np.array(list(info), dtype=episode_info_dtype)
+        self._record_episodes(info)
+        self._first_batch()
         return np.stack(obs), np.stack(rewards), np.stack(done), info
     
+    def _record_episodes(self, info):
+        ended = info[info['episode_end']]
+        if len(ended):
+            self.episode_returns.extend(ended['episode_return'].tolist())
+            self.episode_lengths.extend(ended['episode_length'].tolist())
+    
+    def pop_episode_stats(self):
+        ''' returns and lengths of all training episodes completed since the last call '''
+        returns, lengths = np.array(self.episode_returns), np.array(self.episode_lengths)
+        self.episode_returns, self.episode_lengths = [], []
+        return returns, lengths
+    
     def reset(self):
-        obs = [env.reset() for env in self.envs]
+        results = [env._send_step('reset', None) for env in self.envs] # reset all workers before collecting
+        obs = [result() for result in results]
+        self._first_batch()
         return np.stack(obs)
     
+    def _first_batch(self):
+        # startup_time and time_to_first_batch are left for the caller to log (see SyncMultiEnvTrainer.train)
+        if self.time_to_first_batch is None:
+            self.time_to_first_batch = time.time() - self._start_time
+    
     def close(self):
         for env in self.envs:
             env.close()
@@ -443,16 +733,18 @@ def chunks(l, n):
         yield l[i:i+n]
 
 class ChunkEnv(object):
-    def __init__(self, env_id, num_workers, num_chunks):
+    def __init__(self, env_id, num_workers, num_chunks, seed=None):
         self.num_workers = num_workers
         self.num_chunks = num_chunks
         self.env_id = env_id
 
         self.workers = []
         self.parents = []
+        # same per env seeds as BatchEnv(DummyEnv, env_id, num_workers*num_chunks, seed=seed)
+        seeds = list(chunks(worker_seeds(seed, num_workers*num_chunks), num_chunks))
         for i in range(num_workers):
             parent, child = mp.Pipe()
-            worker = ChunkWorker(env_id,num_chunks,child)
+            worker = ChunkWorker(env_id,num_chunks,child,seeds=seeds[i])
             self.parents.append(parent)
             self.workers.append(worker)
 
@@ -488,7 +780,7 @@ class ChunkEnv(object):
         if blocking:
             results = list(chain.from_iterable(results()))
             obs, rewards, dones, infos = zip(*results)
-            return np.stack(obs), np.stack(rewards), np.stack(dones), infos
+            return np.stack(obs), np.stack(rewards), np.stack(dones), np.array(list(infos), dtype=episode_info_dtype)
         else:
             return results
     
@@ -503,29 +795,52 @@ class ChunkEnv(object):
             worker.join()
 
 class ChunkWorker(mp.Process):
-    def __init__(self, env_id, num_chunks, connection, render=False):
+    def __init__(self, env_id, num_chunks, connection, render=False, seeds=None):
         mp.Process.__init__(self)
-        self.envs = [gym.make(env_id) for i in range(num_chunks)]
+        self.env_id = env_id
+        self.num_chunks = num_chunks
         self.connection = connection
         self.render = render
+        self.seeds = seeds if seeds is not None else [None for i in range(num_chunks)]
         
+    def _seeded(self, i, fn):
+        # each env steps with its own global numpy stream, the stream a BatchEnv worker seeded with the same seed would have
+        if self.seeds[i] is None:
+            return fn()
+        np.random.set_state(self.rng_states[i])
+        try:
+            return fn()
+        finally:
+            self.rng_states[i] = np.random.get_state()
+
     def run(self):
+        self.rng_states = []
+        for seed in self.seeds:
+            np.random.seed(seed)
+            self.rng_states.append(np.random.get_state())
+        self.envs = [self._seeded(i, lambda: gym.make(self.env_id)) for i in range(self.num_chunks)] # build envs inside worker process
+        self.stats = [EpisodeStats() for i in range(self.num_chunks)]
+        for env, seed in zip(self.envs, self.seeds):
+            if seed is not None:
+                env.seed(seed)
+                env.action_space.seed(seed)
         while True:
             cmd, actions = self.connection.recv()
             if cmd == 'step':
                 results = []
-                for a, env in zip(actions,self.envs):
-                    obs, r, done, info = env.step(a)
+                for i, (a, env, stats) in enumerate(zip(actions,self.envs,self.stats)):
+                    obs, r, done, info = self._seeded(i, lambda: env.step(a))
+                    info = stats.update(r, done, info, ale_lives(env))
                     if done:
-                        obs = env.reset()
+                        obs = self._seeded(i, env.reset)
                     if self.render:
-                        self.env.render()
+                        env.render()
                     results.append((obs,r,done,info))
                 self.connection.send(results)
             elif cmd == 'reset':
                 results = []
-                for a, env in zip(actions,self.envs):
-                    obs = env.reset()
+                for i, env in enumerate(self.envs):
+                    obs = self._seeded(i, env.reset)
                     results.append(obs)
                 self.connection.send(results)
             elif cmd == 'close':
@@ -535,4 +850,35 @@ class ChunkWorker(mp.Process):
                 break
 
 
-    
\ No newline at end of file
+    
+
+
+def replay_action_script(envs, action_script):
+    ''' step a vectorised env through a fixed action script [time, num_envs] from reset
+        returns stacked observations [time+1, num_envs, ...] and time taken
+    '''
+    start = time.time()
+    observations = [envs.reset()]
+    for actions in action_script:
+        obs, rewards, dones, infos = envs.step(actions)
+        observations.append(obs)
+    return np.stack(observations), time.time() - start
+
+
+def compare_env_backends(env_fns, action_script):
+    ''' verify seeded vectorised env backends produce identical observation streams for the same action script
+        e.g. compare_env_backends([lambda: BatchEnv(DummyEnv, env_id, 8, seed=0),
+                                   lambda: ChunkEnv(env_id, 2, 4, seed=0)], script)
+    '''
+    reference = None
+    identical = True
+    for i, env_fn in enumerate(env_fns):
+        envs = env_fn()
+        observations, time_taken = replay_action_script(envs, action_script)
+        envs.close()
+        if reference is None:
+            reference = observations
+        else:
+            identical = identical and np.array_equal(reference, observations)
+        print('backend %i, %i steps in %fs, fps %f' %(i, len(action_script), time_taken, len(action_script)*observations.shape[1]/time_taken))
+    return identical
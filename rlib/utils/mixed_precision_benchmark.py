@@ -0,0 +1,78 @@
+import time, argparse
+import numpy as np
+import tensorflow as tf
+from rlib.networks.networks import nature_cnn
+from rlib.A2C.ActorCritic import ActorCritic
+from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
+
+DTYPES = {'float32':tf.float32, 'float16':tf.float16, 'bfloat16':tf.bfloat16}
+
+
+def build(dtype, loss_scale, input_shape, action_size):
+    graph = tf.Graph()
+    with graph.as_default():
+        model = ActorCritic(nature_cnn, input_shape, action_size, loss_scale=loss_scale, dtype=DTYPES[dtype])
+        sess = tf.Session(graph=graph, config=SyncMultiEnvTrainer.session_config(gpu_growth=True))
+        model.set_session(sess)
+        sess.run(tf.global_variables_initializer())
+    return model, sess
+
+def copy_weights(src, src_sess, dst, dst_sess):
+    ''' master weights are float32 variables with the same names in both precisions '''
+    values = dict(zip([w.name for w in src.weights], src_sess.run(src.weights)))
+    for w in dst.weights:
+        w.load(values[w.name], dst_sess)
+
+def compare(dtype, loss_scale=128.0, num_envs=32, nsteps=20, num_updates=50, warmup=5, input_shape=(84,84,4), action_size=6):
+    '''
+        outputs and loss of a mixed precision ActorCritic(nature_cnn) against float32 from identical weights,
+        then updates/sec of both, warmup updates are not timed
+        float16 convolutions are only fast on GPUs with tensor cores, on CPU the comparison checks correctness not speed
+    '''
+    reference, reference_sess = build('float32', 1.0, input_shape, action_size)
+    mixed, mixed_sess = build(dtype, loss_scale, input_shape, action_size)
+    copy_weights(reference, reference_sess, mixed, mixed_sess)
+
+    batch_size = num_envs * nsteps
+    states = np.random.randint(0, 256, size=(batch_size, *input_shape)).astype(np.uint8)
+    R = np.random.randn(batch_size).astype(np.float32)
+    actions = np.random.randint(0, action_size, size=batch_size)
+
+    report = {}
+    policy32, value32 = reference.forward(states)
+    policy16, value16 = mixed.forward(states)
+    report['policy_max_error'] = float(np.abs(policy32 - policy16).max())
+    report['value_max_error'] = float(np.abs(value32 - value16).max())
+    report['action_agreement'] = float(np.mean(np.argmax(policy32, axis=-1) == np.argmax(policy16, axis=-1)))
+    feed = lambda model: {model.state:states, model.R:R, model.actions:actions}
+    loss32 = reference_sess.run(reference.loss, feed(reference))
+    loss16 = mixed_sess.run(mixed.loss, feed(mixed))
+    report['loss_error'] = float(abs(loss32 - loss16))
+
+    for name, model in (('float32', reference), (dtype, mixed)):
+        for i in range(warmup):
+            model.backprop(states, R, actions)
+        start = time.perf_counter()
+        for i in range(num_updates):
+            model.backprop(states, R, actions)
+        report[name + '_updates_per_sec'] = num_updates / (time.perf_counter() - start)
+
+    reference_sess.close()
+    mixed_sess.close()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'bfloat16'])
+    parser.add_argument('--loss_scale', type=float, default=128.0, help='static loss scale, 1 for bfloat16 which has the float32 exponent range')
+    parser.add_argument('--num_envs', type=int, default=32)
+    parser.add_argument('--nsteps', type=int, default=20)
+    parser.add_argument('--num_updates', type=int, default=50)
+    args = parser.parse_args()
+
+    report = compare(args.dtype, args.loss_scale, args.num_envs, args.nsteps, args.num_updates)
+    print('%s vs float32: policy max error %f, value max error %f, action agreement %f, loss error %f' %(args.dtype,
+          report['policy_max_error'], report['value_max_error'], report['action_agreement'], report['loss_error']))
+    print('updates/s: float32 %.2f, %s %.2f (%.2fx)' %(report['float32_updates_per_sec'], args.dtype,
+          report[args.dtype + '_updates_per_sec'], report[args.dtype + '_updates_per_sec'] / report['float32_updates_per_sec']))
@@ -0,0 +1,76 @@
+import os, time, argparse
+os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_cpu_global_jit') # must be set before tensorflow reads it for cpu auto-clustering
+import numpy as np
+import tensorflow as tf
+from rlib.networks.networks import nature_cnn
+from rlib.A2C.ActorCritic import ActorCritic
+from rlib.A2C.A2C_lstm import A2C_LSTM
+from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
+
+
+def build(model_type, input_shape, action_size, num_envs):
+    if model_type == 'cnn':
+        return ActorCritic(nature_cnn, input_shape, action_size)
+    elif model_type == 'lstm':
+        return A2C_LSTM(nature_cnn, input_shape, action_size, num_envs, cell_size=256)
+    raise ValueError('unknown model type ' + str(model_type))
+
+def benchmark(model_type, xla, num_envs=32, nsteps=20, num_updates=50, warmup=5, input_shape=(84,84,4), action_size=6):
+    '''
+        updates/sec (backprop on a num_envs*nsteps batch) and forwards/sec (one rollout step of num_envs) of a model with or without XLA,
+        warmup updates are not timed so XLA compilation is excluded
+    '''
+    tf.reset_default_graph()
+    model = build(model_type, input_shape, action_size, num_envs)
+    sess = tf.Session(config=SyncMultiEnvTrainer.session_config(gpu_growth=True, xla=xla))
+    model.set_session(sess)
+    sess.run(tf.global_variables_initializer())
+
+    batch_size = num_envs * nsteps
+    states = np.random.randint(0, 256, size=(batch_size, *input_shape)).astype(np.uint8)
+    R = np.random.randn(batch_size).astype(np.float32)
+    actions = np.random.randint(0, action_size, size=batch_size)
+    if model_type == 'lstm':
+        hidden = model.get_initial_hidden(num_envs)
+        dones = np.zeros((nsteps, num_envs), dtype=np.float32)
+        forward = lambda: model.forward(states[:num_envs], hidden)
+        update = lambda: model.backprop(states, R, actions, hidden, dones)
+    else:
+        forward = lambda: model.forward(states[:num_envs])
+        update = lambda: model.backprop(states, R, actions)
+
+    for i in range(warmup):
+        forward()
+        update()
+    start = time.perf_counter()
+    for i in range(num_updates):
+        update()
+    updates_per_sec = num_updates / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(num_updates * nsteps):
+        forward()
+    forwards_per_sec = num_updates * nsteps / (time.perf_counter() - start)
+    sess.close()
+    return updates_per_sec, forwards_per_sec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', nargs='+', default=['cnn', 'lstm'], choices=['cnn', 'lstm'])
+    parser.add_argument('--num_envs', type=int, default=32)
+    parser.add_argument('--nsteps', type=int, default=20)
+    parser.add_argument('--num_updates', type=int, default=50)
+    args = parser.parse_args()
+
+    results = []
+    for model_type in args.models:
+        for xla in [False, True]:
+            updates, forwards = benchmark(model_type, xla, args.num_envs, args.nsteps, args.num_updates)
+            results.append((model_type, xla, updates, forwards))
+
+    print('%-6s %-5s %12s %12s' %('model', 'xla', 'updates/s', 'forwards/s'))
+    for model_type, xla, updates, forwards in results:
+        print('%-6s %-5s %12.2f %12.2f' %(model_type, xla, updates, forwards))
+    for model_type in args.models:
+        (_, _, u0, f0), (_, _, u1, f1) = [r for r in results if r[0] == model_type]
+        print('%s xla speedup: updates %.2fx, forwards %.2fx' %(model_type, u1 / u0, f1 / f0))
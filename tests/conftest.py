@@ -0,0 +1,8 @@
+import os, sys
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1') # tf.nn.rnn_cell needs tf_keras on tensorflow >= 2.16
+import tensorflow as tf
+
+# rlib is written against the tensorflow 1.x graph API, run the tests on tensorflow 2 through its compat.v1 module
+if not hasattr(tf, 'placeholder'):
+    tf.compat.v1.disable_v2_behavior()
+    sys.modules['tensorflow'] = tf.compat.v1
@@ -0,0 +1,33 @@
+import numpy as np
+import tensorflow as tf
+from rlib.networks.networks import lstm_masked, convert_lstm_checkpoint
+
+
+def lstm_outputs(fused, checkpoint, inputs, mask, save=False):
+    time, batch, input_size = inputs.shape
+    cell_size = 8
+    with tf.Graph().as_default():
+        x = tf.placeholder(tf.float32, [None, input_size])
+        with tf.variable_scope('lstm'):
+            output, (cell_in, hidden_in), hidden_out, mask_ph = lstm_masked(x, cell_size, fold_output=True, time_major=True, fused=fused)
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if save:
+                sess.run(tf.global_variables_initializer())
+                saver.save(sess, checkpoint)
+            else:
+                saver.restore(sess, checkpoint)
+            zeros = np.zeros((batch, cell_size), dtype=np.float32)
+            return sess.run(output, {x:inputs.reshape(-1, input_size), cell_in:zeros, hidden_in:zeros, mask_ph:mask})
+
+
+def test_converted_checkpoint_matches_lstm_cell(tmp_path):
+    inputs = np.random.randn(5, 3, 6).astype(np.float32)
+    mask = np.zeros((5, 3), dtype=np.float32)
+    mask[2, 1] = 1 # reset part way through a sequence
+    checkpoint, converted = str(tmp_path / 'lstm.ckpt'), str(tmp_path / 'fused.ckpt')
+
+    expected = lstm_outputs(False, checkpoint, inputs, mask, save=True)
+    convert_lstm_checkpoint(checkpoint, converted)
+    outputs = lstm_outputs(True, converted, inputs, mask)
+    np.testing.assert_allclose(outputs, expected, rtol=1e-5, atol=1e-6)
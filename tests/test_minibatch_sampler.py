@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from rlib.utils.RolloutStorage import MinibatchSampler
+from rlib.utils.utils import fold_batch
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_gather_matches_fold_batch(axis):
+    states = np.random.randn(8, 4, 3)
+    actions = np.random.randint(0, 6, size=(8, 4))
+    minibatches = MinibatchSampler(2, axis=axis)
+    seen = []
+    for batch_idxs in minibatches.shuffle(states.shape[axis], num_epochs=2):
+        mb_states, mb_actions = minibatches.gather(batch_idxs, states, actions)
+        take = lambda x: x[batch_idxs] if axis == 0 else x[:, batch_idxs]
+        np.testing.assert_array_equal(mb_states, fold_batch(take(states)))
+        np.testing.assert_array_equal(mb_actions, fold_batch(take(actions)))
+        seen.extend(batch_idxs)
+    assert sorted(seen) == sorted(list(range(states.shape[axis])) * 2) # every step once per epoch
+
+
+def test_buffers_alternate():
+    x = np.arange(8)[:, None].repeat(2, axis=1)
+    minibatches = MinibatchSampler(4, num_buffers=2)
+    first, = minibatches.gather(np.array([0, 1]), x)
+    second, = minibatches.gather(np.array([2, 3]), x)
+    np.testing.assert_array_equal(first, fold_batch(x[[0, 1]])) # still intact after the next gather
+    third, = minibatches.gather(np.array([4, 5]), x)
+    assert np.shares_memory(first, third) and not np.shares_memory(first, second)
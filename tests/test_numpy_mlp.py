@@ -0,0 +1,50 @@
+import numpy as np
+import tensorflow as tf
+from rlib.networks.networks import mlp
+from rlib.PPO.PPO import PPO
+from rlib.A2C.ActorCritic import ActorCritic
+from rlib.utils.NumpyMLP import NumpyMLP
+
+
+def build_ppo(**kwargs):
+    model = PPO(mlp, (4,), 3, **kwargs)
+    sess = tf.Session()
+    model.set_session(sess)
+    sess.run(tf.global_variables_initializer())
+    return model, sess
+
+
+def test_backprop_staged_syncs_numpy_forward():
+    states = np.random.randn(8, 4).astype(np.float32)
+    with tf.Graph().as_default():
+        model, sess = build_ppo(staged_feeding=True)
+        numpy_model = NumpyMLP(model)
+        before = numpy_model.forward(states)[1]
+
+        minibatches = [(states, np.ones(8, dtype=np.float32), np.ones(8, dtype=np.float32), np.zeros(8, dtype=np.int32),
+                        np.full((8, 3), 1/3, dtype=np.float32)) for i in range(2)]
+        numpy_model.backprop_staged(minibatches, 1)
+        policy, value = model.forward(states)
+
+        numpy_model.stage_forward(states)
+        numpy_policy, numpy_value = numpy_model.forward_staged()
+        sess.close()
+
+    assert not np.allclose(before, value) # trained
+    np.testing.assert_allclose(numpy_policy, policy, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(numpy_value, value, rtol=1e-5, atol=1e-6)
+
+
+def test_forward_matches_tensorflow():
+    states = np.random.randn(16, 4).astype(np.float32)
+    with tf.Graph().as_default():
+        model = ActorCritic(mlp, (4,), 3)
+        sess = tf.Session()
+        model.set_session(sess)
+        sess.run(tf.global_variables_initializer())
+        policy, value = model.forward(states)
+        numpy_policy, numpy_value = NumpyMLP(model).forward(states)
+        sess.close()
+
+    np.testing.assert_allclose(numpy_policy, policy, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(numpy_value, value, rtol=1e-5, atol=1e-6)
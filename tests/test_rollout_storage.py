@@ -0,0 +1,18 @@
+import numpy as np
+from rlib.utils.RolloutStorage import RolloutStorage
+from rlib.utils.utils import fold_batch
+
+
+def test_rollout_matches_stacked_steps():
+    num_steps, num_envs = 5, 3
+    steps = [{'states':np.random.randn(num_envs, 2), 'rewards':np.random.randint(0, 2, size=num_envs)} for t in range(num_steps)]
+    steps[-1]['rewards'] = steps[-1]['rewards'] + 0.5 # float rewards after integer ones widen the buffer
+    rollout = RolloutStorage(num_steps)
+    for t, step in enumerate(steps):
+        rollout.insert(t, **step)
+
+    states, rewards = rollout.get('states', 'rewards')
+    np.testing.assert_array_equal(states, np.stack([step['states'] for step in steps]))
+    assert rewards[-1, 0] == steps[-1]['rewards'][0]
+    folded_states, = rollout.folded('states')
+    np.testing.assert_array_equal(folded_states, fold_batch(states))
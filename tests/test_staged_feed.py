@@ -0,0 +1,42 @@
+import numpy as np
+import tensorflow as tf
+from rlib.utils.StagedFeed import StagedFeed
+from rlib.utils.RolloutStorage import MinibatchSampler
+from rlib.utils.utils import fold_batch
+
+
+def test_iterate_reads_each_sampled_minibatch():
+    nsteps, num_envs = 16, 4
+    states = np.random.randint(0, 256, size=(nsteps, num_envs, 3, 3)).astype(np.uint8)
+    actions = np.random.randint(0, 6, size=(nsteps, num_envs)).astype(np.int32)
+    minibatches = MinibatchSampler(4, num_buffers=2)
+    sampled = []
+
+    def batches():
+        for batch_idxs in minibatches.shuffle(nsteps, num_epochs=2):
+            sampled.append(batch_idxs.copy())
+            mb_states, mb_actions = minibatches.gather(batch_idxs, states, actions)
+            yield {'state':mb_states, 'actions':mb_actions}
+
+    with tf.Graph().as_default():
+        feed = StagedFeed({'state':(tf.uint8, (3,3)), 'actions':(tf.int32, ())})
+        # the fetched copies of what each step dequeued
+        fetches = [tf.identity(feed.default('state')), tf.identity(feed.default('actions'))]
+        with tf.Session() as sess:
+            dequeued = list(feed.iterate(sess, fetches, batches()))
+
+    assert len(dequeued) == len(sampled) == 8
+    for batch_idxs, (mb_states, mb_actions) in zip(sampled, dequeued):
+        np.testing.assert_array_equal(mb_states, fold_batch(states[batch_idxs]))
+        np.testing.assert_array_equal(mb_actions, fold_batch(actions[batch_idxs]))
+
+
+def test_run_reads_staged_states_unless_fed():
+    with tf.Graph().as_default():
+        feed = StagedFeed({'state':(tf.float32, (2,))})
+        state = feed.default('state')
+        doubled = state * 2
+        with tf.Session() as sess:
+            feed.stage_async(sess, state=np.ones((3, 2), dtype=np.float32))
+            np.testing.assert_array_equal(feed.run(sess, doubled), np.full((3, 2), 2))
+            np.testing.assert_array_equal(sess.run(doubled, {state:np.zeros((1, 2))}), np.zeros((1, 2)))
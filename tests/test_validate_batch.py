@@ -0,0 +1,57 @@
+import gym
+import numpy as np
+import pytest
+from rlib.utils.SyncMultiEnvTrainer import SyncMultiEnvTrainer
+from rlib.utils.VecEnv import BatchEnv, DummyEnv
+
+
+class RandomPolicyTrainer(SyncMultiEnvTrainer):
+    def __init__(self, action_size):
+        # only the state validate_batch uses
+        self.validate_rewards = []
+        self.action_size = action_size
+        self.batch_sizes = []
+
+    def __del__(self):
+        pass
+
+    def get_batch_actions(self, states, val_state):
+        self.batch_sizes.append(len(states))
+        return np.random.randint(0, self.action_size, size=len(states)), val_state
+
+
+@pytest.mark.parametrize('vectorised', [False, True])
+def test_validate_batch_runs_requested_episodes(vectorised):
+    num_eps = [2, 1, 3]
+    if vectorised:
+        envs = BatchEnv(DummyEnv, 'CartPole-v1', len(num_eps))
+    else:
+        envs = [gym.make('CartPole-v1') for i in range(len(num_eps))]
+    trainer = RandomPolicyTrainer(2)
+    try:
+        trainer.validate_batch(envs, num_eps, max_steps=8)
+    finally:
+        if vectorised:
+            envs.close()
+
+    assert len(trainer.validate_rewards) == sum(num_eps)
+    assert all(1 <= score <= 8 for score in trainer.validate_rewards)
+    assert set(trainer.batch_sizes) == {len(num_eps)} # one batched forward over every env per step
+
+
+def test_evaluator_runs_requested_episodes():
+    from rlib.utils.AsyncEvaluator import AsyncEvaluator
+    policy_fn = lambda model, states: np.random.randint(0, 2, size=len(states))
+    worker = AsyncEvaluator.Worker(None, [], None, num_episodes=5, max_steps=8, policy_fn=policy_fn, log_dir=None, gpu=False)
+    scores = worker.evaluate(None, [gym.make('CartPole-v1') for i in range(2)])
+    assert len(scores) == 5
+    assert all(1 <= score <= 8 for score in scores)
+
+
+def test_attach_evaluator_rejects_recurrent_trainers():
+    class RecurrentTrainer(RandomPolicyTrainer):
+        def init_validate_state(self, num_envs):
+            return np.zeros((num_envs, 4))
+
+    with pytest.raises(ValueError):
+        RecurrentTrainer(2).attach_evaluator(None)
@@ -0,0 +1,58 @@
+import gym
+import numpy as np
+from rlib.utils.VecEnv import BatchEnv, ChunkEnv, DummyEnv, compare_env_backends
+
+
+class FakeALE(object):
+    def __init__(self):
+        self.remaining = 3
+
+    def lives(self):
+        return self.remaining
+
+
+class FakeAtari(gym.Env):
+    # loses a life every step and ends the episode with the last one, lives are only reported through ale as with ale-py
+    observation_space = gym.spaces.Box(0, 255, shape=(2,), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(2)
+
+    def __init__(self):
+        self.ale = FakeALE()
+
+    def reset(self):
+        self.ale.remaining = 3
+        return np.zeros(2, dtype=np.uint8)
+
+    def step(self, action):
+        self.ale.remaining -= 1
+        return np.zeros(2, dtype=np.uint8), 1.0, self.ale.remaining == 0, {'lives':self.ale.remaining}
+
+gym.envs.registration.register(id='FakeAtari-v0', entry_point=FakeAtari)
+
+
+def test_seeded_batch_envs_replay_identically():
+    script = np.random.RandomState(0).randint(0, 2, size=(50, 4))
+    env_fns = [lambda: BatchEnv(DummyEnv, 'CartPole-v1', 4, blocking=True, seed=3),
+               lambda: BatchEnv(DummyEnv, 'CartPole-v1', 4, blocking=False, seed=3),
+               lambda: ChunkEnv('CartPole-v1', 2, 2, seed=3)]
+    assert compare_env_backends(env_fns, script)
+
+
+def test_seeded_batch_env_spaces_reach_the_parent():
+    envs = BatchEnv(DummyEnv, 'CartPole-v1', 2, seed=3)
+    try:
+        assert envs.action_space.n == 2
+        assert envs.observation_space.shape == (4,)
+        assert envs.action_space.contains(envs.action_space.sample()) # reseeded lazily in the parent
+    finally:
+        envs.close()
+
+
+def test_episode_info_lives_read_from_ale():
+    envs = BatchEnv(DummyEnv, 'FakeAtari-v0', 2, start_method='fork')
+    try:
+        envs.reset()
+        lives = [envs.step([0, 1])[3]['lives'].tolist() for t in range(3)]
+    finally:
+        envs.close()
+    assert lives == [[2, 2], [1, 1], [0, 0]]